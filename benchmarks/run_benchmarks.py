@@ -0,0 +1,140 @@
+"""
+Benchmark each stage of the pipeline on synthetic data at several scales.
+
+Each scale is run in a separate process (so that peak memory is measured independently) using
+    `mhnav_pipeline.synthetic` data and regex file, and the stage metrics written by `build_datasets`
+    (see `mhnav_pipeline.metrics`) are collected and reported.
+
+Results are compared to a stored baseline, failing (exit code 1) if throughput of any stage (or of the
+    whole run) falls by more than `--tolerance`, or peak memory grows by more than `--tolerance`.
+    Baselines are machine-specific, so first record one on the machine used for comparison:
+
+    python benchmarks/run_benchmarks.py --save-baseline
+    # ...make changes...
+    python benchmarks/run_benchmarks.py
+"""
+import json
+import multiprocessing
+import pathlib
+import sys
+import tempfile
+
+from loguru import logger
+
+BASELINE_FILE = pathlib.Path(__file__).parent / 'baseline.json'
+
+# name -> arguments to `generate_datasets`
+SCALES = {
+    'small': dict(n_patients=200),
+    'medium': dict(n_patients=2_000),
+    'large': dict(n_patients=10_000),
+}
+# stages faster than this (in seconds) are too noisy to compare
+MIN_WALL_TIME = 0.2
+
+
+def run_scale(scale, build_options):
+    """Generate data for `scale`, run the pipeline, and return its stage metrics."""
+    from mhnav_pipeline.main import build_datasets
+    from mhnav_pipeline.synthetic import generate_datasets, SYNTHETIC_REGEX_FILE
+
+    logger.remove()
+    index_df, historical_df = generate_datasets(**SCALES[scale])
+    with tempfile.TemporaryDirectory() as outpath:
+        build_datasets(index_df, historical_df, SYNTHETIC_REGEX_FILE, outpath=outpath, output_to_csv=False,
+                       **build_options)
+        metrics_file, = pathlib.Path(outpath).glob('*/metrics_*.json')
+        with open(metrics_file) as fh:
+            metrics = json.load(fh)
+    metrics['records'] = index_df.shape[0] + historical_df.shape[0]
+    return metrics
+
+
+def run_benchmarks(scales, build_options):
+    results = {}
+    ctx = multiprocessing.get_context('spawn')
+    for scale in scales:
+        with ctx.Pool(1) as pool:
+            results[scale] = pool.apply(run_scale, (scale, build_options))
+        summary = results[scale]['summary']
+        logger.info(f'{scale}: {results[scale]["records"]} records in {summary["wall_time"]:.2f}s'
+                    f' ({results[scale]["records"] / summary["wall_time"]:.0f} records/s),'
+                    f' peak memory: {summary["peak_memory_mb"] or 0:.0f}MB')
+        for record in results[scale]['stages']:
+            logger.info(f'  * {record["stage"]}: {record["wall_time"]:.2f}s,'
+                        f' {record["notes_per_sec"] or 0:.0f} notes/s')
+    return results
+
+
+def _throughputs(result):
+    """Throughput of whole run and each stage (if long enough to measure reliably)."""
+    throughputs = {}
+    if result['summary']['wall_time'] >= MIN_WALL_TIME:
+        throughputs['total'] = result['records'] / result['summary']['wall_time']
+    for record in result['stages']:
+        if record['notes_per_sec'] and record['wall_time'] >= MIN_WALL_TIME:
+            throughputs[record['stage']] = record['notes_per_sec']
+    return throughputs
+
+
+def compare_to_baseline(results, baseline, tolerance=0.25):
+    """
+    :return: list of regressions (empty if none)
+    """
+    regressions = []
+    for scale, result in results.items():
+        if scale not in baseline:
+            logger.warning(f'No baseline for scale: {scale}')
+            continue
+        expected = _throughputs(baseline[scale])
+        for stage, throughput in _throughputs(result).items():
+            if stage in expected and throughput < expected[stage] * (1 - tolerance):
+                regressions.append(f'{scale}/{stage}: {throughput:.0f}/s (baseline: {expected[stage]:.0f}/s)')
+        memory, expected_memory = result['summary']['peak_memory_mb'], baseline[scale]['summary']['peak_memory_mb']
+        if memory and expected_memory and memory > expected_memory * (1 + tolerance):
+            regressions.append(f'{scale}/peak memory: {memory:.0f}MB (baseline: {expected_memory:.0f}MB)')
+    return regressions
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scales', nargs='+', default=['small', 'medium'], choices=list(SCALES))
+    parser.add_argument('--baseline', default=BASELINE_FILE, type=pathlib.Path,
+                        help='Baseline results to compare against (or to save with --save-baseline).')
+    parser.add_argument('--save-baseline', default=False, action='store_true',
+                        help='Save results as the new baseline rather than comparing against it.')
+    parser.add_argument('--tolerance', default=0.25, type=float,
+                        help='Allowed fractional decrease in throughput/increase in peak memory.')
+    parser.add_argument('--output', default=None, type=pathlib.Path, help='Write results to this JSON file.')
+    parser.add_argument('--workers', default=1, type=int)
+    parser.add_argument('--chunk-size', dest='chunksize', default=None, type=int)
+    parser.add_argument('--prefilter', default=False, action='store_true')
+    args = parser.parse_args()
+
+    results = run_benchmarks(
+        args.scales, dict(workers=args.workers, chunksize=args.chunksize, prefilter=args.prefilter)
+    )
+    if args.output:
+        with open(args.output, 'w') as out:
+            json.dump(results, out, indent=2)
+    if args.save_baseline:
+        baseline = json.loads(args.baseline.read_text()) if args.baseline.exists() else {}
+        baseline.update(results)
+        args.baseline.write_text(json.dumps(baseline, indent=2))
+        logger.info(f'Saved baseline to {args.baseline}.')
+        return 0
+    if not args.baseline.exists():
+        logger.warning(f'No baseline found at {args.baseline}: run with --save-baseline to create one.')
+        return 0
+    regressions = compare_to_baseline(results, json.loads(args.baseline.read_text()), args.tolerance)
+    for regression in regressions:
+        logger.error(f'Regression: {regression}')
+    if not regressions:
+        logger.info('No regressions compared to baseline.')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,64 +1,128 @@
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+
+import numpy as np
 import pandas as pd
 from bratdb.funcs.apply import apply_regex_to_df
+from loguru import logger
+
+from mhnav_pipeline.build_datasets import fan_out_results
+from mhnav_pipeline.concept_terms import convert_terms
+from mhnav_pipeline.metrics import measure
+
+
+def partition_by_patient(df, n_partitions):
+    """
+    Assign each record to one of `n_partitions` so that all records for a `studyid` share a partition
+        and the total amount of text in each partition is roughly equal.
+
+    :return: array of partition numbers aligned with `df`
+    """
+    patient_codes, _ = pd.factorize(df['studyid'])
+    patient_sizes = np.bincount(patient_codes, weights=df['note_text'].str.len().fillna(0).to_numpy())
+    loads = np.zeros(n_partitions)
+    patient_partitions = np.zeros(patient_sizes.shape[0], dtype=int)
+    for patient in np.argsort(-patient_sizes, kind='stable'):  # largest first into least-loaded partition
+        partition = loads.argmin()
+        patient_partitions[patient] = partition
+        loads[partition] += patient_sizes[patient]
+    return patient_partitions[patient_codes]
+
+
+def _apply_regex_to_partition(regex_file, df, include_context):
+    """Run in worker process: the regex file is compiled once for the entire partition."""
+    return list(apply_regex_to_df(regex_file, df, include_context=include_context))
+
+
+def apply_regex(df, regex_file, include_context=0, workers=1, pool=None):
+    """
+    Run bratdb-apply on `df`, optionally splitting the records by `studyid` across a pool of `workers` processes.
+
+    Results are returned in the same order as the serial path: by record, then in the order yielded by bratdb.
+
+    :param pool: (optional) ProcessPoolExecutor with `workers` processes to reuse (and leave running);
+        otherwise, a pool is created for this call
+
+    :return: list of (id, concept, term, capture) [+ (precontext, postcontext) if include_context]
+    """
+    if workers <= 1 or df.shape[0] <= 1:
+        return list(apply_regex_to_df(regex_file, df, include_context=include_context))
+    workers = min(workers, df['studyid'].nunique())
+    partitions = partition_by_patient(df, workers)
+    text_df = df[['note_text']].set_axis(np.arange(df.shape[0]))  # index by position; labels may not be unique
+    logger.info(f'Running bratdb-apply on {df.shape[0]} records across {workers} processes.')
+    with nullcontext(pool) if pool is not None else ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(_apply_regex_to_partition, regex_file, text_df[partitions == i], include_context)
+            for i in range(workers)
+        ]
+        results = [result for future in futures for result in future.result()]
+    # restore serial order (stable sort retains bratdb's order within each record)
+    positions = np.fromiter((result[0] for result in results), dtype=np.int64, count=len(results))
+    labels = df.index.to_numpy()
+    return [(labels[result[0]],) + tuple(result[1:]) for result in
+            (results[i] for i in np.argsort(positions, kind='stable'))]
+
+
+def apply_prefilter(df, prefilter):
+    """Limit `df` to notes which are candidates for matching a regular expression."""
+    mask = prefilter.candidate_mask(df['note_text'])
+    logger.info(f'Prefilter skipped {df.shape[0] - mask.sum()} of {df.shape[0]} notes'
+                f' which cannot match any regular expression.')
+    return df[mask]
+
 
+def apply_regex_and_merge(df, regex_file, include_context=0, workers=1, concept_term_rules=None, prefilter=None,
+                          cache_lookup=None, note_df=None, note_index=None, metrics=None, label='regex',
+                          context_sink=None, pool=None):
+    """
+    Run bratdb-apply and merge results with `df`.
 
-def contains(lst, s):
-    for el in lst:
-        if el in s:
-            return True
-
-
-def convert_terms(df):
-    res = []
-    for r in df.itertuples():
-        d = r._asdict()
-        if r.concept in {'BEHAV_SYMPT', 'ENV_STRESS', 'MH_REFERRAL'}:
-            d['concept_term'] = r.concept
-            res.append(d)
-        if 'depres' in r.term:
-            d['concept_term'] = 'depression'
-            res.append(d)
-        if contains(['academ', 'grade', 'school'], r.term):
-            d['concept_term'] = 'academic'
-            res.append(d)
-        if contains(['add', 'adhd', 'attention'], r.term):
-            d['concept_term'] = 'adhd'
-            res.append(d)
-        if 'anger' in r.term:
-            d['concept_term'] = 'anger'
-            res.append(d)
-        if 'anx' in r.term:
-            d['concept_term'] = 'anxiety'
-            res.append(d)
-        if 'bully' in r.term:
-            d['concept_term'] = 'bully'
-            res.append(d)
-        if contains(['defia', 'oppositional'], r.term):
-            d['concept_term'] = 'defiant'
-            res.append(d)
-        if contains(['drug', 'substance'], r.term):
-            d['concept_term'] = 'drug'
-            res.append(d)
-        if 'meds' in r.term:
-            d['concept_term'] = 'meds'
-            res.append(d)
-        if 'suic' in r.term:
-            d['concept_term'] = 'suicide'
-            res.append(d)
-    return pd.DataFrame(res)
-
-
-def apply_regex_and_merge(df, regex_file, include_context=0):
-    if include_context:
-        results_df = pd.DataFrame(
-            apply_regex_to_df(regex_file, df, include_context=include_context),
-            columns=['id', 'concept', 'term', 'capture', 'precontext', 'postcontext']
-        )
-    else:
-        results_df = pd.DataFrame(
-            apply_regex_to_df(regex_file, df, include_context=include_context),
-            columns=['id', 'concept', 'term', 'capture']
-        )
-    res_df = pd.merge(df, results_df, left_index=True, right_on='id', how='inner')
-    ct_df = convert_terms(res_df)
-    return res_df.drop_duplicates(), ct_df.drop_duplicates()
+    :param cache_lookup: (optional) CacheLookup for the notes to run (`df` or `note_df`)
+    :param note_df: (optional) distinct notes in `df` (see `deduplicate_notes`); if supplied, bratdb-apply
+        is only run on these, and the results are copied to each record in `df` using `note_index`
+    :param note_index: position in `note_df` for each record in `df`
+    :param metrics: (optional) StageMetrics to record the `{label}_prefilter`, `{label}_bratdb_apply`,
+        and `{label}_merge` stages
+    :param context_sink: (optional) ContextSink to which hits with context are written (as index data if
+        `label` is 'index') rather than retaining context and `note_text` in the results
+    :param pool: (optional) ProcessPoolExecutor to reuse for bratdb-apply (see `apply_regex`)
+    :return: res_df, ct_df; `note_text` is only retained (for nlp_regex) if `include_context` (and not `context_sink`)
+    """
+    regex_df = df if note_df is None else note_df
+    candidate_df = regex_df if cache_lookup is None else regex_df[~cache_lookup.found]
+    if prefilter:
+        with measure(metrics, f'{label}_prefilter', rows_in=candidate_df.shape[0]) as stage:
+            candidate_df = apply_prefilter(candidate_df, prefilter)
+            stage.rows_out = candidate_df.shape[0]
+    with measure(metrics, f'{label}_bratdb_apply', rows_in=candidate_df.shape[0]) as stage:
+        if include_context:
+            results_df = pd.DataFrame(
+                apply_regex(candidate_df, regex_file, include_context=include_context, workers=workers, pool=pool),
+                columns=['id', 'concept', 'term', 'capture', 'precontext', 'postcontext']
+            )
+        else:
+            results_df = pd.DataFrame(
+                apply_regex(candidate_df, regex_file, include_context=include_context, workers=workers, pool=pool),
+                columns=['id', 'concept', 'term', 'capture']
+            )
+        stage.rows_out = results_df.shape[0]
+    with measure(metrics, f'{label}_merge', rows_in=results_df.shape[0]) as stage:
+        if cache_lookup is not None:
+            results_df = cache_lookup.merge_and_store(regex_df, results_df)
+        if context_sink is not None:  # before fanning out so that context is not copied to each record
+            results_df, contexts = context_sink.encode(results_df)
+        if note_df is not None:
+            results_df = fan_out_results(results_df, df, note_df, note_index)
+        # concepts/terms are repeated across many hits
+        results_df = results_df.astype({'concept': 'category', 'term': 'category'})
+        # full text is only needed for debugging output
+        metadata_df = df if include_context and context_sink is None else df.drop(columns='note_text')
+        res_df = pd.merge(metadata_df, results_df, left_index=True, right_on='id', how='inner')
+        ct_df = convert_terms(res_df, concept_term_rules)
+        res_df, ct_df = res_df.drop_duplicates(), ct_df.drop_duplicates()
+        stage.rows_out = ct_df.shape[0]
+    if context_sink is not None:
+        with measure(metrics, f'{label}_write_context', rows_in=ct_df.shape[0]):
+            context_sink.write(ct_df, contexts, is_index=label == 'index')
+    return res_df, ct_df
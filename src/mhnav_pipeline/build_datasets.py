@@ -1,3 +1,4 @@
+import numpy as np
 import pandas as pd
 from loguru import logger
 
@@ -26,6 +27,23 @@ def attach_results_to_correct_encounter(ds1, ds2, on='studyid', skip_date_filter
         ]
 
 
+def order_like_merge(hits_df, df, on):
+    """
+    Stable-sort hits (where `id` is the index of the record in `df`) into the order produced by merging
+        `df` with the hits on the columns `on`: by the first record in `df` with the same values.
+    """
+    groups = df.groupby(on, sort=False, dropna=False).ngroup()
+    order = groups.loc[hits_df['id']].to_numpy()
+    return hits_df.iloc[np.argsort(order, kind='stable')]
+
+
+def categories_to_values(df):
+    """Convert categorical columns (used for concept, term, and concept_term) back to the dtype of their values."""
+    return df.astype({
+        col: df[col].cat.categories.dtype for col in df.columns if isinstance(df[col].dtype, pd.CategoricalDtype)
+    })
+
+
 def build_nlp_positive_table(historical_res_df2, historical_lmt_df):
     nlp_positive = historical_res_df2.groupby(['studyid', 'index_pat_enc_csn_id'])['note_date'].nunique().reset_index()
     nlp_positive = pd.merge(nlp_positive,
@@ -47,7 +65,7 @@ def build_nlp_model_table(historical_ct_df2):
     nlp_model = historical_ct_df2[
         historical_ct_df2['concept_term'].notnull()
     ][['index_pat_enc_csn_id', 'note_date', 'concept_term']]
-    nlp_model = nlp_model.drop_duplicates()
+    nlp_model = categories_to_values(nlp_model.drop_duplicates())
     nlp_model.columns = ['index_pat_enc_csn_id', 'note_date', 'concept_term']
     logger.info('Data on nlp_model table:')
     logger.info(f' * Number of records: {nlp_model.shape[0]}')
@@ -60,7 +78,7 @@ def build_nlp_index_table(index_ct_df2):
         index_ct_df2['concept_term'].notnull()
     ][['pat_enc_csn_id', 'note_date', 'concept_term', 'capture']]
     nlp_index.columns = ['pat_enc_csn_id', 'note_date', 'concept_term', 'text_string']
-    nlp_index = nlp_index.drop_duplicates()
+    nlp_index = categories_to_values(nlp_index.drop_duplicates())
     logger.info('Data on nlp_index table:')
     logger.info(f' * Number of records: {nlp_index.shape[0]}')
     logger.info(f' * Number of unique pat_enc_csn_ids: {nlp_index.pat_enc_csn_id.nunique()}')
@@ -71,7 +89,138 @@ def build_nlp_regex_table(index_ct_df, historical_ct_df):
     """Build debugging output showing the hits of each regular expression with context."""
     index_ct_df['is_index'] = 1
     historical_ct_df['is_index'] = 0
-    nlp_regex = pd.concat((index_ct_df, historical_ct_df))
+    nlp_regex = pd.concat((categories_to_values(index_ct_df), categories_to_values(historical_ct_df)))
     logger.info('Data on nlp_regex table:')
     logger.info(f' * Number of records: {nlp_regex.shape[0]}')
     return nlp_regex
+
+
+def partial_nlp_positive(historical_res_df2, historical_lmt_df):
+    """Reduce a chunk to the records needed to build nlp_positive (see `combine_partials`)."""
+    return (
+        historical_res_df2[['studyid', 'index_pat_enc_csn_id', 'note_date']].drop_duplicates(),
+        historical_lmt_df[['index_pat_enc_csn_id']].drop_duplicates(),
+    )
+
+
+def partial_nlp_model(historical_ct_df2):
+    """Reduce a chunk to the records needed to build nlp_model (see `combine_partials`)."""
+    return categories_to_values(historical_ct_df2[
+        historical_ct_df2['concept_term'].notnull()
+    ][['index_pat_enc_csn_id', 'note_date', 'concept_term']].drop_duplicates())
+
+
+def partial_nlp_index(index_ct_df2):
+    """Reduce a chunk to the records needed to build nlp_index (see `combine_partials`)."""
+    return categories_to_values(index_ct_df2[
+        index_ct_df2['concept_term'].notnull()
+    ][['pat_enc_csn_id', 'note_date', 'concept_term', 'capture']].drop_duplicates())
+
+
+def partial_nlp_regex(ct_df):
+    """Prepare a chunk's hits for nlp_regex (categories differ between chunks, so cannot be concatenated)."""
+    return categories_to_values(ct_df)
+
+
+def combine_regex_parts(parts, columns):
+    """Combine chunks' hits for nlp_regex (see `partial_nlp_regex`); empty dataframe with `columns` if no hits."""
+    parts = [part for part in parts if part.shape[0] > 0]  # chunks without hits lack the dtypes of the values
+    if not parts:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(parts)
+
+
+def combine_partials(partials, columns):
+    """Combine reduced chunks into a single dataframe which can be passed to the `build_nlp_*` functions."""
+    partials = [partial for partial in partials if partial.shape[0] > 0]
+    if not partials:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(partials, ignore_index=True).drop_duplicates()
+
+
+def deduplicate_notes(historical_df):
+    """
+    Historical notes are repeated for each index encounter whose window contains them. Identify each
+        distinct note by studyid, pat_enc_csn_id, note_date and a hash of note_text.
+
+    :return: note_df (the first record for each distinct note), note_index (position in note_df for each record)
+    """
+    keys = historical_df[['studyid', 'pat_enc_csn_id', 'note_date']].assign(
+        text_hash=pd.util.hash_pandas_object(historical_df['note_text'], index=False).to_numpy()
+    )
+    note_index = keys.groupby(list(keys.columns), sort=False, dropna=False).ngroup().to_numpy()
+    note_df = historical_df.loc[~keys.duplicated().to_numpy(), ['studyid', 'pat_enc_csn_id', 'note_date', 'note_text']]
+    logger.info(f'Deduplicated {historical_df.shape[0]} historical records to {note_df.shape[0]} distinct notes.')
+    return note_df, note_index
+
+
+def fan_out_results(results_df, df, note_df, note_index):
+    """
+    Copy the bratdb-apply results for each distinct note (`results_df['id']` refers to `note_df`) to each
+        record in `df` which contains that note, in the order they would have had if run on `df` directly.
+    """
+    note_positions = pd.Series(np.arange(note_df.shape[0]), index=note_df.index)
+    results_df = results_df.assign(
+        note_position=note_positions.loc[results_df['id']].to_numpy(),
+        seq=np.arange(results_df.shape[0]),
+    ).drop(columns='id')
+    records = pd.DataFrame({'id': df.index, 'note_position': note_index, 'position': np.arange(df.shape[0])})
+    fanned = pd.merge(records, results_df, on='note_position')
+    fanned = fanned.sort_values(['position', 'seq'], kind='stable')
+    return fanned.drop(columns=['note_position', 'position', 'seq']).reset_index(drop=True)
+
+
+def _to_days(dates):
+    """Dates (strings or datetimes) as integer days, and a mask of those which are not null."""
+    days = pd.to_datetime(pd.Series(dates)).to_numpy().astype('datetime64[D]')
+    notnull = ~np.isnat(days)
+    return np.where(notnull, days.astype(np.int64), 0), notnull
+
+
+def assign_notes_to_windows(notes_df, encounters_df):
+    """
+    Build historical records from a table of distinct notes by assigning each note to the window (start_date
+        to end_date, inclusive) of every index encounter of the same patient which contains it.
+
+    Rather than merging each patient's notes with each of their encounters and then filtering on dates,
+        notes are sorted by patient and date once, and each window is found with a binary search, so
+        only the records in a window are ever created.
+
+    :param notes_df: notes with columns: studyid, pat_enc_csn_id, note_date, (note_text)
+    :param encounters_df: index encounters with columns: studyid, pat_enc_csn_id, start_date, end_date
+    :return: historical_df (without note_text) ordered by encounter (in the order of `encounters_df`),
+        then note_date; note_index (position in `notes_df` of each record's note)
+    """
+    patients = pd.Index(pd.unique(notes_df['studyid']))
+    note_patients = patients.get_indexer(notes_df['studyid'])
+    enc_patients = patients.get_indexer(encounters_df['studyid'])
+    note_days, note_valid = _to_days(notes_df['note_date'])
+    start_days, start_valid = _to_days(encounters_df['start_date'])
+    end_days, end_valid = _to_days(encounters_df['end_date'])
+
+    # sort key: patient, then (offset) day, so that each window is a contiguous range of sorted notes
+    all_days = np.concatenate((note_days, start_days, end_days))
+    first_day = all_days.min() if all_days.shape[0] else 0
+    n_days = (all_days.max() - first_day + 1) if all_days.shape[0] else 1
+    note_keys = np.where(note_valid, note_patients * n_days + (note_days - first_day), -1)
+    order = np.argsort(note_keys, kind='stable')
+    sorted_keys = note_keys[order]
+    lo = np.searchsorted(sorted_keys, enc_patients * n_days + (start_days - first_day), side='left')
+    hi = np.searchsorted(sorted_keys, enc_patients * n_days + (end_days - first_day), side='right')
+    counts = np.where((enc_patients >= 0) & start_valid & end_valid, np.maximum(hi - lo, 0), 0)
+
+    # expand each window into its records
+    enc_index = np.repeat(np.arange(encounters_df.shape[0]), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    note_index = order[np.repeat(lo, counts) + offsets]
+    historical_df = pd.DataFrame({
+        'studyid': notes_df['studyid'].to_numpy()[note_index],
+        'index_pat_enc_csn_id': encounters_df['pat_enc_csn_id'].to_numpy()[enc_index],
+        'pat_enc_csn_id': notes_df['pat_enc_csn_id'].to_numpy()[note_index],
+        'note_date': notes_df['note_date'].to_numpy()[note_index],
+        'start_date': encounters_df['start_date'].to_numpy()[enc_index],
+        'end_date': encounters_df['end_date'].to_numpy()[enc_index],
+    })
+    logger.info(f'Assigned {notes_df.shape[0]} notes to {historical_df.shape[0]} records in the windows'
+                f' of {encounters_df.shape[0]} index encounters.')
+    return historical_df, note_index
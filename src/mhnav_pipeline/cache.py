@@ -0,0 +1,206 @@
+"""
+Persistent cache of bratdb-apply results for individual notes.
+
+Notes are keyed by a hash of their (uncleaned) text, keyed by a hash of the regex file, the cleaning
+    code, and the amount of context requested. Since cached notes need neither cleaning nor
+    bratdb-apply, a rerun over overlapping data only needs to process new or changed notes (though
+    all notes are cleaned when their text is output in nlp_regex; see `main.clean_notes`).
+
+The cache is a SQLite database in `cache_dir`. When the stored results exceed `max_size_mb`, the
+    least recently used notes are evicted.
+"""
+import hashlib
+import pathlib
+import sqlite3
+import time
+
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+RESULT_COLUMNS = ['concept', 'term', 'capture', 'precontext', 'postcontext']
+# approximate storage overhead of each note/hit record
+_NOTE_OVERHEAD = 64
+_HIT_OVERHEAD = 32
+
+
+def _hash_files(paths):
+    h = hashlib.blake2b(digest_size=32)
+    for path in paths:
+        with open(path, 'rb') as fh:
+            h.update(fh.read())
+    return h
+
+
+class RegexResultCache:
+
+    def __init__(self, cache_dir, regex_file, cleaning_files=(), include_context=0, max_size_mb=1024):
+        """
+        :param cache_dir: directory in which to keep the cache database
+        :param regex_file: regex file used by bratdb-apply
+        :param cleaning_files: source/configuration files which determine how text is cleaned
+        :param include_context: amount of context requested from bratdb-apply
+        :param max_size_mb: evict least recently used notes once cached results exceed this size
+        """
+        self.path = pathlib.Path(cache_dir) / 'regex_results.sqlite'
+        self.path.parent.mkdir(exist_ok=True, parents=True)
+        version = _hash_files([regex_file, *cleaning_files])
+        version.update(f'include_context={include_context}'.encode('utf8'))
+        self.version = version.digest()
+        self.include_context = include_context
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.conn = sqlite3.connect(self.path)
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS notes (key TEXT PRIMARY KEY, size INTEGER, last_used REAL);
+            CREATE TABLE IF NOT EXISTS hits (
+                key TEXT, seq INTEGER, concept TEXT, term TEXT, capture TEXT, precontext TEXT, postcontext TEXT
+            );
+            CREATE INDEX IF NOT EXISTS hits_key ON hits (key);
+            CREATE INDEX IF NOT EXISTS notes_last_used ON notes (last_used);
+        ''')
+        self.size = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM notes').fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        logger.info(f'Using regex result cache {self.path} ({self.size / 1024 / 1024:.1f}MB).')
+
+    def note_keys(self, texts):
+        """Key for each (uncleaned) note text."""
+        return pd.Series(
+            [
+                hashlib.blake2b(text.encode('utf8') if isinstance(text, str) else b'',
+                                digest_size=16, key=self.version).hexdigest()
+                for text in texts
+            ],
+            index=texts.index,
+        )
+
+    def lookup(self, texts):
+        """
+        Find cached results for each (uncleaned) note text.
+
+        :return: CacheLookup
+        """
+        keys = self.note_keys(texts)
+        with self.conn:
+            self.conn.execute('CREATE TEMP TABLE IF NOT EXISTS lookup (key TEXT PRIMARY KEY)')
+            self.conn.execute('DELETE FROM lookup')
+            self.conn.executemany('INSERT OR IGNORE INTO lookup VALUES (?)', ((key,) for key in keys))
+            found_keys = {key for key, in self.conn.execute(
+                'SELECT n.key FROM notes n JOIN lookup l ON n.key = l.key'
+            )}
+            hits = pd.read_sql(
+                f'SELECT h.key, h.seq, {", ".join(f"h.{col}" for col in RESULT_COLUMNS)}'
+                f' FROM hits h JOIN lookup l ON h.key = l.key',
+                con=self.conn,
+            )
+            self.conn.execute('UPDATE notes SET last_used = ? WHERE key IN (SELECT key FROM lookup)', (time.time(),))
+        found = keys.isin(found_keys).to_numpy()
+        self.hits += int(found.sum())
+        self.misses += int((~found).sum())
+        return CacheLookup(self, keys, found, hits)
+
+    def store(self, keys, results_df):
+        """
+        Store results for notes which have been run through bratdb-apply.
+
+        :param keys: note key for each record index (id) which was processed
+        :param results_df: bratdb-apply results with columns: id, seq, *RESULT_COLUMNS
+        """
+        keys = keys[~keys.duplicated()]
+        results_df = results_df[results_df['id'].isin(keys.index)]
+        hits = pd.DataFrame({
+            'key': keys.loc[results_df['id']].to_numpy(),
+            'seq': results_df['seq'].to_numpy(),
+            **{col: results_df[col].to_numpy() if col in results_df.columns else None for col in RESULT_COLUMNS},
+        })
+        hit_sizes = pd.Series(
+            sum(hits[col].fillna('').astype(str).str.len().to_numpy(dtype=np.int64) for col in RESULT_COLUMNS),
+            index=hits.index,
+        )
+        note_sizes = (hit_sizes + _HIT_OVERHEAD).groupby(hits['key']).sum()
+        note_sizes = note_sizes.reindex(keys.to_numpy(), fill_value=0) + _NOTE_OVERHEAD
+        now = time.time()
+        with self.conn:
+            self.conn.executemany('DELETE FROM hits WHERE key = ?', ((key,) for key in keys))
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO notes VALUES (?, ?, ?)',
+                ((key, int(size), now) for key, size in note_sizes.items()),
+            )
+            self.conn.executemany(
+                f'INSERT INTO hits VALUES ({", ".join("?" * (2 + len(RESULT_COLUMNS)))})',
+                hits.astype(object).where(hits.notnull(), None).itertuples(index=False, name=None),
+            )
+        self.size += int(note_sizes.sum())
+        if self.size > self.max_size:
+            self.evict()
+
+    def evict(self):
+        """Remove least recently used notes until the cache is within 90% of maximum size."""
+        target = self.size - int(self.max_size * 0.9)
+        removed, n_notes = 0, 0
+        with self.conn:
+            for key, size in self.conn.execute('SELECT key, size FROM notes ORDER BY last_used').fetchall():
+                if removed >= target:
+                    break
+                self.conn.execute('DELETE FROM notes WHERE key = ?', (key,))
+                self.conn.execute('DELETE FROM hits WHERE key = ?', (key,))
+                removed += size
+                n_notes += 1
+        self.size -= removed
+        self.evicted += n_notes
+        logger.info(f'Evicted {n_notes} notes ({removed / 1024 / 1024:.1f}MB) from regex result cache.')
+
+    def log_statistics(self):
+        total = self.hits + self.misses
+        logger.info(f'Regex result cache: {self.hits} hits, {self.misses} misses'
+                    f' ({self.hits / total if total else 0:.1%} hit rate); {self.evicted} evicted;'
+                    f' size: {self.size / 1024 / 1024:.1f}MB.')
+
+    def close(self):
+        self.conn.close()
+
+
+class CacheLookup:
+    """Cached results for the notes in a dataframe."""
+
+    def __init__(self, cache, keys, found, hits):
+        """
+        :param cache: RegexResultCache
+        :param keys: note key for each record, aligned with dataframe
+        :param found: boolean array which is True for records with cached results
+        :param hits: cached results with columns: key, seq, *RESULT_COLUMNS
+        """
+        self.cache = cache
+        self.keys = keys
+        self.found = found
+        self.hits = hits
+
+    def merge_and_store(self, df, results_df):
+        """
+        Store the results of running bratdb-apply on the records which were not found in the cache, and
+            combine them with the cached results in the order bratdb-apply would have produced them.
+
+        :param df: dataframe the lookup was performed for
+        :param results_df: results for records which were not found in cache
+        """
+        columns = list(results_df.columns)
+        results_df = results_df.assign(seq=results_df.groupby('id').cumcount())
+        self.cache.store(self.keys[~self.found], results_df)
+        positions = pd.Series(np.arange(df.shape[0]), index=df.index)
+        positions = positions[~positions.index.duplicated()]
+        results_df['position'] = positions.loc[results_df['id']].to_numpy()
+        cached_df = pd.merge(
+            pd.DataFrame({
+                'id': df.index[self.found],
+                'key': self.keys[self.found].to_numpy(),
+                'position': np.arange(df.shape[0])[self.found],
+            }),
+            self.hits, on='key',
+        )
+        if cached_df.shape[0] == 0:
+            return results_df[columns]
+        combined = pd.concat((results_df, cached_df[results_df.columns]), ignore_index=True)
+        combined = combined.sort_values(['position', 'seq'], kind='stable')
+        # infer dtypes as if results had been built directly from bratdb-apply output
+        return combined[columns].reset_index(drop=True).infer_objects()
@@ -0,0 +1,130 @@
+"""
+Rule-based text cleaning as an alternative to `local/cleaning.py`.
+
+Rules are loaded from a tab-separated file with one rule per line (lines starting with '#' are ignored):
+    * `exclude<TAB>phrase`: exclude the entire note if the phrase is found in its first 100 characters
+    * `replace<TAB>pattern`: replace matches of the regular expression with a space (spaces in the pattern
+        match any non-word characters, as in `local/cleaning_template.replace`)
+
+All rules are compiled once. Replacement patterns are combined into a single regular expression
+    which is applied in one pass, so (unlike applying them one after another) text produced by one
+    replacement is not seen by another. Since each pattern becomes a group of the combined expression,
+    numbered backreferences (`\\1`, `(?(1)...)`) would refer to the wrong group and are rejected; use
+    named groups (`(?P<name>...)` with `(?P=name)`) instead, with names distinct across rules.
+
+Statistics (number of notes affected by each rule) are returned by each call rather than kept in a
+    global, so they can be merged (e.g., `stats1 + stats2`) across chunks or processes.
+"""
+import re
+from collections import Counter
+
+import pandas as pd
+from loguru import logger
+
+# number of characters at the start of a note searched for exclusion phrases
+EXCLUSION_WINDOW = 100
+# numbered backreference (`\1`) or conditional (`(?(1)...)`), not preceded by an escaped backslash
+NUMBERED_REFERENCE_REGEX = re.compile(r'(?<!\\)(?:\\\\)*(?:\\[1-9]|\(\?\(\d)')
+
+
+def _to_regex(pattern):
+    return pattern.replace(' ', r'\W+')
+
+
+def _combine_replacements(replacements):
+    """Combine replacement patterns into one regular expression with a named group (`_r{i}`) for each."""
+    for pattern in replacements:
+        if NUMBERED_REFERENCE_REGEX.search(pattern):
+            e = ValueError(f'Numbered backreferences are not supported in replacement rules (use named groups,'
+                           f' e.g., `(?P<name>...)` and `(?P=name)`): {pattern!r}')
+            logger.exception(e)
+            raise e
+    try:
+        return re.compile(
+            '|'.join(f'(?P<_r{i}>{_to_regex(pattern)})' for i, pattern in enumerate(replacements)), re.I
+        )
+    except re.error as err:
+        e = ValueError(f'Invalid replacement rules (group names must be distinct across rules): {err}')
+        logger.exception(e)
+        raise e from err
+
+
+class CleaningRuleSet:
+
+    def __init__(self, exclusions=(), replacements=()):
+        """
+        :param exclusions: phrases which, if found in the first 100 characters, exclude the entire note
+        :param replacements: regular expressions to replace with a space
+        """
+        self.exclusions = [phrase.lower() for phrase in exclusions]
+        self.replacements = list(replacements)
+        self._exclusion_regex = re.compile(
+            '|'.join(re.escape(phrase) for phrase in self.exclusions)
+        ) if self.exclusions else None
+        self._replacement_regex = _combine_replacements(self.replacements) if self.replacements else None
+
+    @classmethod
+    def from_file(cls, path):
+        exclusions, replacements = [], []
+        with open(path, encoding='utf8') as fh:
+            for i, line in enumerate(fh, start=1):
+                if not line.strip() or line.startswith('#'):
+                    continue
+                rule_type, _, value = line.rstrip('\r\n').partition('\t')
+                if rule_type == 'exclude':
+                    exclusions.append(value)
+                elif rule_type == 'replace':
+                    replacements.append(value)
+                else:
+                    e = ValueError(f'Unrecognized cleaning rule on line {i} of {path}: {line!r}')
+                    logger.exception(e)
+                    raise e
+        logger.info(f'Loaded {len(exclusions)} exclusion and {len(replacements)} replacement rules from {path}.')
+        return cls(exclusions, replacements)
+
+    def should_be_excluded(self, text, stats=None):
+        if self._exclusion_regex is None:
+            return False
+        start_text = text[:EXCLUSION_WINDOW].lower()
+        if not self._exclusion_regex.search(start_text):
+            return False
+        if stats is not None:
+            stats[next(phrase for phrase in self.exclusions if phrase in start_text)] += 1
+        return True
+
+    def clean_text(self, text, stats=None):
+        """
+        Remove boilerplate, etc.
+
+        :param stats: (optional) Counter to which the number of notes affected by each rule is added
+        """
+        if pd.isnull(text):
+            return ''
+        if self.should_be_excluded(text, stats):
+            return ''
+        text = '  '.join(text.split('\n'))
+        if self._replacement_regex is None:
+            return text
+        if stats is None:
+            return self._replacement_regex.sub(' ', text)
+        matched = set()
+
+        def _replace(m):
+            matched.add(m.lastgroup)
+            return ' '
+        text = self._replacement_regex.sub(_replace, text)
+        for group in matched:
+            stats[self.replacements[int(group[2:])]] += 1
+        return text
+
+    def __call__(self, text):
+        return self.clean_text(text)
+
+    def clean_series(self, texts):
+        """
+        Clean each text in a Series.
+
+        :return: cleaned Series, Counter of notes affected by each rule
+        """
+        stats = Counter()
+        return pd.Series([self.clean_text(text, stats) for text in texts], index=texts.index), stats
@@ -0,0 +1,101 @@
+"""
+Mapping of bratdb concept/term hits to the concept_terms used by the Mental Health Navigator model.
+
+The mapping is defined by an ordered list of rules, each of which is a tuple of (field, value, concept_term):
+    * field='concept': exact match of the concept; if concept_term is empty, the concept itself is used
+    * field='term': substring match within the term
+
+Rules can be loaded from a tab-separated file with the same three columns (lines starting with '#' are ignored).
+"""
+import pathlib
+
+import pandas as pd
+from loguru import logger
+
+DEFAULT_CONCEPT_TERM_RULES = (
+    ('concept', 'BEHAV_SYMPT', ''),
+    ('concept', 'ENV_STRESS', ''),
+    ('concept', 'MH_REFERRAL', ''),
+    ('term', 'depres', 'depression'),
+    ('term', 'academ', 'academic'),
+    ('term', 'grade', 'academic'),
+    ('term', 'school', 'academic'),
+    ('term', 'add', 'adhd'),
+    ('term', 'adhd', 'adhd'),
+    ('term', 'attention', 'adhd'),
+    ('term', 'anger', 'anger'),
+    ('term', 'anx', 'anxiety'),
+    ('term', 'bully', 'bully'),
+    ('term', 'defia', 'defiant'),
+    ('term', 'oppositional', 'defiant'),
+    ('term', 'drug', 'drug'),
+    ('term', 'substance', 'drug'),
+    ('term', 'meds', 'meds'),
+    ('term', 'suic', 'suicide'),
+)
+
+
+def load_concept_term_rules(path):
+    """Load concept_term rules from a tab-separated file of: field, value, concept_term"""
+    rules = []
+    with open(path, encoding='utf8') as fh:
+        for i, line in enumerate(fh, start=1):
+            if not line.strip() or line.startswith('#'):
+                continue
+            field, value, *concept_term = line.rstrip('\r\n').split('\t')
+            if field not in {'concept', 'term'} or len(concept_term) > 1:
+                e = ValueError(f'Unrecognized concept_term rule on line {i} of {path}: {line!r}')
+                logger.exception(e)
+                raise e
+            rules.append((field, value, concept_term[0] if concept_term else ''))
+    logger.info(f'Loaded {len(rules)} concept_term rules from {path}.')
+    return tuple(rules)
+
+
+def get_concept_term_rules(rules=None):
+    """Resolve rules from None (use defaults), a path to a rules file, or an iterable of rules."""
+    if rules is None:
+        return DEFAULT_CONCEPT_TERM_RULES
+    elif isinstance(rules, (str, pathlib.Path)):
+        return load_concept_term_rules(rules)
+    return tuple(rules)
+
+
+def get_concept_terms(concept, term, rules=DEFAULT_CONCEPT_TERM_RULES):
+    """List the (distinct) concept_terms for a single concept/term in the order of the rules."""
+    concept_terms = []
+    for field, value, concept_term in rules:
+        if field == 'concept':
+            if concept != value:
+                continue
+            concept_term = concept_term or concept
+        elif value not in term:
+            continue
+        if concept_term not in concept_terms:
+            concept_terms.append(concept_term)
+    return concept_terms
+
+
+def build_concept_term_lookup(df, rules=DEFAULT_CONCEPT_TERM_RULES):
+    """Build table of concept, term, concept_term for each distinct concept/term in `df`."""
+    pairs = df[['concept', 'term']].drop_duplicates()
+    return pd.DataFrame(
+        [
+            (concept, term, concept_term)
+            for concept, term in zip(pairs['concept'], pairs['term'])
+            for concept_term in get_concept_terms(concept, term, rules)
+        ],
+        columns=['concept', 'term', 'concept_term'],
+    )
+
+
+def convert_terms(df, rules=None):
+    """
+    Add `concept_term` to each bratdb hit, producing one record for each concept_term the hit maps to.
+        Hits which do not map to any concept_term are dropped.
+    """
+    rules = get_concept_term_rules(rules)
+    lookup = build_concept_term_lookup(df, rules)
+    # match dtypes of `df` (e.g., categorical) so the join is on compatible keys
+    lookup = lookup.astype({'concept': df['concept'].dtype, 'term': df['term'].dtype, 'concept_term': 'category'})
+    return pd.merge(df, lookup, on=['concept', 'term'], how='inner')
@@ -0,0 +1,133 @@
+"""
+Streaming output of regular expression hits with context (nlp_regex) for debugging.
+
+Rather than retaining the hits (with the full note text) for every chunk and concatenating them into a
+    single nlp_regex table at the end, hits are written to a compressed file as each dataset (or chunk) is
+    processed (see `bratdb_utils.apply_regex_and_merge`):
+    * csv: gzip-compressed CSV (`.csv.gz`)
+    * parquet: zstd-compressed Parquet (`.parquet`; requires pyarrow), one row group per batch
+
+Each hit's context is stored once per distinct (precontext, postcontext) rather than copied to every record
+    sharing the note, and is only attached to the rows as they are written. Context is truncated to
+    `context_length` characters on either side of the capture. The note text is not included.
+
+Memory use is only bounded when the datasets are processed in chunks (`chunksize`): otherwise, the hits for
+    an entire dataset are collected from bratdb-apply before any are written.
+"""
+import gzip
+
+import pandas as pd
+from loguru import logger
+
+from mhnav_pipeline.build_datasets import categories_to_values
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+# index hits have index_pat_enc_csn_id = pat_enc_csn_id
+CONTEXT_COLUMNS = ['is_index', 'studyid', 'index_pat_enc_csn_id', 'pat_enc_csn_id', 'note_date',
+                   'concept', 'term', 'concept_term', 'capture', 'precontext', 'postcontext']
+CONTEXT_FORMATS = {'csv': '.csv.gz', 'parquet': '.parquet'}
+# number of rows to write at a time
+CONTEXT_BATCH_SIZE = 100_000
+
+
+class ContextSink:
+
+    def __init__(self, path, output_format='csv', context_length=None, batch_size=CONTEXT_BATCH_SIZE):
+        """
+        :param path: path without extension
+        :param output_format: one of `CONTEXT_FORMATS`; 'parquet' requires pyarrow
+        :param context_length: (optional) maximum number of characters of precontext/postcontext to retain
+        :param batch_size: number of rows to write at a time
+        """
+        if output_format not in CONTEXT_FORMATS:
+            e = ValueError(f'Unrecognized output format: {output_format}')
+            logger.exception(e)
+            raise e
+        if output_format == 'parquet' and pa is None:
+            e = ValueError('pyarrow is required to write nlp_regex to parquet: install with `pip install .[parquet]`')
+            logger.exception(e)
+            raise e
+        self.path = f'{path}{CONTEXT_FORMATS[output_format]}'
+        self.output_format = output_format
+        self.context_length = context_length
+        self.batch_size = batch_size
+        self.n_records = 0
+        self._fh = None  # gzip file (csv)
+        self._writer = None  # ParquetWriter (parquet)
+        logger.info(f'Streaming nlp_regex to {self.path}.')
+
+    def encode(self, results_df):
+        """
+        Replace the context of each hit with a code for its distinct (precontext, postcontext).
+
+        :param results_df: bratdb-apply results including precontext and postcontext
+        :return: results_df (with `context` rather than precontext/postcontext), contexts (truncated
+            precontext/postcontext for each code)
+        """
+        groups = results_df.groupby(['precontext', 'postcontext'], sort=False, dropna=False)
+        codes = groups.ngroup().to_numpy()
+        contexts = results_df.loc[
+            ~results_df.duplicated(['precontext', 'postcontext']).to_numpy(), ['precontext', 'postcontext']
+        ].reset_index(drop=True)  # in order of first appearance, as are the codes
+        if self.context_length:
+            contexts['precontext'] = contexts['precontext'].str[-self.context_length:]
+            contexts['postcontext'] = contexts['postcontext'].str[:self.context_length]
+        return results_df.drop(columns=['precontext', 'postcontext']).assign(context=codes), contexts
+
+    def write(self, ct_df, contexts, is_index):
+        """
+        Write hits with their context.
+
+        :param ct_df: hits with record metadata, `concept_term`, and `context` (see `encode`)
+        :param contexts: truncated precontext/postcontext for each code in `ct_df['context']`
+        :param is_index: True for index data, False for historical data
+        """
+        for start in range(0, ct_df.shape[0], self.batch_size):
+            batch = categories_to_values(ct_df.iloc[start:start + self.batch_size])
+            context = contexts.iloc[batch['context'].to_numpy()]
+            df = pd.DataFrame({
+                'is_index': int(is_index),
+                'studyid': batch['studyid'].to_numpy(),
+                'index_pat_enc_csn_id': batch['pat_enc_csn_id' if is_index else 'index_pat_enc_csn_id'].to_numpy(),
+                'pat_enc_csn_id': batch['pat_enc_csn_id'].to_numpy(),
+                'note_date': batch['note_date'].to_numpy(),
+                'concept': batch['concept'].to_numpy(),
+                'term': batch['term'].to_numpy(),
+                'concept_term': batch['concept_term'].to_numpy(),
+                'capture': batch['capture'].to_numpy(),
+                'precontext': context['precontext'].to_numpy(),
+                'postcontext': context['postcontext'].to_numpy(),
+            })
+            self._write_batch(df)
+
+    def _write_batch(self, df):
+        if self.output_format == 'csv':
+            if self._fh is None:
+                self._fh = gzip.open(self.path, 'wt', encoding='utf8', newline='')
+                df.to_csv(self._fh, index=False)
+            else:
+                df.to_csv(self._fh, index=False, header=False)
+        else:
+            if self._writer is None:
+                table = pa.Table.from_pandas(df, preserve_index=False)
+                self._writer = pq.ParquetWriter(self.path, table.schema, compression='zstd')
+            else:  # later batches must match the schema of the first
+                table = pa.Table.from_pandas(df, schema=self._writer.schema, preserve_index=False)
+            self._writer.write_table(table)
+        self.n_records += df.shape[0]
+
+    def close(self):
+        if self._fh is None and self._writer is None:  # no hits: write empty file
+            self._write_batch(pd.DataFrame(columns=CONTEXT_COLUMNS))
+        if self._fh is not None:
+            self._fh.close()
+        if self._writer is not None:
+            self._writer.close()
+        logger.info('Data on nlp_regex table:')
+        logger.info(f' * Number of records: {self.n_records}')
@@ -15,10 +15,15 @@ def reset_replacements():
     _REPLACEMENTS = Counter()
 
 
-def log_and_reset_replacements():
+def log_replacements(replacements):
+    """Log replacement counts (e.g., returned by `CleaningRuleSet.clean_series`)"""
     logger.info(f'Text cleaning: [replacement: count]')
-    for k, v in _REPLACEMENTS.items():
+    for k, v in replacements.items():
         logger.info(f'* {k}: {v}\n')
+
+
+def log_and_reset_replacements():
+    log_replacements(_REPLACEMENTS)
     reset_replacements()
 
 
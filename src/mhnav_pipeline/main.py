@@ -2,18 +2,38 @@
 
 """
 import datetime
+import inspect
 import pathlib
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
 
+import numpy as np
 import pandas as pd
 import sqlalchemy as sa
 from loguru import logger
 
 from mhnav_pipeline.bratdb_utils import apply_regex_and_merge
-from mhnav_pipeline.build_datasets import build_nlp_positive_table, build_nlp_model_table, build_nlp_index_table, \
-    attach_results_to_correct_encounter, remove_index_dates, build_nlp_regex_table
+from mhnav_pipeline.build_datasets import (
+    build_nlp_positive_table, build_nlp_model_table, build_nlp_index_table, remove_index_dates, build_nlp_regex_table,
+    partial_nlp_positive, partial_nlp_model, partial_nlp_index, partial_nlp_regex, combine_partials,
+    combine_regex_parts, deduplicate_notes, order_like_merge, assign_notes_to_windows,
+)
+from mhnav_pipeline.cache import RegexResultCache
+from mhnav_pipeline.cleaning_rules import CleaningRuleSet
+from mhnav_pipeline.concept_terms import get_concept_term_rules
+from mhnav_pipeline.context_sink import ContextSink
 from mhnav_pipeline.local.cleaning import clean_text
-from mhnav_pipeline.local.tracking import log_and_reset_replacements
-from mhnav_pipeline.read_data import read_dataset
+from mhnav_pipeline.local.tracking import log_replacements, get_and_reset_replacements
+from mhnav_pipeline.metrics import StageMetrics, measure, measure_iter
+from mhnav_pipeline.prefilter import KeywordPrefilter
+from mhnav_pipeline.presence import PresenceMatcher
+from mhnav_pipeline.read_data import read_dataset, iter_dataset, NOTE_COLUMNS, DATASET_COLUMNS
+from mhnav_pipeline.variants import RegexVariant, resolve_regex_files, summarize_variants
+from mhnav_pipeline.write_data import create_output_engine, write_table, write_file, write_tables_incremental, \
+    OUTPUT_FORMATS
+
+# columns added to records by `apply_regex_and_merge` with include_context
+REGEX_COLUMNS = ['id', 'concept', 'term', 'capture', 'precontext', 'postcontext', 'concept_term']
 
 
 def print_dataset(dataset):
@@ -26,6 +46,362 @@ def print_dataset(dataset):
         return dataset
 
 
+def clean_notes(df, cache=None, cleaning_rules=None, stats=None, clean_cached=False):
+    """
+    Clean `note_text` in place. With a regex result cache, notes with cached results are not cleaned
+        (unless `clean_cached`) since they will not be run through bratdb-apply.
+
+    :param cleaning_rules: (optional) CleaningRuleSet to use instead of `local/cleaning.py`
+    :param stats: (optional) Counter to which replacement counts from `cleaning_rules` are added
+    :param clean_cached: also clean notes with cached results; required when `note_text` is output (in nlp_regex)
+        so that it does not depend on whether the cache holds the note
+    :return: CacheLookup to pass to `apply_regex_and_merge` or None if not using a cache
+    """
+    cache_lookup = cache.lookup(df['note_text']) if cache is not None else None
+    if cache_lookup is not None and not clean_cached:
+        mask = ~cache_lookup.found
+    else:
+        mask = np.ones(df.shape[0], dtype=bool)
+    if cleaning_rules is None:
+        df.loc[mask, 'note_text'] = df.loc[mask, 'note_text'].apply(clean_text)
+    else:
+        df.loc[mask, 'note_text'], rule_stats = cleaning_rules.clean_series(df.loc[mask, 'note_text'])
+        if stats is not None:
+            stats.update(rule_stats)
+    return cache_lookup
+
+
+def count_records(*tables):
+    return sum(table.shape[0] for table in tables if table is not None)
+
+
+def log_cleaning(stats):
+    """Log replacement counts from both `CleaningRuleSet` (in `stats`) and `local/cleaning.py`."""
+    log_replacements(stats + get_and_reset_replacements())
+
+
+def retained_encounters(index_df, retained_enc_ids):
+    """Windows of the retained index encounters, to which notes are assigned (see `prepare_historical`)."""
+    return index_df.loc[
+        index_df['pat_enc_csn_id'].isin(retained_enc_ids), ['studyid', 'pat_enc_csn_id', 'start_date', 'end_date']
+    ].drop_duplicates()
+
+
+def historical_read_options(retained_enc_ids, encounters_df=None):
+    """
+    Arguments for `read_dataset`/`iter_dataset` to only load historical data for retained index encounters.
+
+    :param encounters_df: (optional) retained encounters if the historical dataset is a table of notes
+    :return: extra_cols, kwargs
+    """
+    if encounters_df is None:
+        return ('index_pat_enc_csn_id',), dict(filter_col='index_pat_enc_csn_id', filter_values=retained_enc_ids)
+    return (), dict(filter_col='studyid', filter_values=pd.unique(encounters_df['studyid']), columns=NOTE_COLUMNS)
+
+
+def prepare_historical(historical_df, encounters_df=None, metrics=None):
+    """
+    Find the distinct notes (to clean and run through bratdb-apply) in historical data.
+
+    :param encounters_df: (optional) if supplied, `historical_df` is a table of distinct notes, which are
+        assigned to the windows of these encounters (see `assign_notes_to_windows`); otherwise, it contains
+        each note once for each index encounter
+    :return: historical_lmt_df, note_df, note_index (see `deduplicate_notes`)
+    """
+    if encounters_df is None:
+        with measure(metrics, 'deduplicate_historical', rows_in=historical_df.shape[0]) as stage:
+            note_df, note_index = deduplicate_notes(historical_df)
+            stage.rows_out = note_df.shape[0]
+        return historical_df, note_df, note_index
+    with measure(metrics, 'assign_historical', rows_in=historical_df.shape[0]) as stage:
+        historical_lmt_df, note_index = assign_notes_to_windows(historical_df, encounters_df)
+        # only notes in at least one window need to be cleaned and run through bratdb-apply
+        used_notes = np.unique(note_index)
+        note_df = historical_df.iloc[used_notes].reset_index(drop=True)  # labels must be unique
+        note_index = np.searchsorted(used_notes, note_index)
+        stage.rows_out = historical_lmt_df.shape[0]
+    return historical_lmt_df, note_df, note_index
+
+
+def limit_historical(historical_lmt_df, note_df, note_index, retained_enc_ids, metrics=None):
+    """
+    Limit historical data (see `prepare_historical`) to the records of some of the retained index encounters
+        (e.g., those retained by one of several variants; see `mhnav_pipeline.variants`).
+
+    :return: historical_lmt_df, note_df, note_index (limited to notes in the remaining records)
+    """
+    with measure(metrics, 'limit_historical', rows_in=historical_lmt_df.shape[0]) as stage:
+        mask = historical_lmt_df['index_pat_enc_csn_id'].isin(retained_enc_ids).to_numpy()
+        used_notes, note_index = np.unique(note_index[mask], return_inverse=True)
+        historical_lmt_df = historical_lmt_df[mask]
+        stage.rows_out = historical_lmt_df.shape[0]
+    return historical_lmt_df, note_df.iloc[used_notes], note_index
+
+
+def process_index_data(index_df, regex_file, **kwargs):
+    """
+    Run bratdb-apply on (cleaned) index data.
+
+    :param kwargs: passed to `apply_regex_and_merge`
+    :return: index_ct_df, index_ct_df2, retained_enc_ids
+    """
+    _, index_ct_df = apply_regex_and_merge(index_df, regex_file, label='index', **kwargs)
+    # columns: ['start_date', 'pat_enc_csn_id', 'note_date', 'studyid',
+    #        'end_date', 'id', 'concept', 'term', 'capture', 'concept_term'] +
+    #        ['note_text', 'precontext', 'postcontext'] if include_context > 0
+    retained_enc_ids = index_ct_df.pat_enc_csn_id.unique()
+    # hits already carry the metadata of their record, so rather than merging with index_df again,
+    #   only retain the columns needed for output (in the order the merge would have produced)
+    index_ct_df2 = order_like_merge(
+        index_ct_df, index_df, on=['end_date', 'note_date', 'pat_enc_csn_id', 'start_date', 'studyid'],
+    )[['pat_enc_csn_id', 'note_date', 'concept_term', 'capture']]
+    return index_ct_df, index_ct_df2, retained_enc_ids
+
+
+def process_historical_data(historical_lmt_df, regex_file, presence_matcher=None, **kwargs):
+    """
+    Run bratdb-apply on (cleaned) historical data which has already been limited to retained index encounters.
+
+    :param presence_matcher: (optional) PresenceMatcher to only find the presence of hits/concept_terms on each
+        note date rather than running bratdb-apply (historical_ct_df is None); see `mhnav_pipeline.presence`
+    :param kwargs: passed to `apply_regex_and_merge`
+    :return: historical_ct_df, historical_res_df2, historical_ct_df2
+    """
+    if presence_matcher is not None:
+        with measure(kwargs.get('metrics'), 'historical_presence', rows_in=historical_lmt_df.shape[0]) as stage:
+            historical_res_df2, historical_ct_df2 = presence_matcher.apply(
+                historical_lmt_df, kwargs['note_df'], kwargs['note_index'], prefilter=kwargs.get('prefilter'),
+            )
+            stage.rows_out = historical_ct_df2.shape[0]
+        return None, historical_res_df2, historical_ct_df2
+    historical_res_df, historical_ct_df = apply_regex_and_merge(historical_lmt_df, regex_file, label='historical',
+                                                                **kwargs)
+    # columns [lmt]: ['start_date', 'pat_enc_csn_id', 'note_date', 'studyid', 'index_pat_enc_csn_id', 'end_date',
+    #        'note_text']
+    # columns [res]: ['start_date', 'pat_enc_csn_id', 'note_date', 'studyid',
+    #        'index_pat_enc_csn_id', 'end_date', 'id', 'concept',
+    #        'term', 'capture'] + ['note_text', 'precontext', 'postcontext'] if include_context > 0
+    # columns [ct]: [*res, 'concept_term']
+
+    # hits already carry the metadata of their record, so rather than merging with historical_lmt_df again,
+    #   only retain the columns needed for output (in the order the merge would have produced)
+    on = ['studyid', 'pat_enc_csn_id', 'index_pat_enc_csn_id', 'start_date', 'end_date', 'note_date']
+    historical_res_df2 = order_like_merge(
+        historical_res_df, historical_lmt_df, on=on
+    )[['studyid', 'index_pat_enc_csn_id', 'note_date']]
+    historical_ct_df2 = remove_index_dates(order_like_merge(
+        historical_ct_df, historical_lmt_df, on=on
+    ))[['index_pat_enc_csn_id', 'note_date', 'concept_term']]
+    return historical_ct_df, historical_res_df2, historical_ct_df2
+
+
+def _build_tables(index_dataset, historical_dataset, variants, *, engine_in=None, include_context=0, cache=None,
+                  cleaning_rules=None, metrics=None, from_notes=False, **kwargs):
+    """
+    Build output tables with both datasets loaded entirely into memory.
+
+    :param variants: list of RegexVariant; the datasets are loaded and cleaned once and each variant's
+        regex file is run over the cleaned notes (see `mhnav_pipeline.variants`)
+    :param cache: (optional) RegexResultCache; only used with a single variant, and not for historical data
+        if the variant has a `presence_matcher` (which requires all hits)
+    :param from_notes: `historical_dataset` is a table of distinct notes to assign to the windows of
+        the retained index encounters (see `assign_notes_to_windows`)
+    :param kwargs: passed to `apply_regex_and_merge`
+    :return: list of (nlp_positive, nlp_model, nlp_index, nlp_regex) for each variant; nlp_regex is None
+        unless `include_context` (and the variant has no `context_sink`)
+    """
+    # load data
+    logger.info(f'Loading index data from {print_dataset(index_dataset)}.')
+    with measure(metrics, 'load_index') as stage:
+        index_df = read_dataset(index_dataset, engine=engine_in)
+        stage.rows_out = index_df.shape[0]
+    # columns: ['start_date', 'pat_enc_csn_id', 'note_date', 'studyid', 'end_date', 'note_text']
+    logger.info(f'Loaded {index_df.shape[0]} records for index dataset.')
+
+    # clean text (including notes with cached results if note_text is retained for nlp_regex)
+    clean_cached = bool(include_context) and variants[0].context_sink is None
+    stats = Counter()
+    with measure(metrics, 'clean_index', rows_in=index_df.shape[0]):
+        cache_lookup = clean_notes(index_df, cache, cleaning_rules, stats, clean_cached=clean_cached)
+    log_cleaning(stats)
+
+    # process index data
+    index_results = []
+    for variant in variants:
+        logger.info(f'Processing index data with bratdb-apply ({variant.name}).')
+        index_results.append(process_index_data(
+            index_df, variant.regex_file, include_context=include_context, cache_lookup=cache_lookup,
+            metrics=metrics, prefilter=variant.prefilter, context_sink=variant.context_sink, **kwargs
+        ))
+    retained_enc_ids = pd.unique(np.concatenate([retained for _, _, retained in index_results]))
+
+    # load historical data, but only for retained index encounters
+    logger.info(f'Loading historical data for {len(retained_enc_ids)} retained index encounters'
+                f' from {print_dataset(historical_dataset)}.')
+    encounters_df = retained_encounters(index_df, retained_enc_ids) if from_notes else None
+    extra_cols, read_options = historical_read_options(retained_enc_ids, encounters_df)
+    with measure(metrics, 'load_historical') as stage:
+        historical_df = read_dataset(historical_dataset, *extra_cols, engine=engine_in, **read_options)
+        stage.rows_out = historical_df.shape[0]
+    logger.info(f'Loaded {historical_df.shape[0]} records for historical dataset.')
+    historical_lmt_df, note_df, note_index = prepare_historical(historical_df, encounters_df, metrics)
+    # columns: ['start_date', 'pat_enc_csn_id', 'note_date', 'studyid', 'index_pat_enc_csn_id', 'end_date', 'note_text']
+
+    # clean text of distinct notes
+    stats = Counter()
+    with measure(metrics, 'clean_historical', rows_in=note_df.shape[0]):
+        cache_lookup = clean_notes(note_df, None if variants[0].presence_matcher else cache, cleaning_rules, stats,
+                                   clean_cached=clean_cached)
+        historical_lmt_df['note_text'] = note_df['note_text'].to_numpy()[note_index]
+    log_cleaning(stats)
+
+    tables = []
+    for variant, (index_ct_df, index_ct_df2, variant_enc_ids) in zip(variants, index_results):
+        # process historical data
+        logger.info(f'Processing historical data with bratdb-apply ({variant.name}).')
+        variant_lmt_df, variant_note_df, variant_note_index = limit_historical(
+            historical_lmt_df, note_df, note_index, variant_enc_ids, metrics
+        ) if len(variants) > 1 else (historical_lmt_df, note_df, note_index)
+        historical_ct_df, historical_res_df2, historical_ct_df2 = process_historical_data(
+            variant_lmt_df, variant.regex_file, include_context=include_context, cache_lookup=cache_lookup,
+            note_df=variant_note_df, note_index=variant_note_index, metrics=metrics, prefilter=variant.prefilter,
+            presence_matcher=variant.presence_matcher, context_sink=variant.context_sink, **kwargs
+        )
+
+        # produce output
+        logger.info(f'Building final tables ({variant.name}).')
+        with measure(metrics, 'build_tables') as stage:
+            nlp_positive = build_nlp_positive_table(historical_res_df2, variant_lmt_df)
+            nlp_model = build_nlp_model_table(historical_ct_df2)
+            nlp_index = build_nlp_index_table(index_ct_df2)
+            if include_context and variant.context_sink is None:
+                nlp_regex = build_nlp_regex_table(index_ct_df, historical_ct_df)
+            else:
+                nlp_regex = None
+            stage.rows_out = count_records(nlp_positive, nlp_model, nlp_index, nlp_regex)
+        tables.append((nlp_positive, nlp_model, nlp_index, nlp_regex))
+    return tables
+
+
+def _build_tables_in_chunks(index_dataset, historical_dataset, variants, *, engine_in=None,
+                            chunksize=100_000, include_context=0, cache=None, cleaning_rules=None, metrics=None,
+                            from_notes=False, **kwargs):
+    """
+    Build output tables by streaming both datasets in patient-aligned chunks.
+
+    Each chunk is cleaned, run through bratdb-apply, and reduced to the (deduplicated) records
+        required by the `build_nlp_*` functions, so that memory depends on `chunksize` rather than
+        on the size of the corpus.
+
+    :param variants: list of RegexVariant; each chunk is cleaned once and run through each variant
+    :param cache: (optional) RegexResultCache; see `_build_tables`
+    :param from_notes: `historical_dataset` is a table of distinct notes; see `_build_tables`
+    :param kwargs: passed to `apply_regex_and_merge`
+    :return: list of (nlp_positive, nlp_model, nlp_index, nlp_regex) for each variant; see `_build_tables`
+    """
+    # reduced chunks for each variant
+    parts = [defaultdict(list) for _ in variants]
+
+    # process index data
+    logger.info(f'Processing index data from {print_dataset(index_dataset)} with bratdb-apply.')
+    encounter_parts = []
+    n_records = 0
+    stats = Counter()
+    # notes with cached results are also cleaned if note_text is retained for nlp_regex
+    clean_cached = bool(include_context) and variants[0].context_sink is None
+    for index_df in measure_iter(metrics, 'load_index', iter_dataset(index_dataset, engine=engine_in,
+                                                                     chunksize=chunksize)):
+        n_records += index_df.shape[0]
+        with measure(metrics, 'clean_index', rows_in=index_df.shape[0]):
+            cache_lookup = clean_notes(index_df, cache, cleaning_rules, stats, clean_cached=clean_cached)
+        for variant, variant_parts in zip(variants, parts):
+            index_ct_df, index_ct_df2, retained_enc_ids = process_index_data(
+                index_df, variant.regex_file, include_context=include_context, cache_lookup=cache_lookup,
+                metrics=metrics, prefilter=variant.prefilter, context_sink=variant.context_sink, **kwargs
+            )
+            with measure(metrics, 'reduce_index', rows_in=index_ct_df2.shape[0]) as stage:
+                variant_parts['index'].append(partial_nlp_index(index_ct_df2))
+                variant_parts['retained'].append(retained_enc_ids)
+                if from_notes:
+                    encounter_parts.append(retained_encounters(index_df, retained_enc_ids))
+                if include_context and variant.context_sink is None:
+                    variant_parts['index_regex'].append(partial_nlp_regex(index_ct_df))
+                stage.rows_out = variant_parts['index'][-1].shape[0]
+    log_cleaning(stats)
+    logger.info(f'Processed {n_records} records for index dataset.')
+    variant_enc_ids = [
+        pd.unique(np.concatenate(variant_parts['retained'])) if variant_parts['retained'] else np.array([])
+        for variant_parts in parts
+    ]
+    retained_enc_ids = pd.unique(np.concatenate(variant_enc_ids))
+    encounters_df = combine_partials(
+        encounter_parts, ['studyid', 'pat_enc_csn_id', 'start_date', 'end_date']
+    ) if from_notes else None
+
+    # process historical data
+    logger.info(f'Processing historical data for {len(retained_enc_ids)} retained index encounters'
+                f' from {print_dataset(historical_dataset)} with bratdb-apply.')
+    n_records = 0
+    stats = Counter()
+    extra_cols, read_options = historical_read_options(retained_enc_ids, encounters_df)
+    historical_chunks = iter_dataset(historical_dataset, *extra_cols, engine=engine_in, chunksize=chunksize,
+                                     **read_options)
+    for historical_df in measure_iter(metrics, 'load_historical', historical_chunks):
+        n_records += historical_df.shape[0]
+        historical_lmt_df, note_df, note_index = prepare_historical(historical_df, encounters_df, metrics)
+        with measure(metrics, 'clean_historical', rows_in=note_df.shape[0]):
+            cache_lookup = clean_notes(note_df, None if variants[0].presence_matcher else cache, cleaning_rules,
+                                       stats, clean_cached=clean_cached)
+            historical_lmt_df['note_text'] = note_df['note_text'].to_numpy()[note_index]
+        for variant, variant_parts, enc_ids in zip(variants, parts, variant_enc_ids):
+            variant_lmt_df, variant_note_df, variant_note_index = limit_historical(
+                historical_lmt_df, note_df, note_index, enc_ids, metrics
+            ) if len(variants) > 1 else (historical_lmt_df, note_df, note_index)
+            historical_ct_df, historical_res_df2, historical_ct_df2 = process_historical_data(
+                variant_lmt_df, variant.regex_file, include_context=include_context, cache_lookup=cache_lookup,
+                note_df=variant_note_df, note_index=variant_note_index, metrics=metrics,
+                prefilter=variant.prefilter, presence_matcher=variant.presence_matcher,
+                context_sink=variant.context_sink, **kwargs
+            )
+            with measure(metrics, 'reduce_historical', rows_in=historical_res_df2.shape[0]) as stage:
+                positive_part, lmt_part = partial_nlp_positive(historical_res_df2, variant_lmt_df)
+                variant_parts['positive'].append(positive_part)
+                variant_parts['lmt'].append(lmt_part)
+                variant_parts['model'].append(partial_nlp_model(historical_ct_df2))
+                if include_context and variant.context_sink is None:
+                    variant_parts['historical_regex'].append(partial_nlp_regex(historical_ct_df))
+                stage.rows_out = positive_part.shape[0] + variant_parts['model'][-1].shape[0]
+    log_cleaning(stats)
+    logger.info(f'Processed {n_records} retained records for historical dataset.')
+
+    # produce output
+    tables = []
+    for variant, variant_parts in zip(variants, parts):
+        logger.info(f'Building final tables ({variant.name}).')
+        with measure(metrics, 'build_tables') as stage:
+            nlp_positive = build_nlp_positive_table(
+                combine_partials(variant_parts['positive'], ['studyid', 'index_pat_enc_csn_id', 'note_date']),
+                combine_partials(variant_parts['lmt'], ['index_pat_enc_csn_id']),
+            )
+            nlp_model = build_nlp_model_table(
+                combine_partials(variant_parts['model'], ['index_pat_enc_csn_id', 'note_date', 'concept_term'])
+            )
+            nlp_index = build_nlp_index_table(
+                combine_partials(variant_parts['index'], ['pat_enc_csn_id', 'note_date', 'concept_term', 'capture'])
+            )
+            if include_context and variant.context_sink is None:
+                nlp_regex = build_nlp_regex_table(
+                    combine_regex_parts(variant_parts['index_regex'], [*sorted(DATASET_COLUMNS), *REGEX_COLUMNS]),
+                    combine_regex_parts(variant_parts['historical_regex'],
+                                        [*sorted(DATASET_COLUMNS), 'index_pat_enc_csn_id', *REGEX_COLUMNS]),
+                )
+            else:
+                nlp_regex = None
+            stage.rows_out = count_records(nlp_positive, nlp_model, nlp_index, nlp_regex)
+        tables.append((nlp_positive, nlp_model, nlp_index, nlp_regex))
+    return tables
+
+
 def build_datasets(index_dataset, historical_dataset, regex_file, *,
                    in_connection_string=None, outpath=None, out_connection_string=None,
                    output_to_csv=True,
@@ -34,140 +410,207 @@ def build_datasets(index_dataset, historical_dataset, regex_file, *,
                    nlp_index_tablename=None,
                    nlp_regex_tablename=None,
                    overwrite_existing=False,
-                   include_context=0):
+                   include_context=0,
+                   chunksize=None,
+                   workers=1,
+                   concept_term_file=None,
+                   prefilter=False,
+                   cache_dir=None,
+                   cache_max_size=1024,
+                   cleaning_rules=None,
+                   output_format='csv',
+                   profile=False,
+                   presence_only=False,
+                   notes_dataset=None,
+                   stream_context=False,
+                   incremental=False):
     """
     Build datasets of text and then run regular expressions with bratdb-apply on the text. Retain
         instances that are useful for the Mental Health Navigator model and output those as CSV/db.
 
     :param index_dataset:
     :param historical_dataset:
-    :param regex_file:
+    :param regex_file: regex file, directory of regex files, or list of regex files/directories; with more
+        than one regex file, the datasets are loaded and cleaned once and each regex file is run over the
+        cleaned notes, producing output tables for each (labelled with the name of the regex file) and a
+        summary of the differences in concept_term counts (see `mhnav_pipeline.variants`); the cache
+        (`cache_dir`) is not used
     :param in_connection_string:
     :param outpath:
     :param out_connection_string:
-    :param output_to_csv:
+    :param output_to_csv: write tables to files in `outpath` (see `output_format`)
     :param nlp_positive_tablename: (optional) specify exact name for table
     :param nlp_model_tablename: (optional) specify exact name for table
     :param nlp_index_tablename: (optional) specify exact name for table
     :param nlp_regex_tablename: (optional) specify exact name for table
     :param overwrite_existing: overwrite existing tables
     :param include_context: specify context to include for debugging
-    :return:
+    :param chunksize: (optional) stream datasets in patient-aligned chunks of this many records
+        rather than loading them entirely into memory; output is the same
+    :param workers: number of processes across which to split (by studyid) the running of bratdb-apply
+    :param concept_term_file: (optional) tab-separated file of rules mapping bratdb concept/term
+        to concept_term; see `mhnav_pipeline.concept_terms`
+    :param prefilter: only run bratdb-apply on notes containing a literal required by at least one
+        regular expression; see `mhnav_pipeline.prefilter`
+    :param cache_dir: (optional) directory for a persistent cache of bratdb-apply results for each note;
+        on subsequent runs, only new or changed notes are cleaned and run through bratdb-apply (all notes
+        are cleaned if `include_context` without `stream_context`, since note text is output in nlp_regex)
+    :param cache_max_size: maximum size (in MB) of cached results before least recently used notes are evicted
+    :param cleaning_rules: (optional) tab-separated file of exclusion/replacement rules to clean text with
+        instead of `local/cleaning.py`; see `mhnav_pipeline.cleaning_rules`
+    :param output_format: format of output files: 'csv' or 'parquet' (requires pyarrow)
+    :param profile: run each stage under cProfile and save the profiles to `outpath`; stage metrics
+        (see `mhnav_pipeline.metrics`) are always logged, and are written to `outpath` if it is specified
+        or any files are output
+    :param presence_only: for historical data, only find whether each concept_term occurs on each note date
+        (stopping early) rather than every match; output is the same; ignored if `include_context`
+        (see `mhnav_pipeline.presence`)
+    :param notes_dataset: (optional) table of distinct notes (studyid, pat_enc_csn_id, note_date, note_text)
+        to use instead of `historical_dataset` (which must be None); each note is assigned to the window
+        (start_date to end_date) of each retained index encounter of the same patient which contains it; output
+        records are the same as for the equivalent historical dataset, but ordered as if it were sorted by
+        index encounter and note date
+    :param stream_context: with `include_context`, write nlp_regex (without note text, and with context truncated
+        to `include_context` characters) to a compressed file in `outpath` as hits are found rather than
+        building it in memory; nlp_regex is not returned or written to the database
+        (see `mhnav_pipeline.context_sink`); memory use is only bounded with `chunksize`, since otherwise
+        the hits for each entire dataset are collected before being written
+    :param incremental: update database tables with stable names (`nlp_positive`, etc., unless a tablename is
+        specified) by only deleting and inserting the records which have changed, in a single transaction
+        (see `write_data.write_tables_incremental`); nlp_regex is still written to a new table
+    :return: nlp_positive, nlp_model, nlp_index, nlp_regex (None unless `include_context`); with more than one
+        regex file, dict of regex file name -> (nlp_positive, nlp_model, nlp_index, nlp_regex)
     """
     logger.info(f'Beginning process of building datasets for Mental Health Navigator.')
+    # validate arguments before creating anything that must be closed (cache, worker processes, output files)
+    if (historical_dataset is None) == (notes_dataset is None):
+        e = ValueError('Exactly one of historical_dataset and notes_dataset must be specified.')
+        logger.exception(e)
+        raise e
+    regex_files = resolve_regex_files(regex_file)
+    multiple = len(regex_files) > 1
+    if cache_dir and multiple:
+        logger.warning('The regex result cache is not used with more than one regex file.')
+    if presence_only and include_context:
+        logger.warning('Presence-only mode is ignored with include_context since nlp_regex requires every hit.')
+    if stream_context and not include_context:
+        logger.warning('Streaming context is ignored without include_context.')
+    concept_term_rules = get_concept_term_rules(concept_term_file)
+    cleaning_rule_set = CleaningRuleSet.from_file(cleaning_rules) if cleaning_rules else None
     now = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
 
     engine_in = sa.create_engine(in_connection_string) if in_connection_string else None
-    engine_out = sa.create_engine(out_connection_string) if out_connection_string else None
+    engine_out = create_output_engine(out_connection_string) if out_connection_string else None
+    # metrics are only written alongside other output files (not to the working directory of a database-only run)
+    write_metrics = bool(outpath) or output_to_csv or bool(stream_context and include_context) or profile
     outpath = pathlib.Path(outpath) / now if outpath else pathlib.Path('.')
     outpath.mkdir(exist_ok=True, parents=True)
+    variants = []
+    for path in regex_files:
+        # output of each variant is labelled with its name (if there is more than one)
+        label = f'{path.stem}_{now}' if multiple else now
+        variants.append(RegexVariant(
+            path,
+            prefilter=KeywordPrefilter.from_regex_file(path) if prefilter else None,
+            presence_matcher=PresenceMatcher.from_regex_file(
+                path, concept_term_rules
+            ) if presence_only and not include_context else None,
+            context_sink=ContextSink(  # file is not opened until hits are written
+                outpath / f'nlp_regex_{label}', output_format, context_length=include_context,
+            ) if stream_context and include_context else None,
+        ))
+    metrics = StageMetrics(profile=profile)
+    cache = RegexResultCache(
+        cache_dir, regex_files[0],
+        cleaning_files=[cleaning_rules] if cleaning_rules else [inspect.getsourcefile(clean_text)],
+        include_context=include_context, max_size_mb=cache_max_size,
+    ) if cache_dir and not multiple else None
+    regex_options = dict(
+        workers=workers,
+        concept_term_rules=concept_term_rules,
+        # one pool of worker processes for the whole run rather than for each dataset/chunk/variant
+        pool=ProcessPoolExecutor(max_workers=workers) if workers > 1 else None,
+    )
 
-    # load data
-    logger.info(f'Loading index data from {print_dataset(index_dataset)}.')
-    index_df = read_dataset(index_dataset, engine=engine_in)
-    # columns: ['start_date', 'pat_enc_csn_id', 'note_date', 'studyid', 'end_date', 'note_text']
-    logger.info(f'Loaded {index_df.shape[0]} records for index dataset.')
-    logger.info(f'Loading historical data from {print_dataset(historical_dataset)}.')
-    historical_df = read_dataset(historical_dataset, 'index_pat_enc_csn_id', engine=engine_in)
-    # columns: ['start_date', 'pat_enc_csn_id', 'note_date', 'studyid', 'index_pat_enc_csn_id', 'end_date', 'note_text']
-    logger.info(f'Loaded {index_df.shape[0]} records for historical dataset.')
+    try:
+        if chunksize:
+            tables = _build_tables_in_chunks(
+                index_dataset, historical_dataset if notes_dataset is None else notes_dataset, variants,
+                engine_in=engine_in, chunksize=chunksize, include_context=include_context, cache=cache,
+                cleaning_rules=cleaning_rule_set, metrics=metrics, from_notes=notes_dataset is not None,
+                **regex_options
+            )
+        else:
+            tables = _build_tables(
+                index_dataset, historical_dataset if notes_dataset is None else notes_dataset, variants,
+                engine_in=engine_in, include_context=include_context, cache=cache,
+                cleaning_rules=cleaning_rule_set, metrics=metrics, from_notes=notes_dataset is not None,
+                **regex_options
+            )
+    finally:
+        # release worker processes, the cache's connection, and streamed output files even if the build failed
+        if regex_options['pool']:
+            regex_options['pool'].shutdown()
+        if cache:
+            cache.log_statistics()
+            cache.close()
+        for variant in variants:
+            if variant.context_sink:
+                variant.context_sink.close()
 
-    # clean text
-    index_df['note_text'] = index_df['note_text'].apply(clean_text)
-    log_and_reset_replacements()
-    historical_df['note_text'] = historical_df['note_text'].apply(clean_text)
-    log_and_reset_replacements()
+    for variant, (nlp_positive, nlp_model, nlp_index, nlp_regex) in zip(variants, tables):
+        label = f'{variant.name}_{now}' if multiple else now
+        # output data
+        n_records = count_records(nlp_positive, nlp_model, nlp_index, nlp_regex)
+        if output_to_csv:
+            logger.info(f'Outputting tables to {output_format}: {outpath}.')
+            with measure(metrics, 'write_files', rows_in=n_records):
+                write_file(nlp_positive, outpath / f'nlp_positive_{label}', output_format)
+                write_file(nlp_model, outpath / f'nlp_model_{label}', output_format)
+                write_file(nlp_index, outpath / f'nlp_index_{label}', output_format)
+                if nlp_regex is not None:  # include_context > 0 and not streamed
+                    write_file(nlp_regex, outpath / f'nlp_regex_{label}', output_format)
 
-    # process index data
-    logger.info('Processing index data with bratdb-apply.')
-    _, index_ct_df = apply_regex_and_merge(index_df, regex_file, include_context=include_context)
-    # columns: ['Index', 'start_date', 'pat_enc_csn_id', 'note_date', 'studyid',
-    #        'end_date', 'note_text', 'id', 'concept', 'term', 'capture', 'concept_term'] +
-    #        ['precontext', 'postcontext'] if include_context > 0
-    retained_enc_ids = index_ct_df.pat_enc_csn_id.unique()
-    index_lmt_df = index_df[index_df.pat_enc_csn_id.isin(retained_enc_ids)]
-    # columns: ['start_date', 'pat_enc_csn_id', 'note_date', 'studyid', 'end_date', 'note_text']
+        # output sql
+        if engine_out:
+            logger.info(f'Outputting tables to database: {out_connection_string}.')
+            suffix = f'_{variant.name}' if multiple else ''
+            with measure(metrics, 'write_database', rows_in=n_records):
+                if incremental:
+                    write_tables_incremental([
+                        (nlp_positive, f'{nlp_positive_tablename or "nlp_positive"}{suffix}', 'nlp_positive'),
+                        (nlp_model, f'{nlp_model_tablename or "nlp_model"}{suffix}', 'nlp_model'),
+                        (nlp_index, f'{nlp_index_tablename or "nlp_index"}{suffix}', 'nlp_index'),
+                    ], engine_out)
+                else:
+                    write_table(nlp_positive, f'{nlp_positive_tablename}{suffix}' if nlp_positive_tablename
+                                else f'nlp_positive_{label}', engine_out, 'nlp_positive',
+                                overwrite_existing=overwrite_existing)
+                    write_table(nlp_model, f'{nlp_model_tablename}{suffix}' if nlp_model_tablename
+                                else f'nlp_model_{label}', engine_out, 'nlp_model',
+                                overwrite_existing=overwrite_existing)
+                    write_table(nlp_index, f'{nlp_index_tablename}{suffix}' if nlp_index_tablename
+                                else f'nlp_index_{label}', engine_out, 'nlp_index',
+                                overwrite_existing=overwrite_existing)
+                if nlp_regex is not None:  # include_context > 0 and not streamed
+                    write_table(nlp_regex, f'{nlp_regex_tablename}{suffix}' if nlp_regex_tablename
+                                else f'nlp_regex_{label}', engine_out,
+                                overwrite_existing=overwrite_existing)
 
-    # process historical data
-    logger.info('Processing historical data with bratdb-apply.')
-    historical_lmt_df = historical_df[historical_df.index_pat_enc_csn_id.isin(retained_enc_ids)]
-    historical_res_df, historical_ct_df = apply_regex_and_merge(
-        historical_lmt_df, regex_file, include_context=include_context
-    )
-    # columns [lmt]: ['start_date', 'pat_enc_csn_id', 'note_date', 'studyid', 'index_pat_enc_csn_id', 'end_date',
-    #        'note_text']
-    # columns [res]: ['start_date', 'pat_enc_csn_id', 'note_date', 'studyid',
-    #        'index_pat_enc_csn_id', 'end_date', 'note_text', 'id', 'concept',
-    #        'term', 'capture'] + ['precontext', 'postcontext'] if include_context > 0
-    # columns [ct]: ['Index', 'start_date', 'pat_enc_csn_id', 'note_date', 'studyid', 'term', 'capture',
-    #        'index_pat_enc_csn_id', 'end_date', 'note_text', 'id', 'concept', 'concept_term'] +
-    #        ['precontext', 'postcontext'] if include_context > 0
-
-    # merge with metadata
-    logger.info('Merging results of bratdb-apply with metadata.')
-    historical_res_df2 = attach_results_to_correct_encounter(
-        historical_lmt_df, historical_res_df,
-        on=['studyid', 'pat_enc_csn_id', 'index_pat_enc_csn_id', 'start_date', 'end_date', 'note_date'],
-        skip_date_filter=True
-    )
-    # columns: ['start_date', 'pat_enc_csn_id', 'note_date', 'studyid',
-    #        'index_pat_enc_csn_id', 'end_date', 'note_text_x', 'note_text_y', 'id',
-    #        'concept', 'term', 'capture'] +? ['precontext', 'postcontext']
-    historical_ct_df2 = remove_index_dates(attach_results_to_correct_encounter(
-        historical_lmt_df, historical_ct_df,
-        on=['studyid', 'start_date', 'end_date', 'pat_enc_csn_id', 'index_pat_enc_csn_id', 'note_date'],
-        skip_date_filter=True
-    ))
-    # columns: ['start_date', 'pat_enc_csn_id', 'note_date', 'studyid',
-    #        'index_pat_enc_csn_id', 'end_date', 'note_text_x', 'Index',
-    #        'note_text_y', 'id', 'concept', 'term', 'capture', 'concept_term'] +?
-    #        ['precontext', 'postcontext']
-    index_ct_df2 = attach_results_to_correct_encounter(
-        index_lmt_df, index_ct_df,
-        on=['end_date', 'note_date', 'pat_enc_csn_id', 'start_date', 'studyid'],
-        skip_date_filter=True
-    )
-    # columns: ['start_date', 'pat_enc_csn_id', 'note_date', 'studyid', 'end_date',
-    #        'note_text_x', 'Index', 'note_text_y', 'id', 'concept', 'term',
-    #        'capture', 'concept_term'] +? ['precontext', 'postcontext']
-
-    # produce output
-    logger.info('Building final tables.')
-    nlp_positive = build_nlp_positive_table(historical_res_df2, historical_lmt_df)
-    nlp_model = build_nlp_model_table(historical_ct_df2)
-    nlp_index = build_nlp_index_table(index_ct_df2)
-    if include_context:
-        nlp_regex = build_nlp_regex_table(index_ct_df, historical_ct_df)
-    else:
-        nlp_regex = None
-
-    # output data
-    if output_to_csv:
-        logger.info(f'Outputting tables to CSV: {outpath}.')
-        nlp_positive.to_csv(outpath / f'nlp_positive_{now}.csv', index=False)
-        nlp_model.to_csv(outpath / f'nlp_model_{now}.csv', index=False)
-        nlp_index.to_csv(outpath / f'nlp_index_{now}.csv', index=False)
-        if include_context:  # nlp_regex exists if include_context > 0
-            nlp_regex.to_csv(outpath / f'nlp_regex_{now}.csv', index=False)
-
-    # output sql
-    if engine_out:
-        logger.info(f'Outputting tables to database: {out_connection_string}.')
-        nlp_positive_tablename = nlp_positive_tablename if nlp_positive_tablename else f'nlp_positive_{now}'
-        nlp_model_tablename = nlp_model_tablename if nlp_model_tablename else f'nlp_model_{now}'
-        nlp_index_tablename = nlp_index_tablename if nlp_index_tablename else f'nlp_index_{now}'
-        nlp_positive.to_sql(nlp_positive_tablename, con=engine_out, index=False,
-                            if_exists='replace' if overwrite_existing else 'fail')
-        nlp_model.to_sql(nlp_model_tablename, con=engine_out, index=False,
-                         if_exists='replace' if overwrite_existing else 'fail')
-        nlp_index.to_sql(nlp_index_tablename, con=engine_out, index=False,
-                         if_exists='replace' if overwrite_existing else 'fail')
-        if include_context:  # nlp_regex exists if include_context > 0
-            nlp_regex.to_sql(nlp_regex_tablename, con=engine_out, index=False,
-                             if_exists='replace' if overwrite_existing else 'fail')
+    if multiple:
+        variant_tables = {variant.name: variant_tables for variant, variant_tables in zip(variants, tables)}
+        summary = summarize_variants(variant_tables)
+        logger.info(f'Differences in concept_term counts between regex files:\n{summary.to_string(index=False)}')
+        if output_to_csv:
+            write_file(summary, outpath / f'regex_summary_{now}', output_format)
 
+    metrics.log()
+    if write_metrics:
+        metrics.write(outpath, f'metrics_{now}')
     logger.info(f'Process completed.')
-    return nlp_positive, nlp_model, nlp_index, nlp_regex
+    if multiple:
+        return variant_tables
+    return tables[0]
 
 
 def run():
@@ -178,23 +621,79 @@ def run():
                         help='Dataset from the target encounters information.'
                              ' Must have the following columns: pat_enc_csn_id,'
                              ' studyid, note_date, note_text, start_date, end_date.')
-    parser.add_argument('-s', '--historical-dataset', dest='historical_dataset', required=True,
-                        help='Dataset from one day before to 365 days before the encounter date.'
-                             ' Must have the following columns: index_pat_enc_csn_id, pat_enc_csn_id,'
-                             ' studyid, note_date, note_text, start_date, end_date.'
-                             ' May be dataframe, CSV file, or table name.')
-    parser.add_argument('-r', '--regex-file', dest='regex_file', required=True, type=pathlib.Path,
-                        help='Full path to regex file for running bratdb-apply.')
+    historical_group = parser.add_mutually_exclusive_group(required=True)
+    historical_group.add_argument('-s', '--historical-dataset', dest='historical_dataset',
+                                  help='Dataset from one day before to 365 days before the encounter date.'
+                                       ' Must have the following columns: index_pat_enc_csn_id, pat_enc_csn_id,'
+                                       ' studyid, note_date, note_text, start_date, end_date.'
+                                       ' May be dataframe, CSV file, or table name.')
+    historical_group.add_argument('-n', '--notes-dataset', dest='notes_dataset',
+                                  help='Dataset of distinct notes to use instead of --historical-dataset. Must have'
+                                       ' the following columns: studyid, pat_enc_csn_id, note_date, note_text.'
+                                       ' Each note is assigned to every index encounter window (start_date to'
+                                       ' end_date in the index dataset) of the same patient which contains it.')
+    parser.add_argument('-r', '--regex-file', dest='regex_file', required=True, type=pathlib.Path, nargs='+',
+                        help='Full path to regex file for running bratdb-apply. To compare several regex files,'
+                             ' supply more than one file or a directory (of .tsv/.txt files): the datasets'
+                             ' are loaded and cleaned once, output tables are written for each regex file,'
+                             ' and a summary of differences in concept_term counts is written.')
     parser.add_argument('--in-connection-string', dest='in_connection_string',
                         help='SQL Alchemy-style connection string to retrieve index and historical datasets.'
                              ' --index-dataset and --historical-dataset must be set to tablenames.')
     parser.add_argument('--out-connection-string', dest='out_connection_string',
                         help='SQL Alchemy-style connection string to output result datasets.')
+    parser.add_argument('--outpath', dest='outpath', required=False, default=None, type=pathlib.Path,
+                        help='Directory in which to write output files (in a timestamped subdirectory).'
+                             ' Defaults to the current directory.')
     parser.add_argument('--dont-output-to-csv', dest='output_to_csv', default=True, action='store_false',
                         help='Skip writing data to file. (If using database only, or want to just return'
                              ' result dataframes.')
     parser.add_argument('--include-context', dest='include_context', required=False, default=0, type=int,
                         help='Include debugging context for regular expressions on a note-by-note level.')
+    parser.add_argument('--chunk-size', dest='chunksize', required=False, default=None, type=int,
+                        help='Stream index and historical datasets in chunks of this many records to bound'
+                             ' memory usage. Chunks are aligned on studyid (assuming data is ordered by'
+                             ' studyid). By default, datasets are loaded entirely into memory.')
+    parser.add_argument('--workers', dest='workers', required=False, default=1, type=int,
+                        help='Number of processes to use when running bratdb-apply. Records are split'
+                             ' across processes by studyid.')
+    parser.add_argument('--concept-term-file', dest='concept_term_file', required=False, default=None,
+                        type=pathlib.Path,
+                        help='Tab-separated file of rules (field, value, concept_term) mapping bratdb'
+                             ' concept/term to concept_term. Defaults to the built-in rules.')
+    parser.add_argument('--prefilter', dest='prefilter', default=False, action='store_true',
+                        help='Skip running bratdb-apply on notes which do not contain any of the literal'
+                             ' text required by the regular expressions.')
+    parser.add_argument('--cache-dir', dest='cache_dir', required=False, default=None, type=pathlib.Path,
+                        help='Directory for a persistent cache of bratdb-apply results for each note. On'
+                             ' subsequent runs, only new or changed notes will be cleaned and processed.')
+    parser.add_argument('--cache-max-size', dest='cache_max_size', required=False, default=1024, type=int,
+                        help='Maximum size (in MB) of the cache before least recently used notes are evicted.')
+    parser.add_argument('--cleaning-rules', dest='cleaning_rules', required=False, default=None, type=pathlib.Path,
+                        help='Tab-separated file of text cleaning rules (`exclude<TAB>phrase` or'
+                             ' `replace<TAB>pattern`) to use instead of `local/cleaning.py`.'
+                             ' All rules are compiled once and applied in a single pass.')
+    parser.add_argument('--output-format', dest='output_format', default='csv', choices=OUTPUT_FORMATS,
+                        help='Format of output files. Parquet requires pyarrow.')
+    parser.add_argument('--profile', dest='profile', default=False, action='store_true',
+                        help='Run each stage under cProfile and save the profiles (profile_{stage}.prof)'
+                             ' alongside the stage metrics in the output directory.')
+    parser.add_argument('--presence-only', dest='presence_only', default=False, action='store_true',
+                        help='For historical data, only find whether each concept_term occurs on each note date,'
+                             ' skipping further matching once found. Output is unchanged. Ignored with'
+                             ' --include-context.')
+    parser.add_argument('--stream-context', dest='stream_context', default=False, action='store_true',
+                        help='With --include-context, write nlp_regex (without note text, and with context'
+                             ' truncated to --include-context characters) to a compressed file (gzipped CSV or'
+                             ' Parquet, see --output-format) as hits are found rather than building it in'
+                             ' memory. nlp_regex is not written to the database. Memory use is only bounded'
+                             ' with --chunk-size; otherwise, the hits for each entire dataset are collected'
+                             ' before being written.')
+    parser.add_argument('--incremental', dest='incremental', default=False, action='store_true',
+                        help='Update output tables with stable names (nlp_positive, nlp_model, nlp_index, or the'
+                             ' names supplied) in the --out-connection-string database, only deleting and'
+                             ' inserting records which have changed since the previous run (in a single'
+                             ' transaction), rather than writing new timestamped tables.')
     build_datasets(**vars(parser.parse_args()))
 
 
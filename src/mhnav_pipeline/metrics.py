@@ -0,0 +1,177 @@
+"""
+Stage-level metrics for pipeline runs.
+
+For each stage (e.g., loading, cleaning, bratdb-apply), records wall time, CPU time, rows in/out,
+    notes per second, and peak memory, and writes them to JSON and CSV files. A stage run more than
+    once (e.g., once per chunk) is aggregated into a single record.
+
+CPU time only includes the main process (i.e., not `--workers` processes). Peak memory is the high-water
+    mark of the process's resident memory at the end of the stage, so the stage in which it increases
+    is the one which reached the peak. On Windows, this requires `psutil` (`pip install .[metrics]`).
+
+If `profile` is enabled, each stage is also run under cProfile and the profile saved to
+    `profile_{stage}.prof` (load with `pstats` or, e.g., snakeviz).
+"""
+import contextlib
+import cProfile
+import csv
+import json
+import pstats
+import sys
+import time
+
+from loguru import logger
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+METRIC_COLUMNS = ['stage', 'calls', 'wall_time', 'cpu_time', 'rows_in', 'rows_out', 'notes_per_sec', 'peak_memory_mb']
+
+
+def peak_memory_mb():
+    """High-water mark of resident memory for this process (MB) or None if unavailable."""
+    if resource is not None:
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss / 1024 / 1024 if sys.platform == 'darwin' else maxrss / 1024  # bytes on macOS, else KB
+    if psutil is not None:
+        info = psutil.Process().memory_info()
+        return getattr(info, 'peak_wset', info.rss) / 1024 / 1024
+    return None
+
+
+class Stage:
+    """Counts for a single run of a stage; set `rows_out` (and `rows_in`/`notes` if not known up front)."""
+
+    def __init__(self, name, rows_in=None, notes=None):
+        """
+        :param rows_in: number of records passed to the stage
+        :param notes: number of notes processed (for notes/sec); defaults to `rows_in` or `rows_out`
+        """
+        self.name = name
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.notes = notes
+        self.discard = False  # set to not record this run
+
+
+class StageMetrics:
+
+    def __init__(self, profile=False):
+        """
+        :param profile: run each stage under cProfile
+        """
+        self.profile = profile
+        self.stages = {}
+        self.profiles = {}
+        self._start = time.perf_counter()
+        self._start_cpu = time.process_time()
+
+    @contextlib.contextmanager
+    def stage(self, name, rows_in=None, notes=None):
+        """Measure a stage: `with metrics.stage('clean_index', rows_in=n) as stage: ...; stage.rows_out = m`"""
+        stage = Stage(name, rows_in=rows_in, notes=notes)
+        profiler = cProfile.Profile() if self.profile else None
+        start, start_cpu = time.perf_counter(), time.process_time()
+        if profiler:
+            profiler.enable()
+        try:
+            yield stage
+        finally:
+            if profiler:
+                profiler.disable()
+            self._record(stage, time.perf_counter() - start, time.process_time() - start_cpu, profiler)
+
+    def _record(self, stage, wall_time, cpu_time, profiler=None):
+        if stage.discard:
+            return
+        record = self.stages.setdefault(stage.name, {
+            'stage': stage.name, 'calls': 0, 'wall_time': 0.0, 'cpu_time': 0.0,
+            'rows_in': None, 'rows_out': None, 'notes': None, 'peak_memory_mb': None,
+        })
+        record['calls'] += 1
+        record['wall_time'] += wall_time
+        record['cpu_time'] += cpu_time
+        notes = next((n for n in (stage.notes, stage.rows_in, stage.rows_out) if n is not None), None)
+        for key, value in (('rows_in', stage.rows_in), ('rows_out', stage.rows_out), ('notes', notes)):
+            if value is not None:
+                record[key] = (record[key] or 0) + int(value)
+        record['peak_memory_mb'] = peak_memory_mb()
+        if profiler:
+            if stage.name in self.profiles:
+                self.profiles[stage.name].add(profiler)
+            else:
+                self.profiles[stage.name] = pstats.Stats(profiler)
+
+    def records(self):
+        """One dict per stage with `METRIC_COLUMNS`, in the order stages were first run."""
+        records = []
+        for record in self.stages.values():
+            record = dict(record)
+            notes = record.pop('notes')
+            record['notes_per_sec'] = notes / record['wall_time'] if notes is not None and record['wall_time'] else None
+            records.append({col: record[col] for col in METRIC_COLUMNS})
+        return records
+
+    def summary(self):
+        """Totals for the whole run (so far)."""
+        return {
+            'wall_time': time.perf_counter() - self._start,
+            'cpu_time': time.process_time() - self._start_cpu,
+            'peak_memory_mb': peak_memory_mb(),
+        }
+
+    def log(self):
+        logger.info('Stage metrics: [stage: wall time, CPU time, rows in -> rows out, notes/sec, peak memory]')
+        for record in self.records():
+            logger.info(f'* {record["stage"]}: {record["wall_time"]:.2f}s, {record["cpu_time"]:.2f}s,'
+                        f' {record["rows_in"]} -> {record["rows_out"]},'
+                        f' {record["notes_per_sec"] or 0:.0f}/s, {record["peak_memory_mb"] or 0:.0f}MB')
+
+    def write(self, outpath, label):
+        """
+        Write `{label}.json` (summary and stages) and `{label}.csv` (stages) to `outpath`, and
+            a `profile_{stage}.prof` file for each stage if profiling.
+        """
+        records = self.records()
+        with open(outpath / f'{label}.json', 'w') as out:
+            json.dump({'summary': self.summary(), 'stages': records}, out, indent=2)
+        with open(outpath / f'{label}.csv', 'w', newline='') as out:
+            writer = csv.DictWriter(out, fieldnames=METRIC_COLUMNS)
+            writer.writeheader()
+            writer.writerows(records)
+        for name, stats in self.profiles.items():
+            stats.dump_stats(outpath / f'profile_{name}.prof')
+        logger.info(f'Wrote stage metrics to {outpath / label}.json/.csv'
+                    + (f' and {len(self.profiles)} profiles' if self.profiles else '') + '.')
+
+
+@contextlib.contextmanager
+def measure(metrics, name, rows_in=None, notes=None):
+    """Same as `metrics.stage`, but if `metrics` is None, the stage is not recorded."""
+    if metrics is None:
+        yield Stage(name, rows_in=rows_in, notes=notes)
+    else:
+        with metrics.stage(name, rows_in=rows_in, notes=notes) as stage:
+            yield stage
+
+
+def measure_iter(metrics, name, chunks):
+    """Yield from `chunks` (e.g., `iter_dataset`), recording the time taken to produce each chunk as stage `name`."""
+    chunks = iter(chunks)
+    while True:
+        with measure(metrics, name) as stage:
+            chunk = next(chunks, None)
+            if chunk is None:
+                stage.discard = True
+            else:
+                stage.rows_out = chunk.shape[0]
+        if chunk is None:
+            return
+        yield chunk
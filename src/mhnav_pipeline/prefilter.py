@@ -0,0 +1,208 @@
+"""
+Keyword prefilter to skip notes which cannot match any regular expression in the regex file.
+
+For each regular expression, a set of literal 'anchors' is extracted such that every match of the
+    regular expression must contain at least one of them. A note is only a candidate for bratdb-apply
+    if it contains at least one anchor from any regular expression. If a regular expression has no
+    extractable anchor, every note is treated as a candidate.
+
+Both anchors and note text are case-folded (see `normalize`), so that any (case-insensitive) match
+    of a literal in the regular expression is also a match of the normalized anchor in the normalized
+    text, and no note which could produce a hit is skipped.
+
+Uses `pyahocorasick` (if installed) to search all anchors at once; otherwise, falls back to a single
+    regular expression of alternated anchors.
+"""
+import re
+
+import numpy as np
+from loguru import logger
+
+from mhnav_pipeline.regexes import read_regex_file
+
+try:
+    from re import _parser as sre_parse  # python 3.11+
+    from re import _constants as sre_constants
+except ImportError:
+    import sre_parse
+    import sre_constants
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+# `str.casefold` alone does not equate all characters which `re.IGNORECASE` treats as equal:
+#   'I' also matches dotless 'ı' (U+0131) and 'İ' (U+0130), which casefolds to 'i' + U+0307
+_NORMALIZE_TABLE = {0x131: 'i', 0x307: None}
+
+_REPEATS = {sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT}
+if hasattr(sre_constants, 'POSSESSIVE_REPEAT'):  # python 3.11+
+    _REPEATS.add(sre_constants.POSSESSIVE_REPEAT)
+_ZERO_WIDTH = {sre_constants.AT}
+
+
+def normalize(text):
+    return text.casefold().translate(_NORMALIZE_TABLE)
+
+
+def _best(candidates):
+    """Choose the most selective anchor set: longest shortest anchor, then fewest anchors."""
+    candidates = [c for c in candidates if c and all(c)]
+    if not candidates:
+        return None
+    return max(candidates, key=lambda c: (min(len(a) for a in c), -len(c)))
+
+
+def _literal_set(op, av):
+    """Set of characters for a character class containing only literals (e.g., after `a|b` is optimized to `[ab]`)."""
+    if op == sre_constants.IN and all(item_op == sre_constants.LITERAL for item_op, _ in av):
+        return {chr(item_av) for _, item_av in av}
+    return None
+
+
+def _prefix_literals(parsed):
+    """
+    Find a set of literals, one of which must begin any match of the parsed pattern.
+
+    :return: set of literal strings or None if none could be determined
+    """
+    run = []
+    for op, av in parsed:
+        if op == sre_constants.LITERAL:
+            run.append(chr(av))
+            continue
+        if op in _ZERO_WIDTH:
+            continue
+        if op == sre_constants.SUBPATTERN:
+            prefixes = _prefix_literals(av[-1])
+        elif op == sre_constants.BRANCH:
+            branches = [_prefix_literals(branch) for branch in av[1]]
+            prefixes = set().union(*branches) if all(branches) else None
+        else:
+            prefixes = _literal_set(op, av)
+        if prefixes:
+            return {''.join(run) + prefix for prefix in prefixes}
+        break
+    return {''.join(run)} if run else None
+
+
+def _required_literals(parsed):
+    """
+    Find a set of literals, at least one of which must appear in any match of the parsed pattern.
+
+    :return: set of literal strings or None if none could be determined
+    """
+    candidates = []
+    run = []
+    for op, av in parsed:
+        if op == sre_constants.LITERAL:
+            run.append(chr(av))
+            continue
+        if op in _ZERO_WIDTH:  # does not consume text, so literal run continues
+            continue
+        if op == sre_constants.SUBPATTERN:
+            required = _required_literals(av[-1])
+            prefixes = _prefix_literals(av[-1])
+        elif op == sre_constants.BRANCH:
+            branches = [_required_literals(branch) for branch in av[1]]
+            required = set().union(*branches) if all(branches) else None
+            branches = [_prefix_literals(branch) for branch in av[1]]
+            prefixes = set().union(*branches) if all(branches) else None
+        elif op in _REPEATS:
+            min_repeat, _, item = av
+            required = _required_literals(item) if min_repeat >= 1 else None
+            prefixes = None
+        elif op == getattr(sre_constants, 'ATOMIC_GROUP', None):
+            required = _required_literals(av)
+            prefixes = _prefix_literals(av)
+        else:
+            required = prefixes = _literal_set(op, av)
+        if run:
+            if prefixes:  # e.g., `adhd|attention` is parsed as `a(?:dhd|ttention)`
+                candidates.append({''.join(run) + prefix for prefix in prefixes})
+            candidates.append({''.join(run)})
+            run = []
+        candidates.append(required)
+    if run:
+        candidates.append({''.join(run)})
+    return _best(candidates)
+
+
+def extract_anchors(regex_str):
+    """
+    Extract normalized literal anchors from a regular expression; any match must contain at least one.
+
+    :return: set of anchors or None if no anchors could be extracted
+    """
+    try:
+        literals = _required_literals(sre_parse.parse(regex_str))
+    except Exception as e:
+        logger.warning(f'Unable to parse regular expression for prefilter: {regex_str!r} ({e})')
+        return None
+    if literals is None:
+        return None
+    anchors = {normalize(literal) for literal in literals}
+    if not all(anchors):
+        return None
+    return anchors
+
+
+def minimize_anchors(anchors):
+    """Remove anchors containing a shorter anchor: any text containing the former also contains the latter."""
+    result = []
+    for anchor in sorted(anchors, key=lambda a: (len(a), a)):
+        if not any(other in anchor for other in result):
+            result.append(anchor)
+    return result
+
+
+class KeywordPrefilter:
+
+    def __init__(self, anchors):
+        """
+        :param anchors: iterable of (normalized) anchors or None if every note must be scanned
+        """
+        self.always_scan = anchors is None
+        self.anchors = [] if self.always_scan else minimize_anchors(anchors)
+        self._automaton = None
+        self._regex = None
+        if self.always_scan:
+            pass
+        elif ahocorasick is not None:
+            self._automaton = ahocorasick.Automaton()
+            for anchor in self.anchors:
+                self._automaton.add_word(anchor, anchor)
+            self._automaton.make_automaton()
+        else:
+            self._regex = re.compile('|'.join(re.escape(anchor) for anchor in self.anchors))
+
+    @classmethod
+    def from_regex_file(cls, regex_file):
+        anchors = set()
+        for concept, term, regex_str in read_regex_file(regex_file):
+            regex_anchors = extract_anchors(regex_str)
+            if regex_anchors is None:
+                logger.warning(f'No literal anchor for regex ({concept}, {term}): {regex_str!r};'
+                               f' prefilter will scan all notes.')
+                return cls(None)
+            anchors |= regex_anchors
+        prefilter = cls(anchors)
+        logger.info(f'Built prefilter with {len(prefilter.anchors)} anchors from {regex_file}.')
+        return prefilter
+
+    def is_candidate(self, text):
+        if self.always_scan:
+            return True
+        if not text:
+            return False
+        text = normalize(text)
+        if self._automaton is not None:
+            return next(self._automaton.iter(text), None) is not None
+        return self._regex.search(text) is not None
+
+    def candidate_mask(self, texts):
+        """Boolean array aligned with `texts` which is True for notes that must be run through bratdb-apply."""
+        if self.always_scan:
+            return np.ones(len(texts), dtype=bool)
+        return np.fromiter((self.is_candidate(text) for text in texts), dtype=bool, count=len(texts))
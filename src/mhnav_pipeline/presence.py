@@ -0,0 +1,123 @@
+"""
+Presence-only matching of historical notes.
+
+The historical data only contributes to nlp_positive (the number of distinct note dates with any hit for
+    each index encounter) and nlp_model (distinct concept_terms on each note date), so it is enough to know
+    whether each concept_term occurs on each (index_pat_enc_csn_id, note_date) rather than finding every
+    match of every regular expression in every note. Records are processed in the order of the full output and:
+    * each regular expression is searched for (first match only) rather than iterating over all matches
+    * a regular expression is skipped if all of its concept_terms have already been found on the date
+        (unless it is still unknown whether the date has any hit)
+    * a record is skipped entirely once its date has a hit and all concept_terms have been found
+
+Since only the first occurrence of each (index_pat_enc_csn_id, note_date, concept_term) is retained in
+    nlp_model, and these are found in the same order, the output tables are unchanged.
+
+Regular expressions are run directly (case-insensitive, as in bratdb-apply; see `regexes.RegexSet`) rather
+    than with bratdb-apply, and only in the main process. Not used with `include_context` (nlp_regex
+    requires every hit) or for index data (nlp_index includes every distinct capture).
+"""
+import numpy as np
+from loguru import logger
+
+from mhnav_pipeline.concept_terms import get_concept_term_rules, get_concept_terms
+from mhnav_pipeline.regexes import RegexSet
+
+# columns identifying a record's position in the output (see `build_datasets.order_like_merge`)
+RECORD_COLUMNS = ['studyid', 'pat_enc_csn_id', 'index_pat_enc_csn_id', 'start_date', 'end_date', 'note_date']
+
+
+class PresenceMatcher:
+
+    def __init__(self, regex_set, concept_term_rules=None):
+        """
+        :param regex_set: RegexSet
+        :param concept_term_rules: (optional) path to rules file or iterable of rules;
+            see `mhnav_pipeline.concept_terms`
+        """
+        rules = get_concept_term_rules(concept_term_rules)
+        self.patterns = [
+            (regex, tuple(get_concept_terms(concept, term, rules))) for concept, term, regex in regex_set.regexes
+        ]
+        self.concept_terms = {concept_term for _, concept_terms in self.patterns for concept_term in concept_terms}
+
+    @classmethod
+    def from_regex_file(cls, regex_file, concept_term_rules=None):
+        return cls(RegexSet.from_file(regex_file), concept_term_rules)
+
+    def _search(self, note_results, text, j):
+        """Whether pattern `j` matches `text` (searching only if not already in `note_results`)."""
+        if note_results[j] is None:
+            note_results[j] = self.patterns[j][0].search(text) is not None
+        return note_results[j]
+
+    def find(self, keys, excluded, note_positions, texts, candidates=None):
+        """
+        Find presence of hits and concept_terms for records in the order of the output.
+
+        :param keys: (index_pat_enc_csn_id, note_date) for each record
+        :param excluded: for each record, True if it only counts towards nlp_positive (i.e., index encounter notes)
+        :param note_positions: for each record, position of its (cleaned) note in `texts`
+        :param texts: distinct note texts
+        :param candidates: (optional) boolean array aligned with `texts`; False if a note cannot contain a hit
+        :return: positive_records (positions of records with a hit), concept_term_records (list of
+            (position, concept_term) for the first record with each concept_term for its key)
+        """
+        n_concept_terms = len(self.concept_terms)
+        found = {}  # key -> set of concept_terms
+        positive = set()  # keys with any hit
+        results = {}  # note position -> list of True/False/None (not yet searched) for each pattern
+        positive_records, concept_term_records = [], []
+        n_skipped = 0
+
+        for i, (key, is_excluded, note) in enumerate(zip(keys, excluded, note_positions)):
+            found_concept_terms = found.setdefault(key, set())
+            if key in positive and (is_excluded or len(found_concept_terms) == n_concept_terms):
+                n_skipped += 1
+                continue
+            if candidates is not None and not candidates[note]:
+                continue
+            text = texts[note]
+            note_results = results.setdefault(note, [None] * len(self.patterns))
+            has_hit = False
+            if not is_excluded:
+                for j, (_, concept_terms) in enumerate(self.patterns):
+                    new_concept_terms = [ct for ct in concept_terms if ct not in found_concept_terms]
+                    if new_concept_terms and self._search(note_results, text, j):
+                        has_hit = True
+                        found_concept_terms.update(new_concept_terms)
+                        concept_term_records.extend((i, ct) for ct in new_concept_terms)
+            if key not in positive and (
+                    has_hit or any(self._search(note_results, text, j) for j in range(len(self.patterns)))):
+                positive.add(key)
+                positive_records.append(i)
+
+        n_searches = sum(result is not None for note_results in results.values() for result in note_results)
+        logger.info(f'Presence-only matching: skipped {n_skipped} of {len(keys)} records; ran {n_searches}'
+                    f' of {len(results) * len(self.patterns)} searches on {len(results)} notes.')
+        return positive_records, concept_term_records
+
+    def apply(self, df, note_df, note_index, prefilter=None):
+        """
+        Find presence of hits and concept_terms in (cleaned) historical data.
+
+        :param df: historical records
+        :param note_df: distinct (cleaned) notes in `df` (see `deduplicate_notes`)
+        :param note_index: position in `note_df` for each record in `df`
+        :param prefilter: (optional) KeywordPrefilter to skip notes which cannot match
+        :return: res_df2 (studyid, index_pat_enc_csn_id, note_date for records with a hit) and
+            ct_df2 (index_pat_enc_csn_id, note_date, concept_term), as returned by `process_historical_data`
+        """
+        order = np.argsort(df.groupby(RECORD_COLUMNS, sort=False, dropna=False).ngroup().to_numpy(), kind='stable')
+        keys = list(zip(df['index_pat_enc_csn_id'].to_numpy()[order], df['note_date'].to_numpy()[order]))
+        excluded = (df['pat_enc_csn_id'].to_numpy() == df['index_pat_enc_csn_id'].to_numpy())[order]
+        candidates = prefilter.candidate_mask(note_df['note_text']) if prefilter else None
+        positive_records, concept_term_records = self.find(
+            keys, excluded, note_index[order], note_df['note_text'].tolist(), candidates
+        )
+        res_df2 = df[['studyid', 'index_pat_enc_csn_id', 'note_date']].iloc[order[positive_records]]
+        ct_positions = np.array([position for position, _ in concept_term_records], dtype=np.int64)
+        ct_df2 = df[['index_pat_enc_csn_id', 'note_date']].iloc[order[ct_positions]].assign(
+            concept_term=[concept_term for _, concept_term in concept_term_records]
+        )
+        return res_df2, ct_df2
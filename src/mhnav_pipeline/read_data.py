@@ -1,32 +1,262 @@
 import pandas as pd
+import sqlalchemy as sa
 from loguru import logger
 
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
 
-def read_dataset(dataset, *extra_cols, engine=None):
+# maximum number of values in a single `IN (...)` clause (MS SQL Server supports at most 2100 parameters)
+FILTER_BATCH_SIZE = 1000
+# number of records to read at a time when filtering a file
+FILTER_CHUNKSIZE = 100_000
+PARQUET_EXTENSIONS = ('parquet', 'pq')
+ARROW_EXTENSIONS = ('arrow', 'feather', 'ipc')
+# columns of a notes table (see `build_datasets.assign_notes_to_windows`)
+NOTE_COLUMNS = frozenset({'studyid', 'note_text', 'pat_enc_csn_id', 'note_date'})
+# columns of index and historical datasets
+DATASET_COLUMNS = NOTE_COLUMNS | {'start_date', 'end_date'}
+
+
+def read_dataset(dataset, *extra_cols, engine=None, filter_col=None, filter_values=None, columns=DATASET_COLUMNS):
+    """
+    Read and validate dataset.
+
+    :param columns: expected columns (in addition to `extra_cols`); e.g., `NOTE_COLUMNS` for a notes table
+
+    :param filter_col: (optional) only retain records where this column has one of `filter_values`;
+        databases apply the filter server-side and files are filtered while streaming, so excluded
+        records are never loaded into memory at once
+    :param filter_values: values of `filter_col` to retain
+    """
     logger.info(f'Loading dataset: {dataset if not isinstance(dataset, pd.DataFrame) else "DataFrame"}')
+    if filter_col is not None:
+        chunks = [
+            chunk for chunk in _iter_chunks(
+                dataset, *extra_cols, engine=engine, chunksize=FILTER_CHUNKSIZE,
+                filter_col=filter_col, filter_values=filter_values, columns=columns,
+            ) if chunk.shape[0] > 0
+        ]
+        if not chunks:
+            return pd.DataFrame(columns=list(expected_columns(*extra_cols, columns=columns)))
+        return pd.concat(chunks)
     if engine:
-        return validate_headers(pd.read_sql_table(dataset, con=engine), *extra_cols)
+        return validate_headers(pd.read_sql_table(dataset, con=engine), *extra_cols, copy=False, columns=columns)
     elif isinstance(dataset, pd.DataFrame):
-        return validate_headers(dataset, *extra_cols)
+        return validate_headers(dataset, *extra_cols, columns=columns)
     elif str(dataset).endswith('csv'):
-        return validate_headers(pd.read_csv(dataset), *extra_cols)
+        return validate_headers(pd.read_csv(dataset, usecols=_usecols(*extra_cols, columns=columns)), *extra_cols,
+                                copy=False, columns=columns)
     elif str(dataset).endswith('sas7bdat'):
-        return validate_headers(pd.read_sas(dataset), *extra_cols)
+        return validate_headers(pd.read_sas(dataset), *extra_cols, copy=False, columns=columns)
+    elif str(dataset).endswith(PARQUET_EXTENSIONS + ARROW_EXTENSIONS):
+        return validate_headers(_arrow_to_pandas(read_arrow_table(dataset, *extra_cols, columns=columns)),
+                                *extra_cols, copy=False, columns=columns)
     else:
         e = ValueError(f'Unrecognized filetype: {dataset}')
         logger.exception(e)
         raise e
 
 
-def validate_headers(df, *extra_cols):
-    df.columns = [col.lower() for col in df.columns]
-    columns = set(df.columns)
-    exp_columns = {'studyid', 'note_text', 'pat_enc_csn_id', 'start_date', 'end_date', 'note_date'}
+def iter_dataset(dataset, *extra_cols, engine=None, chunksize=100_000, filter_col=None, filter_values=None,
+                 columns=DATASET_COLUMNS):
+    """
+    Read dataset in chunks of roughly `chunksize` records, yielding validated DataFrames.
+
+    Chunks are re-cut so that all records for a `studyid` land in the same chunk (as long as
+        the source is ordered by `studyid`); see `align_chunks`.
+
+    :param filter_col: (optional) only retain records where this column has one of `filter_values`;
+        see `read_dataset`
+    :param filter_values: values of `filter_col` to retain
+    :param columns: expected columns (in addition to `extra_cols`); see `read_dataset`
+    """
+    logger.info(f'Loading dataset in chunks of {chunksize}:'
+                f' {dataset if not isinstance(dataset, pd.DataFrame) else "DataFrame"}')
+    yield from align_chunks(_iter_chunks(
+        dataset, *extra_cols, engine=engine, chunksize=chunksize,
+        filter_col=filter_col, filter_values=filter_values, columns=columns,
+    ))
+
+
+def _iter_chunks(dataset, *extra_cols, engine=None, chunksize=100_000, filter_col=None, filter_values=None,
+                 columns=DATASET_COLUMNS):
+    if engine and filter_col is not None:
+        chunks = read_sql_table_filtered(dataset, engine, filter_col, filter_values, chunksize=chunksize)
+    elif engine:
+        chunks = pd.read_sql_table(dataset, con=engine, chunksize=chunksize)
+    elif isinstance(dataset, pd.DataFrame):
+        chunks = (dataset.iloc[i:i + chunksize] for i in range(0, dataset.shape[0], chunksize))
+    elif str(dataset).endswith('csv'):
+        chunks = pd.read_csv(dataset, chunksize=chunksize, usecols=_usecols(*extra_cols, columns=columns))
+    elif str(dataset).endswith('sas7bdat'):
+        chunks = pd.read_sas(dataset, chunksize=chunksize)
+    elif str(dataset).endswith(PARQUET_EXTENSIONS + ARROW_EXTENSIONS):
+        chunks = (_arrow_to_pandas(batch) for batch in iter_arrow_batches(dataset, *extra_cols, chunksize=chunksize,
+                                                                          columns=columns))
+    else:
+        e = ValueError(f'Unrecognized filetype: {dataset}')
+        logger.exception(e)
+        raise e
+    offset = 0
+    for chunk in chunks:
+        # slices of an in-memory DataFrame must be copied since text is cleaned in place
+        chunk = validate_headers(chunk, *extra_cols, copy=isinstance(dataset, pd.DataFrame), columns=columns)
+        # bratdb-apply results are joined on index, so labels must be unique across chunks
+        chunk.index = pd.RangeIndex(offset, offset + chunk.shape[0])
+        offset += chunk.shape[0]
+        if filter_col is not None and not engine:
+            chunk = chunk[chunk[filter_col].isin(filter_values)].copy()
+        yield chunk
+
+
+def read_sql_table_filtered(tablename, engine, filter_col, filter_values, chunksize=None, order_col='studyid'):
+    """
+    Select only records from a database table where `filter_col` is in `filter_values`, running
+        one `WHERE filter_col IN (...)` query for each batch of `FILTER_BATCH_SIZE` values.
+
+    Records are returned ordered by `order_col` (`iter_dataset` requires the records for each `studyid` to be
+        contiguous): the values are sorted by the `order_col` of their records, so that the batches cover
+        consecutive ranges of `order_col`, and each batch is ordered by `order_col` (and then `filter_col`).
+    """
+    table = sa.Table(tablename, sa.MetaData(), autoload_with=engine)
+    column = _find_column(table, filter_col)
+    order_column = _find_column(table, order_col)
+    values = [value.item() if hasattr(value, 'item') else value for value in pd.unique(pd.Series(filter_values))]
+    if not values:
+        yield pd.DataFrame(columns=[col.name for col in table.columns])
+        return
+    logger.info(f'Selecting records from {tablename} for {len(values)} values of {filter_col}.')
+    values = _sort_filter_values(engine, column, order_column, values)
+    order_by = [order_column] if order_column is column else [order_column, column]
+    for i in range(0, len(values), FILTER_BATCH_SIZE):
+        query = sa.select(table).where(column.in_(values[i:i + FILTER_BATCH_SIZE])).order_by(*order_by)
+        if chunksize:
+            yield from pd.read_sql(query, con=engine, chunksize=chunksize)
+        else:
+            yield pd.read_sql(query, con=engine)
+
+
+def _find_column(table, name):
+    column = next((col for col in table.columns if col.name.lower() == name), None)
+    if column is None:
+        e = ValueError(f'Dataset missing columns: {name}')
+        logger.exception(e)
+        raise e
+    return column
+
+
+def _sort_filter_values(engine, column, order_column, values):
+    """Sort values of `column` by the (first) value of `order_column` of their records (dropping values without any)."""
+    if order_column is column:
+        return sorted(values)
+    orders = {}
+    with engine.connect() as conn:
+        for i in range(0, len(values), FILTER_BATCH_SIZE):
+            query = sa.select(column, sa.func.min(order_column)).where(
+                column.in_(values[i:i + FILTER_BATCH_SIZE])
+            ).group_by(column)
+            orders.update(conn.execute(query).all())
+    return sorted(orders, key=lambda value: (orders[value], value))
+
+
+def _usecols(*extra_cols, columns=DATASET_COLUMNS):
+    """Only parse the expected columns from a CSV file (matched case-insensitively)."""
+    exp_columns = expected_columns(*extra_cols, columns=columns)
+    return lambda col: col.lower() in exp_columns
+
+
+def _require_pyarrow(dataset):
+    if pa is None:
+        e = ValueError(f'pyarrow is required to read {dataset}: install with `pip install .[parquet]`')
+        logger.exception(e)
+        raise e
+
+
+def _arrow_columns(names, *extra_cols, columns=DATASET_COLUMNS):
+    """Names of the expected columns in an Arrow schema (matched case-insensitively)."""
+    exp_columns = expected_columns(*extra_cols, columns=columns)
+    return [name for name in names if name.lower() in exp_columns]
+
+
+def _arrow_to_pandas(table):
+    """Convert Arrow table/record batch, keeping dates as datetime64 rather than python objects."""
+    return table.to_pandas(date_as_object=False)
+
+
+def read_arrow_table(dataset, *extra_cols, columns=DATASET_COLUMNS):
+    """
+    Read only the expected columns from a Parquet or Arrow IPC (Feather v2) file. Columns are decoded
+        using the types stored in the file (e.g., dates and integer ids need no parsing).
+
+    :return: pyarrow.Table
+    """
+    _require_pyarrow(dataset)
+    if str(dataset).endswith(PARQUET_EXTENSIONS):
+        parquet_file = pq.ParquetFile(dataset)
+        return parquet_file.read(columns=_arrow_columns(parquet_file.schema_arrow.names, *extra_cols, columns=columns))
+    with pa.memory_map(str(dataset)) as source:
+        table = pa.ipc.open_file(source).read_all()
+    return table.select(_arrow_columns(table.schema.names, *extra_cols, columns=columns))
+
+
+def iter_arrow_batches(dataset, *extra_cols, chunksize=100_000, columns=DATASET_COLUMNS):
+    """Read only the expected columns from a Parquet or Arrow IPC file in record batches of at most `chunksize`."""
+    _require_pyarrow(dataset)
+    if str(dataset).endswith(PARQUET_EXTENSIONS):
+        parquet_file = pq.ParquetFile(dataset)
+        yield from parquet_file.iter_batches(
+            batch_size=chunksize, columns=_arrow_columns(parquet_file.schema_arrow.names, *extra_cols, columns=columns)
+        )
+    else:  # memory-mapped, so batches are only read as they are converted
+        yield from read_arrow_table(dataset, *extra_cols, columns=columns).to_batches(max_chunksize=chunksize)
+
+
+def align_chunks(chunks, key='studyid'):
+    """
+    Carry the records of the last `key` in each chunk over into the following chunk so that
+        a patient is never split across two chunks (assuming input is grouped by `key`).
+    """
+    carry = None
+    for chunk in chunks:
+        if carry is not None:
+            chunk = pd.concat((carry, chunk))
+        if chunk.shape[0] == 0:
+            continue
+        mask = chunk[key] == chunk[key].iloc[-1]
+        carry = chunk[mask]
+        chunk = chunk[~mask]
+        if chunk.shape[0] > 0:
+            yield chunk
+    if carry is not None and carry.shape[0] > 0:
+        yield carry
+
+
+def expected_columns(*extra_cols, columns=DATASET_COLUMNS):
+    exp_columns = set(columns)
     if extra_cols:
         exp_columns |= set(extra_cols)
-    missing = exp_columns - columns
+    return exp_columns
+
+
+def validate_headers(df, *extra_cols, copy=True, columns=DATASET_COLUMNS):
+    """
+    Lowercase column names, ensure all expected columns are present, and drop the others.
+
+    :param columns: expected columns (in addition to `extra_cols`); see `read_dataset`
+    :param copy: if False, `df` is returned as-is when it only contains the expected columns
+        (e.g., when columns were selected while reading); set to False only if `df` is not used elsewhere
+    """
+    df.columns = [col.lower() for col in df.columns]
+    exp_columns = expected_columns(*extra_cols, columns=columns)
+    missing = exp_columns - set(df.columns)
     if missing:
         e = ValueError(f'Dataset missing columns: {", ".join(missing)}')
         logger.exception(e)
         raise e
+    if not copy and len(df.columns) == len(exp_columns):
+        return df
     return df[list(exp_columns)].copy()
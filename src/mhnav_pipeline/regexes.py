@@ -0,0 +1,59 @@
+"""
+Reading the regular expression file used by bratdb-apply.
+
+The file is tab-separated with one regular expression per line: concept, term, regex.
+"""
+import re
+
+from loguru import logger
+
+
+def read_regex_file(regex_file):
+    """
+    Read bratdb regex file.
+
+    :return: list of (concept, term, regex_str)
+    """
+    regexes = []
+    with open(regex_file, encoding='utf8') as fh:
+        for i, line in enumerate(fh, start=1):
+            if not line.strip():
+                continue
+            row = line.rstrip('\r\n').split('\t')
+            if len(row) < 3:
+                e = ValueError(f'Expected concept, term, and regex on line {i} of {regex_file}: {line!r}')
+                logger.exception(e)
+                raise e
+            concept, term, regex_str = row[:3]
+            regexes.append((concept, term, regex_str))
+    return regexes
+
+
+class RegexSet:
+    """
+    Compiled regular expressions from a regex file, for matching individual notes without bratdb-apply
+        (e.g., in the scoring service) so that the file is only read and compiled once.
+
+    As with bratdb-apply, matching is case-insensitive and hits are yielded for each regular expression
+        (in the order of the file) and then each of its (non-overlapping) matches.
+    """
+
+    def __init__(self, regexes):
+        """
+        :param regexes: list of (concept, term, regex_str)
+        """
+        self.regexes = [(concept, term, re.compile(regex_str, re.I)) for concept, term, regex_str in regexes]
+
+    @classmethod
+    def from_file(cls, regex_file):
+        regex_set = cls(read_regex_file(regex_file))
+        logger.info(f'Compiled {len(regex_set.regexes)} regular expressions from {regex_file}.')
+        return regex_set
+
+    def finditer(self, text):
+        """
+        :return: iterator of (concept, term, capture)
+        """
+        for concept, term, regex in self.regexes:
+            for m in regex.finditer(text):
+                yield concept, term, m.group()
@@ -0,0 +1,148 @@
+"""
+Scoring of a single index encounter (and its historical notes) without building dataframes.
+
+Produces the same `nlp_positive`, `nlp_model`, and `nlp_index` records for the encounter as `build_datasets`,
+    but with the regex file, cleaning rules, and concept_term rules loaded once (see `EncounterScorer`),
+    so that each encounter can be scored in milliseconds (e.g., by the scoring service in `service.py`).
+
+An encounter is a dict (e.g., parsed from JSON) with:
+    * studyid
+    * pat_enc_csn_id
+    * index_notes: list of {note_date, note_text}
+    * historical_notes: list of {pat_enc_csn_id, note_date, note_text} from the year before the encounter
+
+Ids are integers or strings, and dates and note text are strings (see `validate_encounter`). Dates are
+    returned as they were given.
+"""
+from loguru import logger
+
+from mhnav_pipeline.cleaning_rules import CleaningRuleSet
+from mhnav_pipeline.concept_terms import get_concept_term_rules, get_concept_terms
+from mhnav_pipeline.regexes import RegexSet
+
+TABLE_NAMES = ('nlp_positive', 'nlp_model', 'nlp_index')
+# types of pat_enc_csn_id in an encounter
+ID_TYPES = (int, str)
+
+
+def _group_order(notes, key):
+    """
+    Order notes by the first note with the same `key` (stable), as records are ordered after
+        merging hits with their dataset (see `build_datasets.order_like_merge`).
+    """
+    groups = {}
+    return sorted(notes, key=lambda note: groups.setdefault(key(note), len(groups)))
+
+
+def _invalid(message):
+    e = ValueError(message)
+    logger.exception(e)
+    raise e
+
+
+def _require(records, label='encounter', **keys):
+    """Ensure each record is an object with `keys` (name -> type(s) of value)."""
+    for record in records:
+        if not isinstance(record, dict):
+            _invalid(f'Expected a JSON object for the {label}, not: {type(record).__name__}')
+        missing = [key for key in keys if key not in record]
+        if missing:
+            _invalid(f'The {label} is missing the following required keys: {", ".join(missing)}')
+        for key, types in keys.items():
+            if not isinstance(record[key], types) or isinstance(record[key], bool):
+                _invalid(f'The {label} has an invalid value for {key}: {record[key]!r}')
+
+
+def validate_encounter(encounter):
+    """Ensure an encounter (e.g., parsed from a request) has the keys, and types of values, used by `score`."""
+    _require([encounter], pat_enc_csn_id=ID_TYPES, index_notes=list, historical_notes=list)
+    _require(encounter['index_notes'], note_date=str, note_text=str, label='index note')
+    _require(encounter['historical_notes'], pat_enc_csn_id=ID_TYPES, note_date=str, note_text=str,
+             label='historical note')
+
+
+class EncounterScorer:
+
+    def __init__(self, regex_file, concept_term_rules=None, cleaning_rules=None):
+        """
+        :param concept_term_rules: (optional) path to rules file or iterable of rules;
+            see `mhnav_pipeline.concept_terms`
+        :param cleaning_rules: (optional) path to rules file or CleaningRuleSet to use instead of `local/cleaning.py`
+        """
+        self.regexes = RegexSet.from_file(regex_file)
+        self.concept_term_rules = get_concept_term_rules(concept_term_rules)
+        if cleaning_rules is None:
+            from mhnav_pipeline.local.cleaning import clean_text
+            self.clean_text = clean_text
+        elif isinstance(cleaning_rules, CleaningRuleSet):
+            self.clean_text = cleaning_rules.clean_text
+        else:
+            self.clean_text = CleaningRuleSet.from_file(cleaning_rules).clean_text
+        self._concept_terms = {}
+
+    def concept_terms(self, concept, term):
+        key = (concept, term)
+        if key not in self._concept_terms:
+            self._concept_terms[key] = get_concept_terms(concept, term, self.concept_term_rules)
+        return self._concept_terms[key]
+
+    def find_hits(self, text):
+        """
+        Clean the note and run the regular expressions.
+
+        :return: list of (concept_terms, capture) for each hit (concept_terms may be empty)
+        """
+        return [
+            (self.concept_terms(concept, term), capture)
+            for concept, term, capture in self.regexes.finditer(self.clean_text(text))
+        ]
+
+    def score(self, encounter):
+        """
+        Build the output records for a single index encounter.
+
+        As in `build_datasets`, if no index note has a hit which maps to a concept_term, the historical
+            notes are not processed and all tables are empty.
+
+        :return: dict of table name -> list of records (dicts)
+        """
+        validate_encounter(encounter)
+        enc_id = encounter['pat_enc_csn_id']
+        tables = {name: [] for name in TABLE_NAMES}
+
+        # index notes
+        nlp_index = {}
+        for note in _group_order(encounter['index_notes'], lambda note: note['note_date']):
+            for concept_terms, capture in self.find_hits(note['note_text']):
+                for concept_term in concept_terms:
+                    nlp_index.setdefault((note['note_date'], concept_term, capture), None)
+        if not nlp_index:  # encounter not retained
+            return tables
+        tables['nlp_index'] = [
+            {'pat_enc_csn_id': enc_id, 'note_date': note_date, 'concept_term': concept_term, 'text_string': capture}
+            for note_date, concept_term, capture in nlp_index
+        ]
+
+        # historical notes
+        historical_notes = _group_order(
+            encounter['historical_notes'], lambda note: (note['pat_enc_csn_id'], note['note_date'])
+        )
+        if not historical_notes:
+            return tables
+        positive_dates = set()
+        nlp_model = {}
+        for note in historical_notes:
+            hits = self.find_hits(note['note_text'])
+            if hits:
+                positive_dates.add(note['note_date'])
+            if note['pat_enc_csn_id'] == enc_id:  # see `build_datasets.remove_index_dates`
+                continue
+            for concept_terms, _ in hits:
+                for concept_term in concept_terms:
+                    nlp_model.setdefault((note['note_date'], concept_term), None)
+        tables['nlp_positive'] = [{'pat_enc_csn_id': enc_id, 'note_count': len(positive_dates)}]
+        tables['nlp_model'] = [
+            {'index_pat_enc_csn_id': enc_id, 'note_date': note_date, 'concept_term': concept_term}
+            for note_date, concept_term in nlp_model
+        ]
+        return tables
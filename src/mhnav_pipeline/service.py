@@ -0,0 +1,145 @@
+"""
+Long-running scoring service: load the regex file and cleaning rules once, then score individual
+    index encounters on request (see `mhnav_pipeline.scoring`).
+
+Listens on a local TCP port or a Unix socket. Endpoints:
+    * `POST /score`: body is a JSON encounter (see `mhnav_pipeline.scoring`); response is a JSON object
+        with the encounter's records for each of `nlp_positive`, `nlp_model`, and `nlp_index`, or
+        400 with `{"error": ...}` if the body is not a valid encounter
+    * `GET /health`: returns `{"status": "ok"}` once the service is ready
+
+Connections are kept alive (HTTP/1.1), so a client scoring many encounters only connects once.
+
+    run-mhnav-service --regex-file regexes.tsv --port 8765
+    curl -X POST --data @encounter.json http://127.0.0.1:8765/score
+"""
+import json
+import os
+import pathlib
+import socket
+import socketserver
+import time
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from loguru import logger
+
+from mhnav_pipeline.scoring import EncounterScorer, validate_encounter
+
+
+class ScoringRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep connections alive between requests
+
+    def setup(self):
+        # headers and body are written separately, so don't delay the body waiting for an ACK (TCP only)
+        self.disable_nagle_algorithm = self.server.address_family != socket.AF_UNIX
+        super().setup()
+
+    def _send_json(self, status, data):
+        body = json.dumps(data).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._send_json(HTTPStatus.OK, {'status': 'ok'})
+        else:
+            self._send_json(HTTPStatus.NOT_FOUND, {'error': f'Unknown path: {self.path}'})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path != '/score':
+            self._send_json(HTTPStatus.NOT_FOUND, {'error': f'Unknown path: {self.path}'})
+            return
+        start = time.perf_counter()
+        try:
+            encounter = json.loads(body)
+            validate_encounter(encounter)
+        except ValueError as e:  # includes invalid JSON
+            self._send_json(HTTPStatus.BAD_REQUEST, {'error': str(e)})
+            return
+        try:
+            tables = self.server.scorer.score(encounter)
+        except Exception as e:  # always respond, so that the client is not left waiting
+            logger.exception(e)
+            self._send_json(HTTPStatus.INTERNAL_SERVER_ERROR, {'error': f'Failed to score encounter: {e}'})
+            return
+        self._send_json(HTTPStatus.OK, tables)
+        logger.debug(f'Scored encounter {encounter["pat_enc_csn_id"]}'
+                     f' in {(time.perf_counter() - start) * 1000:.1f}ms.')
+
+    def log_message(self, format, *args):
+        logger.debug(f'{self.command} {self.path}: ' + format % args)
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def create_server(scorer, host='127.0.0.1', port=8765, socket_path=None):
+    """
+    Create (but do not start) a server for `scorer`; call `serve_forever` to handle requests.
+
+    :param port: TCP port on `host` (0 to choose an available port)
+    :param socket_path: (optional) listen on this Unix socket instead of a TCP port
+    """
+    if socket_path:
+        socket_path = pathlib.Path(socket_path)
+        if socket_path.exists():
+            socket_path.unlink()
+        server = ThreadingUnixHTTPServer(str(socket_path), ScoringRequestHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), ScoringRequestHandler)
+    server.scorer = scorer
+    return server
+
+
+def serve(regex_file, *, concept_term_file=None, cleaning_rules=None, host='127.0.0.1', port=8765,
+          socket_path=None):
+    """
+    Load the regex file and rules, then serve requests until interrupted.
+
+    :param concept_term_file: (optional) tab-separated file of rules mapping bratdb concept/term
+        to concept_term; see `mhnav_pipeline.concept_terms`
+    :param cleaning_rules: (optional) tab-separated file of exclusion/replacement rules to clean text with
+        instead of `local/cleaning.py`; see `mhnav_pipeline.cleaning_rules`
+    """
+    scorer = EncounterScorer(regex_file, concept_term_rules=concept_term_file, cleaning_rules=cleaning_rules)
+    server = create_server(scorer, host=host, port=port, socket_path=socket_path)
+    logger.info(f'Scoring service listening on {socket_path or f"http://{host}:{server.server_address[1]}"}.')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info('Stopping scoring service.')
+    finally:
+        server.server_close()
+        if socket_path and os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+
+def run():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Serve scoring of individual index encounters.')
+    parser.add_argument('-r', '--regex-file', dest='regex_file', required=True, type=pathlib.Path,
+                        help='Full path to regex file for running bratdb-apply.')
+    parser.add_argument('--concept-term-file', dest='concept_term_file', required=False, default=None,
+                        type=pathlib.Path,
+                        help='Tab-separated file of rules (field, value, concept_term) mapping bratdb'
+                             ' concept/term to concept_term. Defaults to the built-in rules.')
+    parser.add_argument('--cleaning-rules', dest='cleaning_rules', required=False, default=None, type=pathlib.Path,
+                        help='Tab-separated file of text cleaning rules (`exclude<TAB>phrase` or'
+                             ' `replace<TAB>pattern`) to use instead of `local/cleaning.py`.')
+    parser.add_argument('--host', dest='host', default='127.0.0.1',
+                        help='Address to listen on (default: localhost only).')
+    parser.add_argument('--port', dest='port', default=8765, type=int)
+    parser.add_argument('--socket', dest='socket_path', default=None, type=pathlib.Path,
+                        help='Listen on this Unix socket rather than a TCP port.')
+    serve(**vars(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    run()
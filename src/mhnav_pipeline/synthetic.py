@@ -0,0 +1,151 @@
+"""
+Synthetic index and historical datasets (no PHI) for testing and benchmarking the pipeline.
+
+Each patient has `encounters_per_patient` index encounters within six months of each other, and a
+    history of notes spread over the year before them. Each index encounter's historical records are
+    the notes in its window (365 to 1 days before the encounter), so, as in real data, notes are
+    repeated for each index encounter whose window contains them.
+
+Notes are random filler words, with probability `hit_rate` of containing a phrase matched by the
+    synthetic regex file (`SYNTHETIC_REGEX_FILE`).
+"""
+import pathlib
+
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+from mhnav_pipeline.write_data import write_file, OUTPUT_FORMATS
+
+SYNTHETIC_REGEX_FILE = pathlib.Path(__file__).parent / 'data' / 'synthetic_regexes.tsv'
+
+# each phrase is matched by a regular expression in `SYNTHETIC_REGEX_FILE`
+HIT_PHRASES = [
+    'depressed', 'depression', 'anxious', 'anxiety', 'adhd', 'attention deficit', 'suicidal', 'angry',
+    'oppositional', 'bullied', 'failing grades', 'substance use', 'referred to counseling', 'psych meds',
+]
+# words not matched by any regular expression in `SYNTHETIC_REGEX_FILE`
+FILLER_WORDS = [
+    'patient', 'presents', 'with', 'mother', 'for', 'follow', 'up', 'of', 'cough', 'fever', 'rash', 'ear',
+    'pain', 'well', 'child', 'visit', 'vaccines', 'given', 'today', 'exam', 'normal', 'lungs', 'clear',
+    'heart', 'regular', 'rate', 'rhythm', 'no', 'murmur', 'abdomen', 'soft', 'nontender', 'plan', 'return',
+    'if', 'worse', 'growth', 'appropriate', 'sleep', 'diet', 'reviewed', 'the', 'and', 'is', 'was', 'a',
+]
+
+INDEX_COLUMNS = ['studyid', 'pat_enc_csn_id', 'note_date', 'note_text', 'start_date', 'end_date']
+HISTORICAL_COLUMNS = ['studyid', 'index_pat_enc_csn_id', 'pat_enc_csn_id', 'note_date', 'note_text',
+                      'start_date', 'end_date']
+
+
+def generate_notes(rng, n_notes, note_length=100, hit_rate=0.2):
+    """
+    :param note_length: number of words in each note
+    :param hit_rate: probability of each note including a phrase from `HIT_PHRASES`
+    """
+    words = np.array(FILLER_WORDS, dtype=object)[rng.integers(len(FILLER_WORDS), size=(n_notes, note_length))]
+    hits = np.flatnonzero(rng.random(n_notes) < hit_rate)
+    words[hits, rng.integers(note_length, size=hits.shape[0])] = np.array(HIT_PHRASES, dtype=object)[
+        rng.integers(len(HIT_PHRASES), size=hits.shape[0])
+    ]
+    return [' '.join(note) for note in words]
+
+
+def _format_dates(dates):
+    return pd.to_datetime(np.asarray(dates), unit='D').strftime('%Y-%m-%d').tolist()
+
+
+def generate_datasets(n_patients=100, encounters_per_patient=2, notes_per_window=5, note_length=100,
+                      hit_rate=0.2, index_notes_per_encounter=1, seed=0):
+    """
+    Generate index and historical datasets with the columns expected by `read_data.validate_headers`,
+        ordered by `studyid`.
+
+    :param n_patients: number of patients
+    :param encounters_per_patient: number of index encounters for each patient
+    :param notes_per_window: average number of historical notes in each index encounter's window
+    :param note_length: number of words in each note
+    :param hit_rate: probability of each note containing a phrase matched by `SYNTHETIC_REGEX_FILE`
+    :param index_notes_per_encounter: number of notes for each index encounter
+    :param seed: random seed; the same arguments always produce the same datasets
+    :return: index_df, historical_df
+    """
+    rng = np.random.default_rng(seed)
+    first_date = (pd.Timestamp('2021-01-01') - pd.Timestamp(0)).days
+    index_records, historical_records = [], []
+    encounter_id, history_id = 0, 0
+    for studyid in range(1, n_patients + 1):
+        encounter_dates = np.sort(first_date + rng.integers(0, 180, size=encounters_per_patient))
+        encounter_ids = encounter_id + np.arange(1, encounters_per_patient + 1)
+        encounter_id += encounters_per_patient
+        for enc_id, enc_date in zip(encounter_ids, encounter_dates):
+            index_records.extend(
+                (studyid, enc_id, enc_date, enc_date - 365, enc_date - 1) for _ in range(index_notes_per_encounter)
+            )
+        # notes from over the year before each encounter: approximately `notes_per_window` in each window
+        history_start, history_end = encounter_dates[0] - 365, encounter_dates[-1] - 1
+        n_history = rng.poisson(notes_per_window * (history_end - history_start + 1) / 365)
+        history_dates = np.sort(rng.integers(history_start, history_end + 1, size=n_history))
+        history_ids = history_id + np.arange(n_history)
+        history_id += n_history
+        for position, (hist_id, note_date) in enumerate(zip(history_ids, history_dates)):
+            for enc_id, enc_date in zip(encounter_ids, encounter_dates):
+                if enc_date - 365 <= note_date <= enc_date - 1:
+                    historical_records.append((studyid, enc_id, hist_id, note_date, position, enc_date - 365,
+                                               enc_date - 1))
+
+    index_df = pd.DataFrame(index_records, columns=['studyid', 'pat_enc_csn_id', 'note_date', 'start_date',
+                                                    'end_date'])
+    index_df['note_text'] = generate_notes(rng, index_df.shape[0], note_length, hit_rate)
+    historical_df = pd.DataFrame(historical_records, columns=['studyid', 'index_pat_enc_csn_id', 'pat_enc_csn_id',
+                                                              'note_date', 'position', 'start_date', 'end_date'])
+    # a note repeated for several index encounters has the same text
+    notes = historical_df[['studyid', 'position']].drop_duplicates()
+    notes['note_text'] = generate_notes(rng, notes.shape[0], note_length, hit_rate)
+    historical_df = pd.merge(historical_df, notes, on=['studyid', 'position']).drop(columns='position')
+    historical_df['pat_enc_csn_id'] += encounter_id + 1  # distinct from index encounters
+    for df in (index_df, historical_df):
+        for col in ('note_date', 'start_date', 'end_date'):
+            df[col] = _format_dates(df[col])
+    logger.info(f'Generated {index_df.shape[0]} index and {historical_df.shape[0]} historical records'
+                f' for {n_patients} patients.')
+    return index_df[INDEX_COLUMNS], historical_df[HISTORICAL_COLUMNS]
+
+
+def write_datasets(outpath, output_format='csv', **kwargs):
+    """
+    Generate datasets and write `index.{output_format}` and `historical.{output_format}` to `outpath`.
+
+    :param output_format: 'csv' or 'parquet'
+    :param kwargs: passed to `generate_datasets`
+    :return: paths of index and historical datasets
+    """
+    outpath = pathlib.Path(outpath)
+    outpath.mkdir(exist_ok=True, parents=True)
+    index_df, historical_df = generate_datasets(**kwargs)
+    write_file(index_df, outpath / 'index', output_format)
+    write_file(historical_df, outpath / 'historical', output_format)
+    return outpath / f'index.{output_format}', outpath / f'historical.{output_format}'
+
+
+def run():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Generate synthetic index and historical datasets.')
+    parser.add_argument('-o', '--outpath', dest='outpath', required=True, type=pathlib.Path,
+                        help='Directory in which to write index and historical datasets.')
+    parser.add_argument('--output-format', dest='output_format', default='csv', choices=OUTPUT_FORMATS)
+    parser.add_argument('--patients', dest='n_patients', default=100, type=int)
+    parser.add_argument('--encounters-per-patient', dest='encounters_per_patient', default=2, type=int)
+    parser.add_argument('--notes-per-window', dest='notes_per_window', default=5, type=float,
+                        help='Average number of historical notes in the year before each index encounter.')
+    parser.add_argument('--note-length', dest='note_length', default=100, type=int,
+                        help='Number of words in each note.')
+    parser.add_argument('--hit-rate', dest='hit_rate', default=0.2, type=float,
+                        help='Probability of each note containing a phrase matched by the synthetic regex file.')
+    parser.add_argument('--seed', dest='seed', default=0, type=int)
+    index_path, historical_path = write_datasets(**vars(parser.parse_args()))
+    logger.info(f'Wrote {index_path} and {historical_path}; use regex file: {SYNTHETIC_REGEX_FILE}')
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,87 @@
+"""
+Evaluation of several regex files (variants) in a single pass.
+
+When tuning the regular expressions, running the pipeline once for each candidate regex file reloads and
+    recleans the same notes each time. Instead, the datasets are loaded, cleaned, and joined once, and each
+    variant is run over the shared cleaned notes (see `main._build_tables`):
+    * historical data is loaded for the index encounters retained by any variant, and then limited to
+        the index encounters retained by each variant, so each variant's output is the same as if it had
+        been run on its own
+    * variants are run one after another, each using `workers` processes for bratdb-apply
+    * the regex result cache is not used (it is specific to a regex file and skips cleaning cached notes)
+
+The differences between variants are summarized by the number of records for each concept_term
+    in nlp_model and nlp_index (see `summarize_variants`).
+"""
+import pathlib
+
+import pandas as pd
+from loguru import logger
+
+# extensions of regex files when a directory is supplied
+REGEX_FILE_EXTENSIONS = ('.tsv', '.txt')
+
+
+class RegexVariant:
+    """A regex file along with the options which depend on it."""
+
+    def __init__(self, regex_file, name=None, prefilter=None, presence_matcher=None, context_sink=None):
+        """
+        :param name: (optional) used to label output; defaults to the name of the regex file (without extension)
+        :param prefilter: (optional) KeywordPrefilter for `regex_file`; see `mhnav_pipeline.prefilter`
+        :param presence_matcher: (optional) PresenceMatcher for `regex_file`; see `mhnav_pipeline.presence`
+        :param context_sink: (optional) ContextSink for this variant's nlp_regex; see `mhnav_pipeline.context_sink`
+        """
+        self.regex_file = regex_file
+        self.name = name or pathlib.Path(regex_file).stem
+        self.prefilter = prefilter
+        self.presence_matcher = presence_matcher
+        self.context_sink = context_sink
+
+
+def resolve_regex_files(regex_file):
+    """
+    Resolve one or more regex files from a path, a directory (all `.tsv`/`.txt` files, in name order),
+        or an iterable of paths.
+
+    :return: list of paths to regex files
+    """
+    if isinstance(regex_file, (str, pathlib.Path)):
+        regex_file = [regex_file]
+    regex_files = []
+    for path in regex_file:
+        path = pathlib.Path(path)
+        if path.is_dir():
+            regex_files.extend(sorted(p for p in path.iterdir() if p.suffix in REGEX_FILE_EXTENSIONS))
+        else:
+            regex_files.append(path)
+    if not regex_files:
+        e = ValueError(f'No regex files found in: {regex_file}')
+        logger.exception(e)
+        raise e
+    names = [path.stem for path in regex_files]
+    if len(set(names)) < len(names):
+        e = ValueError(f'Regex files must have distinct names: {", ".join(names)}')
+        logger.exception(e)
+        raise e
+    return regex_files
+
+
+def summarize_variants(variant_tables):
+    """
+    Compare the number of records for each concept_term in nlp_model and nlp_index between variants.
+
+    :param variant_tables: dict of variant name -> (nlp_positive, nlp_model, nlp_index, nlp_regex)
+    :return: dataframe with columns: table, concept_term, the count for each variant, and the difference
+        in count from the first variant for each other variant (`{name}_diff`)
+    """
+    names = list(variant_tables)
+    counts = []
+    for table_name, position in (('nlp_model', 1), ('nlp_index', 2)):
+        counts.append(pd.concat({
+            name: tables[position]['concept_term'].value_counts() for name, tables in variant_tables.items()
+        }, axis=1).fillna(0).astype(int).rename_axis('concept_term').reset_index().assign(table=table_name))
+    summary = pd.concat(counts, ignore_index=True)[['table', 'concept_term', *names]]
+    for name in names[1:]:
+        summary[f'{name}_diff'] = summary[name] - summary[names[0]]
+    return summary.sort_values(['table', 'concept_term'], ignore_index=True)
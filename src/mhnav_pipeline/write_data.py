@@ -0,0 +1,305 @@
+"""
+Bulk writing of output tables to a database.
+
+Tables are created with an explicit schema (see `TABLE_COLUMNS` and the README) rather than letting
+    pandas infer column types, and each table is loaded in a single transaction using the fastest
+    method available for the database:
+    * PostgreSQL (psycopg2): `COPY ... FROM STDIN`
+    * MS SQL Server (pyodbc): `executemany` with pyodbc's `fast_executemany` (see `create_output_engine`)
+    * SQLite: `executemany`
+    * otherwise: chunked multi-row `INSERT ... VALUES (...), (...)`
+
+For regular refreshes, `write_tables_incremental` instead updates tables with stable names by only
+    deleting and inserting the records which have changed since the previous run.
+
+Tables can also be written to CSV or Parquet files (see `write_file`).
+"""
+import csv
+import io
+import time
+
+import pandas as pd
+import sqlalchemy as sa
+from loguru import logger
+
+# number of records to insert per statement/batch
+WRITE_CHUNKSIZE = 10_000
+# maximum number of parameters in a single statement (MS SQL Server supports at most 2100)
+MAX_PARAMETERS = 2000
+# marker for missing values loaded with PostgreSQL's COPY (an empty field is read as an empty string)
+COPY_NULL = '\\N'
+
+OUTPUT_FORMATS = ('csv', 'parquet')
+
+# column name -> (type, nullable)
+TABLE_COLUMNS = {
+    'nlp_positive': {
+        'pat_enc_csn_id': (sa.BigInteger, False),
+        'note_count': (sa.Integer, False),
+    },
+    'nlp_model': {
+        'index_pat_enc_csn_id': (sa.BigInteger, False),
+        'note_date': (sa.Date, False),
+        'concept_term': (sa.Unicode(50), False),
+    },
+    'nlp_index': {
+        'pat_enc_csn_id': (sa.BigInteger, False),
+        'note_date': (sa.Date, False),
+        'concept_term': (sa.Unicode(50), False),
+        'text_string': (sa.Unicode(250), True),
+    },
+}
+
+# columns identifying the records of each table for incremental writes (see `write_tables_incremental`)
+TABLE_KEYS = {
+    'nlp_positive': ['pat_enc_csn_id'],
+    'nlp_model': ['index_pat_enc_csn_id', 'note_date', 'concept_term'],
+    'nlp_index': ['pat_enc_csn_id', 'note_date', 'concept_term'],
+}
+
+# types of known columns in tables without a fixed set of columns (i.e., nlp_regex)
+COLUMN_TYPES = {
+    'pat_enc_csn_id': sa.BigInteger,
+    'index_pat_enc_csn_id': sa.BigInteger,
+    'id': sa.BigInteger,
+    'note_date': sa.Date,
+    'concept': sa.Unicode(50),
+    'term': sa.Unicode(50),
+    'concept_term': sa.Unicode(50),
+    'capture': sa.Unicode(250),
+    'precontext': sa.UnicodeText,
+    'postcontext': sa.UnicodeText,
+    'note_text': sa.UnicodeText,
+    'is_index': sa.Integer,
+}
+
+
+def create_output_engine(connection_string):
+    """Create engine for output, enabling `fast_executemany` for MS SQL Server with pyodbc."""
+    url = sa.engine.make_url(connection_string)
+    if url.get_backend_name() == 'mssql' and url.get_driver_name() == 'pyodbc':
+        return sa.create_engine(url, fast_executemany=True)
+    return sa.create_engine(url)
+
+
+def write_file(df, path, output_format='csv'):
+    """
+    Write table to file.
+
+    :param path: path without extension
+    :param output_format: one of `OUTPUT_FORMATS`; 'parquet' requires pyarrow
+    """
+    if output_format == 'csv':
+        df.to_csv(f'{path}.csv', index=False)
+    elif output_format == 'parquet':
+        df.to_parquet(f'{path}.parquet', index=False)
+    else:
+        e = ValueError(f'Unrecognized output format: {output_format}')
+        logger.exception(e)
+        raise e
+
+
+def _infer_type(series):
+    if pd.api.types.is_bool_dtype(series):
+        return sa.Boolean
+    elif pd.api.types.is_integer_dtype(series):
+        return sa.BigInteger
+    elif pd.api.types.is_float_dtype(series):
+        return sa.Float
+    elif pd.api.types.is_datetime64_any_dtype(series):
+        return sa.DateTime
+    return sa.UnicodeText
+
+
+def build_table(tablename, df, table_type=None, metadata=None):
+    """
+    Build table definition for a dataframe.
+
+    :param table_type: (optional) key in `TABLE_COLUMNS` (e.g., 'nlp_model'); otherwise, column types
+        are taken from `COLUMN_TYPES` or inferred from the dataframe
+    """
+    metadata = metadata if metadata is not None else sa.MetaData()
+    if table_type is not None:
+        columns = TABLE_COLUMNS[table_type]
+        missing = set(columns) - set(df.columns)
+        if missing:
+            e = ValueError(f'Table {tablename} missing columns: {", ".join(missing)}')
+            logger.exception(e)
+            raise e
+        return sa.Table(tablename, metadata, *(
+            sa.Column(name, type_, nullable=nullable) for name, (type_, nullable) in columns.items()
+        ))
+    return sa.Table(tablename, metadata, *(
+        sa.Column(name, COLUMN_TYPES.get(name) or _infer_type(df[name])) for name in df.columns
+    ))
+
+
+def prepare_records(df, table):
+    """Convert dataframe to values appropriate for the table's declared column types."""
+    df = df[[col.name for col in table.columns]].copy()
+    for col in table.columns:
+        if isinstance(col.type, sa.Date):
+            df[col.name] = pd.to_datetime(df[col.name]).dt.date
+        elif isinstance(col.type, sa.DateTime):
+            df[col.name] = pd.to_datetime(df[col.name])
+    df = df.astype(object)
+    return df.where(df.notnull(), None)
+
+
+class BulkWriter:
+    """Insert records using chunked multi-row `INSERT ... VALUES (...), (...)` statements."""
+
+    def __init__(self, chunksize=WRITE_CHUNKSIZE):
+        self.chunksize = chunksize
+
+    def insert(self, conn, table, df):
+        chunksize = max(1, min(self.chunksize, MAX_PARAMETERS // max(1, len(table.columns))))
+        for records in self._iter_records(df, chunksize):
+            conn.execute(table.insert().values(records))
+
+    @staticmethod
+    def _iter_records(df, chunksize):
+        for i in range(0, df.shape[0], chunksize):
+            yield df.iloc[i:i + chunksize].to_dict('records')
+
+
+class ExecutemanyWriter(BulkWriter):
+    """Insert records with the driver's `executemany` (e.g., pyodbc with `fast_executemany`)."""
+
+    def insert(self, conn, table, df):
+        for records in self._iter_records(df, self.chunksize):
+            conn.execute(table.insert(), records)
+
+
+class PostgresCopyWriter(BulkWriter):
+    """Load records with PostgreSQL's `COPY ... FROM STDIN` (requires psycopg2)."""
+
+    def insert(self, conn, table, df):
+        preparer = conn.dialect.identifier_preparer
+        columns = ', '.join(preparer.quote(col.name) for col in table.columns)
+        cursor = conn.connection.cursor()
+        try:
+            for i in range(0, df.shape[0], self.chunksize):
+                buffer, null = self.copy_buffer(df.iloc[i:i + self.chunksize])
+                cursor.copy_expert(
+                    f"COPY {preparer.format_table(table)} ({columns}) FROM STDIN WITH (FORMAT csv, NULL '{null}')",
+                    buffer
+                )
+        finally:
+            cursor.close()
+
+    @staticmethod
+    def copy_buffer(df):
+        """
+        Write records as CSV for `COPY`. Missing values are written as a marker (`null`) since `to_csv` writes
+            both missing values and empty strings as an empty field, which `COPY` would read as NULL.
+
+        :return: buffer, null (the marker, which does not occur as a value in `df`)
+        """
+        null = COPY_NULL
+        while df.isin([null]).to_numpy().any():  # values equal to the marker would be read as NULL
+            null += '_'
+        buffer = io.StringIO()
+        df.to_csv(buffer, index=False, header=False, quoting=csv.QUOTE_MINIMAL, na_rep=null)
+        buffer.seek(0)
+        return buffer, null
+
+
+def get_writer(engine, chunksize=WRITE_CHUNKSIZE):
+    """Choose the fastest writer for the database."""
+    backend, driver = engine.dialect.name, engine.dialect.driver
+    if backend == 'postgresql' and driver == 'psycopg2':
+        return PostgresCopyWriter(chunksize)
+    elif backend == 'mssql' and driver == 'pyodbc' or backend == 'sqlite':
+        return ExecutemanyWriter(chunksize)
+    return BulkWriter(chunksize)
+
+
+def write_table(df, tablename, engine, table_type=None, *, overwrite_existing=False, writer=None):
+    """
+    Create table with explicit schema and load the dataframe in a single transaction.
+
+    :param table_type: (optional) key in `TABLE_COLUMNS`; see `build_table`
+    :param overwrite_existing: replace an existing table; otherwise, raise ValueError if the table exists
+    :param writer: (optional) BulkWriter; defaults to the fastest available for the database
+    """
+    writer = writer or get_writer(engine)
+    table = build_table(tablename, df, table_type)
+    records = prepare_records(df, table)
+    start = time.perf_counter()
+    with engine.begin() as conn:
+        if sa.inspect(conn).has_table(tablename):
+            if not overwrite_existing:
+                e = ValueError(f'Table {tablename} already exists.')
+                logger.exception(e)
+                raise e
+            table.drop(conn)
+        table.create(conn)
+        writer.insert(conn, table, records)
+    elapsed = time.perf_counter() - start
+    logger.info(f'Wrote {records.shape[0]} records to {tablename} in {elapsed:.2f}s'
+                f' ({records.shape[0] / elapsed if elapsed else 0:.0f} records/s) using {type(writer).__name__}.')
+
+
+def comparable_records(df, table):
+    """Convert dataframe (see `prepare_records`) so that new and stored records can be compared."""
+    df = prepare_records(df, table)
+    for col in table.columns:
+        if isinstance(col.type, sa.Integer):
+            df[col.name] = [None if value is None else int(value) for value in df[col.name]]
+    return df
+
+
+def diff_records(existing_df, new_df, keys):
+    """
+    Find the keys whose records differ between the existing and new records (with the same columns).
+
+    :param keys: columns identifying records (not necessarily unique, e.g., nlp_index has a record for each
+        text_string); if any record with a key has changed, all records with that key are replaced
+    :return: deleted_keys (distinct keys of the existing records to delete), inserted_df (new records to insert)
+    """
+    columns = list(new_df.columns)
+    merged = pd.merge(existing_df, new_df, on=columns, how='outer', indicator=True)
+    changed_keys = merged.loc[merged['_merge'] != 'both', keys].drop_duplicates()
+    deleted_keys = pd.merge(existing_df[keys].drop_duplicates(), changed_keys, on=keys)
+    inserted_df = pd.merge(new_df, changed_keys, on=keys)[columns]
+    return deleted_keys, inserted_df
+
+
+def write_tables_incremental(tables, engine, *, writer=None):
+    """
+    Update tables with stable names to contain the new records by only deleting and inserting changed records
+        (see `TABLE_KEYS` and `diff_records`). All tables are updated in a single transaction. Tables which do
+        not exist are created (see `build_table`).
+
+    :param tables: list of (df, tablename, table_type) with table_type a key in `TABLE_KEYS`
+    :param writer: (optional) BulkWriter; defaults to the fastest available for the database
+    """
+    writer = writer or get_writer(engine)
+    start = time.perf_counter()
+    with engine.begin() as conn:
+        for df, tablename, table_type in tables:
+            table = build_table(tablename, df, table_type)
+            records = comparable_records(df, table)
+            if not sa.inspect(conn).has_table(tablename):
+                table.create(conn)
+                writer.insert(conn, table, records)
+                logger.info(f'Created {tablename} with {records.shape[0]} records.')
+                continue
+            keys = TABLE_KEYS[table_type]
+            existing = comparable_records(pd.read_sql(sa.select(table), conn), table)
+            deleted_keys, inserted = diff_records(existing, records, keys)
+            if deleted_keys.shape[0] > 0:
+                n_deleted = pd.merge(existing[keys], deleted_keys, on=keys).shape[0]
+                conn.execute(
+                    table.delete().where(sa.and_(*(table.c[key] == sa.bindparam(f'key_{key}') for key in keys))),
+                    [{f'key_{key}': value for key, value in zip(keys, row)}
+                     for row in deleted_keys.itertuples(index=False, name=None)],
+                )
+            else:
+                n_deleted = 0
+            writer.insert(conn, table, inserted)
+            logger.info(f'Updated {tablename}: {inserted.shape[0]} records inserted, {n_deleted} deleted,'
+                        f' {records.shape[0] - inserted.shape[0]} unchanged.')
+    logger.info(f'Wrote incremental changes to {len(tables)} tables in {time.perf_counter() - start:.2f}s'
+                f' using {type(writer).__name__}.')
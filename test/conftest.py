@@ -0,0 +1,55 @@
+"""
+Fixtures for running the pipeline (`mhnav_pipeline.main`) in tests.
+
+If they cannot be imported, bratdb is replaced by `apply_regex_to_df` below and `local/cleaning.py`
+    (which is created locally from the template) by `local/cleaning_template.py`.
+"""
+import importlib
+import re
+import sys
+import types
+
+import pytest
+
+from mhnav_pipeline.regexes import read_regex_file
+
+
+def apply_regex_to_df(regex_file, df, include_context=0):
+    """Stand-in for bratdb-apply: each match of each (case-insensitive) regular expression for each record."""
+    regexes = [(concept, term, re.compile(regex_str, re.I)) for concept, term, regex_str in read_regex_file(regex_file)]
+    for idx, text in zip(df.index, df['note_text']):
+        for concept, term, regex in regexes:
+            for m in regex.finditer(text):
+                if include_context:
+                    yield (idx, concept, term, m.group(),
+                           text[max(0, m.start() - include_context):m.start()], text[m.end():m.end() + include_context])
+                else:
+                    yield idx, concept, term, m.group()
+
+
+def _module(name, **attrs):
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    return module
+
+
+@pytest.fixture
+def bratdb_utils(monkeypatch):
+    try:
+        importlib.import_module('bratdb.funcs.apply')
+    except ImportError:
+        monkeypatch.setitem(sys.modules, 'bratdb', _module('bratdb'))
+        monkeypatch.setitem(sys.modules, 'bratdb.funcs', _module('bratdb.funcs'))
+        monkeypatch.setitem(sys.modules, 'bratdb.funcs.apply',
+                            _module('bratdb.funcs.apply', apply_regex_to_df=apply_regex_to_df))
+    return importlib.import_module('mhnav_pipeline.bratdb_utils')
+
+
+@pytest.fixture
+def main(bratdb_utils, monkeypatch):
+    try:
+        importlib.import_module('mhnav_pipeline.local.cleaning')
+    except ImportError:
+        monkeypatch.setitem(sys.modules, 'mhnav_pipeline.local.cleaning',
+                            importlib.import_module('mhnav_pipeline.local.cleaning_template'))
+    return importlib.import_module('mhnav_pipeline.main')
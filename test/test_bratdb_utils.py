@@ -0,0 +1,83 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from mhnav_pipeline.build_datasets import deduplicate_notes
+
+
+@pytest.fixture
+def regex_file(tmp_path):
+    path = tmp_path / 'regexes.tsv'
+    path.write_text('MH_DX\tdepression\tdepress(?:ed|ion)\n'
+                    'ENV_STRESS\tbully\tbull(?:y|ied)\n', encoding='utf8')
+    return path
+
+
+@pytest.fixture
+def notes_df():
+    """Patients with differing amounts of text, in no particular order, with duplicated (non-unique) labels."""
+    rng = np.random.default_rng(0)
+    studyids = rng.integers(1, 12, size=60)
+    texts = [' '.join(rng.choice(['depressed', 'bullied', 'bully', 'fine', 'depression'], size=n))
+             for n in rng.integers(1, 8, size=60)]
+    return pd.DataFrame({'studyid': studyids, 'note_text': texts}, index=np.arange(60) // 2)
+
+
+@pytest.mark.parametrize('n_partitions', [1, 2, 3, 5])
+def test_partition_by_patient(bratdb_utils, notes_df, n_partitions):
+    partitions = bratdb_utils.partition_by_patient(notes_df, n_partitions)
+    assert partitions.shape == (notes_df.shape[0],)
+    assert set(partitions) <= set(range(n_partitions))
+    # each studyid lands in exactly one partition
+    assert (pd.Series(partitions).groupby(notes_df['studyid'].to_numpy()).nunique() == 1).all()
+
+
+def test_partition_by_patient_balances_text(bratdb_utils):
+    df = pd.DataFrame({'studyid': [1, 2, 3, 4], 'note_text': ['x' * 10, 'x' * 6, 'x' * 4, None]})
+    partitions = bratdb_utils.partition_by_patient(df, 2)
+    assert partitions[0] != partitions[1]
+    assert partitions[1] == partitions[2]  # 10 vs 6 + 4
+
+
+@pytest.mark.parametrize('include_context', [0, 3])
+def test_apply_regex_workers_same_as_serial(bratdb_utils, notes_df, regex_file, include_context):
+    expected = bratdb_utils.apply_regex(notes_df, regex_file, include_context=include_context, workers=1)
+    assert len(expected) > 0
+    actual = bratdb_utils.apply_regex(notes_df, regex_file, include_context=include_context, workers=2)
+    assert actual == expected  # same results in the same order
+
+
+def test_apply_regex_reuses_pool(bratdb_utils, notes_df, regex_file):
+    expected = bratdb_utils.apply_regex(notes_df, regex_file, workers=1)
+    with ProcessPoolExecutor(max_workers=3) as pool:
+        for _ in range(2):  # pool is left running for the next call
+            assert bratdb_utils.apply_regex(notes_df, regex_file, workers=3, pool=pool) == expected
+
+
+@pytest.fixture
+def historical_df():
+    """Each note repeated for each index encounter whose window contains it."""
+    return pd.DataFrame([
+        (1, 100, 10, '2020-01-01', 'depressed and bullied'),
+        (1, 100, 11, '2020-02-01', 'depression'),
+        (1, 101, 10, '2020-01-01', 'depressed and bullied'),
+        (1, 100, 12, '2020-03-01', 'fine'),
+        (1, 101, 11, '2020-02-01', 'depression'),
+        (2, 200, 20, '2020-01-01', 'bully'),
+        (2, 201, 20, '2020-01-01', 'bully'),
+    ], columns=['studyid', 'index_pat_enc_csn_id', 'pat_enc_csn_id', 'note_date', 'note_text'],
+        index=[6, 5, 4, 3, 2, 1, 0])
+
+
+@pytest.mark.parametrize('include_context', [0, 5])
+def test_apply_regex_and_merge_deduplicated(bratdb_utils, historical_df, regex_file, include_context):
+    expected = bratdb_utils.apply_regex_and_merge(historical_df, regex_file, include_context=include_context)
+    note_df, note_index = deduplicate_notes(historical_df)
+    assert note_df.shape[0] < historical_df.shape[0]
+    actual = bratdb_utils.apply_regex_and_merge(historical_df, regex_file, include_context=include_context,
+                                                note_df=note_df, note_index=note_index)
+    for expected_df, df in zip(expected, actual):
+        assert expected_df.shape[0] > 0
+        pd.testing.assert_frame_equal(expected_df.reset_index(drop=True), df.reset_index(drop=True))
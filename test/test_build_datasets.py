@@ -0,0 +1,162 @@
+import re
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from mhnav_pipeline.build_datasets import assign_notes_to_windows, deduplicate_notes, fan_out_results, \
+    order_like_merge
+
+
+@pytest.fixture
+def notes_df():
+    return pd.DataFrame([
+        (2, 21, '2020-03-01', 'e'),
+        (1, 10, '2020-01-01', 'a'),
+        (1, 11, '2020-06-30', 'b'),
+        (1, 12, '2020-02-15', 'c'),
+        (1, 13, None, 'd'),
+        (3, 30, '2020-01-01', 'f'),
+        (1, 14, '2019-01-01', 'g'),
+    ], columns=['studyid', 'pat_enc_csn_id', 'note_date', 'note_text'])
+
+
+@pytest.fixture
+def encounters_df():
+    return pd.DataFrame([
+        (1, 100, '2020-01-01', '2020-06-30'),
+        (1, 101, '2020-02-01', '2020-03-01'),
+        (2, 200, '2020-01-01', '2020-12-31'),
+        (4, 400, '2020-01-01', '2020-12-31'),  # no notes
+        (1, 102, None, '2020-12-31'),
+    ], columns=['studyid', 'pat_enc_csn_id', 'start_date', 'end_date'])
+
+
+def test_assign_notes_to_windows(notes_df, encounters_df):
+    historical_df, note_index = assign_notes_to_windows(notes_df, encounters_df)
+    assert historical_df[['index_pat_enc_csn_id', 'pat_enc_csn_id']].values.tolist() == [
+        [100, 10], [100, 12], [100, 11],  # ordered by encounter, then note date
+        [101, 12],
+        [200, 21],
+    ]
+    assert historical_df['end_date'].tolist() == ['2020-06-30'] * 3 + ['2020-03-01', '2020-12-31']
+    assert notes_df['note_text'].to_numpy()[note_index].tolist() == ['a', 'c', 'b', 'c', 'e']
+
+
+def test_assign_notes_to_windows_same_as_merge(notes_df, encounters_df):
+    rng = np.random.default_rng(0)
+    notes_df = pd.DataFrame({
+        'studyid': rng.integers(5, size=200),
+        'pat_enc_csn_id': np.arange(200),
+        'note_date': pd.Timestamp('2020-01-01') + pd.to_timedelta(rng.integers(365, size=200), unit='D'),
+    })
+    start_dates = pd.Timestamp('2019-10-01') + pd.to_timedelta(rng.integers(365, size=20), unit='D')
+    encounters_df = pd.DataFrame({
+        'studyid': rng.integers(6, size=20),
+        'pat_enc_csn_id': np.arange(1000, 1020),
+        'start_date': start_dates,
+        'end_date': start_dates + pd.Timedelta(days=90),
+    })
+    historical_df, _ = assign_notes_to_windows(notes_df, encounters_df)
+    expected = pd.merge(encounters_df.rename(columns={'pat_enc_csn_id': 'index_pat_enc_csn_id'}), notes_df,
+                        on='studyid')
+    expected = expected[(expected.note_date >= expected.start_date) & (expected.note_date <= expected.end_date)]
+    key = ['index_pat_enc_csn_id', 'pat_enc_csn_id']
+    assert historical_df.shape[0] == expected.shape[0]
+    pd.testing.assert_frame_equal(
+        historical_df.sort_values(key).reset_index(drop=True),
+        expected[historical_df.columns].sort_values(key).reset_index(drop=True),
+    )
+
+
+def test_assign_notes_to_windows_empty(notes_df, encounters_df):
+    historical_df, note_index = assign_notes_to_windows(notes_df.iloc[:0], encounters_df.iloc[:0])
+    assert historical_df.shape[0] == 0
+    assert note_index.shape == (0,)
+
+
+@pytest.fixture
+def historical_df():
+    """Notes repeated for each index encounter (interleaved), with non-sequential labels."""
+    return pd.DataFrame([
+        (1, 100, 10, '2020-01-01', 'ab a'),
+        (1, 100, 11, '2020-02-01', 'b'),
+        (1, 101, 10, '2020-01-01', 'ab a'),
+        (1, 100, 12, '2020-03-01', 'none'),
+        (1, 101, 11, '2020-02-01', 'b'),
+        (1, 101, 11, '2020-02-01', 'b b'),  # same note, different text
+        (2, 200, 20, None, 'a'),
+        (2, 201, 20, None, 'a'),
+    ], columns=['studyid', 'index_pat_enc_csn_id', 'pat_enc_csn_id', 'note_date', 'note_text'],
+        index=[7, 3, 5, 0, 1, 2, 6, 4])
+
+
+def _hits(df):
+    """Stand-in for bratdb-apply results: each match of `a` or `b`, in order, for each record."""
+    return pd.DataFrame([
+        (idx, m.group(), m.start()) for idx, text in zip(df.index, df['note_text']) for m in re.finditer('[ab]', text)
+    ], columns=['id', 'capture', 'start'])
+
+
+def test_deduplicate_notes(historical_df):
+    note_df, note_index = deduplicate_notes(historical_df)
+    assert note_df.index.tolist() == [7, 3, 0, 2, 6]  # first record of each distinct note
+    assert note_index.tolist() == [0, 1, 0, 2, 1, 3, 4, 4]
+    for column in ('studyid', 'pat_enc_csn_id', 'note_date', 'note_text'):
+        pd.testing.assert_series_equal(note_df[column].iloc[note_index].reset_index(drop=True),
+                                       historical_df[column].reset_index(drop=True))
+
+
+def test_fan_out_results_same_as_direct(historical_df):
+    note_df, note_index = deduplicate_notes(historical_df)
+    fanned = fan_out_results(_hits(note_df), historical_df, note_df, note_index)
+    expected = _hits(historical_df)
+    # every duplicate record is restored, in the original order
+    pd.testing.assert_frame_equal(fanned[expected.columns], expected)
+    records = historical_df.loc[fanned['id']]
+    assert records['pat_enc_csn_id'].tolist() == [10, 10, 10, 11, 10, 10, 10, 11, 11, 11, 20, 20]
+    assert records['index_pat_enc_csn_id'].tolist() == [100] * 4 + [101] * 6 + [200, 201]
+
+
+def test_fan_out_results_no_hits(historical_df):
+    note_df, note_index = deduplicate_notes(historical_df)
+    fanned = fan_out_results(_hits(note_df.iloc[:0]), historical_df, note_df, note_index)
+    assert fanned.shape[0] == 0
+    assert set(fanned.columns) == {'id', 'capture', 'start'}
+
+
+def _records_and_hits(duplicated_keys):
+    """Records with metadata (as in index data) and their hits (with the metadata of each record, as after
+    `apply_regex_and_merge`), with null and categorical keys; hits are not in record order."""
+    records = pd.DataFrame([
+        (1, 100, '2020-01-01'),
+        (2, 200, None),
+        (1, 100, '2020-01-01'),  # same keys as the first record
+        (1, 101, '2020-02-01'),
+        (3, 300, None),
+        (2, 200, None),  # same keys as the second record (with null)
+    ], columns=['studyid', 'pat_enc_csn_id', 'note_date'], index=[5, 4, 3, 2, 1, 0])
+    if not duplicated_keys:
+        records = records.drop_duplicates()
+    records['note_date'] = records['note_date'].astype('category')
+    results = pd.DataFrame([
+        (0, 'b'), (2, 'a'), (5, 'a'), (3, 'c'), (1, 'a'), (5, 'b'), (4, 'c'), (3, 'a'),
+    ], columns=['id', 'concept_term'])
+    results = results[results['id'].isin(records.index)].astype({'concept_term': 'category'})
+    hits = pd.merge(records, results, left_index=True, right_on='id', how='inner')
+    return records, hits
+
+
+@pytest.mark.parametrize('duplicated_keys', [False, True])
+def test_order_like_merge_same_as_merge(duplicated_keys):
+    on = ['studyid', 'pat_enc_csn_id', 'note_date']
+    records, hits = _records_and_hits(duplicated_keys)
+    expected = pd.merge(records, hits.drop(columns='id'), on=on)  # previously, hits were merged with records
+    actual = order_like_merge(hits, records, on=on)[expected.columns]
+    if duplicated_keys:  # the merge repeats hits for each record with the same keys, which output tables drop
+        assert expected.shape[0] > actual.shape[0]
+        expected = expected.drop_duplicates()
+        actual = actual.drop_duplicates()
+    assert actual['note_date'].isnull().any()
+    assert isinstance(actual['concept_term'].dtype, pd.CategoricalDtype)
+    pd.testing.assert_frame_equal(actual.reset_index(drop=True), expected.reset_index(drop=True))
@@ -0,0 +1,55 @@
+import pandas as pd
+import pytest
+
+from mhnav_pipeline.cache import RegexResultCache
+
+
+@pytest.fixture
+def regex_file(tmp_path):
+    path = tmp_path / 'regex.tsv'
+    path.write_text('MH_DX\tdepression\tdepress\\w*\n')
+    return path
+
+
+def _results(ids, captures):
+    return pd.DataFrame({
+        'id': ids, 'concept': 'MH_DX', 'term': 'depression', 'capture': captures,
+    })
+
+
+def test_cache_roundtrip(tmp_path, regex_file):
+    df = pd.DataFrame({'note_text': ['depressed, depression', 'normal', 'depressive']}, index=[10, 11, 12])
+    results_df = _results([10, 10, 12], ['depressed', 'depression', 'depressive'])
+
+    cache = RegexResultCache(tmp_path / 'cache', regex_file)
+    lookup = cache.lookup(df['note_text'])
+    assert not lookup.found.any()
+    assert lookup.merge_and_store(df, results_df).equals(results_df)
+    cache.close()
+
+    # rerun with one new note
+    df2 = pd.DataFrame({'note_text': ['depressive', 'new depression', 'depressed, depression', 'normal']})
+    cache = RegexResultCache(tmp_path / 'cache', regex_file)
+    lookup = cache.lookup(df2['note_text'])
+    assert list(lookup.found) == [True, False, True, True]
+    merged = lookup.merge_and_store(df2, _results([1], ['depression']))
+    assert merged.equals(_results([0, 1, 2, 2], ['depressive', 'depression', 'depressed', 'depression']))
+    assert (cache.hits, cache.misses) == (3, 1)
+
+
+def test_cache_invalidated_by_regex_file(tmp_path, regex_file):
+    df = pd.DataFrame({'note_text': ['depressed']})
+    cache = RegexResultCache(tmp_path / 'cache', regex_file)
+    cache.lookup(df['note_text']).merge_and_store(df, _results([0], ['depressed']))
+    regex_file.write_text('MH_DX\tdepression\tdepress\n')
+    cache = RegexResultCache(tmp_path / 'cache', regex_file)
+    assert not cache.lookup(df['note_text']).found.any()
+
+
+def test_cache_eviction(tmp_path, regex_file):
+    cache = RegexResultCache(tmp_path / 'cache', regex_file, max_size_mb=300 / 1024 / 1024)
+    for i in range(5):
+        df = pd.DataFrame({'note_text': [f'note {i}']})
+        cache.lookup(df['note_text']).merge_and_store(df, _results([0], ['depressed']))
+    assert cache.evicted > 0
+    assert cache.size <= 300
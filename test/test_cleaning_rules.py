@@ -0,0 +1,83 @@
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from mhnav_pipeline.cleaning_rules import CleaningRuleSet
+
+
+@pytest.fixture
+def rule_set():
+    return CleaningRuleSet(
+        exclusions=['Automated Message'],
+        replacements=['please call', r'\bfax\b'],
+    )
+
+
+@pytest.mark.parametrize('null_value', [
+    None, np.nan, pd.NA,
+])
+def test_cleaning_is_null(rule_set, null_value):
+    assert rule_set.clean_text(null_value) == ''
+
+
+def test_exclusion(rule_set):
+    stats = Counter()
+    assert rule_set.clean_text('AUTOMATED MESSAGE: appointment reminder', stats) == ''
+    assert stats == Counter({'automated message': 1})
+
+
+def test_exclusion_only_at_start(rule_set):
+    text = 'x' * 100 + ' automated message'
+    assert rule_set.clean_text(text) == text
+
+
+def test_replacement(rule_set):
+    stats = Counter()
+    assert rule_set.clean_text('Please\n call or fax: feeling down\nPLEASE CALL', stats) == (
+        '  or  : feeling down   '
+    )
+    assert stats == Counter({'please call': 1, r'\bfax\b': 1})
+
+
+def test_clean_series_merges_stats(rule_set):
+    texts = pd.Series(['please call', 'send fax', 'nothing', 'please call'], index=[3, 5, 7, 9])
+    cleaned, stats = rule_set.clean_series(texts)
+    assert cleaned.tolist() == [' ', 'send  ', 'nothing', ' ']
+    assert cleaned.index.tolist() == [3, 5, 7, 9]
+    assert stats == Counter({'please call': 2, r'\bfax\b': 1})
+    assert stats + Counter({'please call': 1}) == Counter({'please call': 3, r'\bfax\b': 1})
+
+
+def test_from_file(tmp_path):
+    path = tmp_path / 'rules.tsv'
+    path.write_text('# comment\nexclude\tAutomated Message\n\nreplace\tplease call\n', encoding='utf8')
+    rule_set = CleaningRuleSet.from_file(path)
+    assert rule_set.exclusions == ['automated message']
+    assert rule_set.replacements == ['please call']
+
+
+def test_from_file_unrecognized(tmp_path):
+    path = tmp_path / 'rules.tsv'
+    path.write_text('remove\tplease call\n', encoding='utf8')
+    with pytest.raises(ValueError):
+        CleaningRuleSet.from_file(path)
+
+
+@pytest.mark.parametrize('pattern', [r'(\w)\1', r'(a)?(?(1)b|c)', r'x (y)\2'])
+def test_numbered_backreference_rejected(pattern):
+    with pytest.raises(ValueError, match='Numbered backreferences'):
+        CleaningRuleSet(replacements=['please call', pattern])
+
+
+def test_named_groups():
+    rule_set = CleaningRuleSet(replacements=['please call', r'(?P<ch>\w)(?P=ch)(?P=ch)', r'(\d+) mg'])
+    stats = Counter()
+    assert rule_set.clean_text('zzz then 20 mg and \\1', stats) == '  then   and \\1'
+    assert stats == Counter({r'(?P<ch>\w)(?P=ch)(?P=ch)': 1, r'(\d+) mg': 1})
+
+
+def test_duplicate_group_names_rejected():
+    with pytest.raises(ValueError, match='distinct'):
+        CleaningRuleSet(replacements=[r'(?P<x>a)', r'(?P<x>b)'])
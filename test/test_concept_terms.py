@@ -0,0 +1,44 @@
+import pandas as pd
+import pytest
+
+from mhnav_pipeline.concept_terms import convert_terms, get_concept_terms, load_concept_term_rules
+
+
+@pytest.mark.parametrize('concept, term, expected', [
+    ('MH_DX', 'depression', ['depression']),
+    ('BEHAV_SYMPT', 'anger outbursts', ['BEHAV_SYMPT', 'anger']),
+    ('ENV_STRESS', 'bullied at school', ['ENV_STRESS', 'academic']),
+    ('MH_DX', 'adhd', ['adhd']),
+    ('MH_DX', 'normal', []),
+])
+def test_get_concept_terms(concept, term, expected):
+    assert get_concept_terms(concept, term) == expected
+
+
+def test_convert_terms_one_record_per_concept_term():
+    df = pd.DataFrame({
+        'id': [1, 2, 3],
+        'concept': ['MH_DX', 'ENV_STRESS', 'MH_DX'],
+        'term': ['depression anxiety', 'school', 'normal'],
+        'capture': ['depressed and anxious', 'school', 'normal'],
+    })
+    ct_df = convert_terms(df)
+    assert list(ct_df.columns) == ['id', 'concept', 'term', 'capture', 'concept_term']
+    assert list(zip(ct_df['id'], ct_df['concept_term'])) == [
+        (1, 'depression'), (1, 'anxiety'), (2, 'ENV_STRESS'), (2, 'academic'),
+    ]
+
+
+def test_convert_terms_empty():
+    df = pd.DataFrame(columns=['id', 'concept', 'term', 'capture'])
+    ct_df = convert_terms(df)
+    assert ct_df.shape[0] == 0
+    assert 'concept_term' in ct_df.columns
+
+
+def test_load_concept_term_rules(tmp_path):
+    path = tmp_path / 'rules.tsv'
+    path.write_text('# field\tvalue\tconcept_term\nconcept\tMH_REFERRAL\n\nterm\tsleep\tinsomnia\n')
+    rules = load_concept_term_rules(path)
+    assert rules == (('concept', 'MH_REFERRAL', ''), ('term', 'sleep', 'insomnia'))
+    assert get_concept_terms('MH_REFERRAL', 'poor sleep', rules) == ['MH_REFERRAL', 'insomnia']
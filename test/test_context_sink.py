@@ -0,0 +1,59 @@
+import pandas as pd
+import pytest
+
+from mhnav_pipeline.context_sink import ContextSink, CONTEXT_COLUMNS
+
+
+@pytest.fixture
+def results_df():
+    return pd.DataFrame([
+        (0, 'MH_DX', 'depression', 'depressed', 'child is very ', ' and sad'),
+        (0, 'MH_DX', 'depression', 'depressed', 'child is very ', ' and sad'),
+        (1, 'ENV_STRESS', 'bully', 'bullied', '', ' at school'),
+        (2, 'MH_DX', 'depression', 'depression', 'child is very ', ' and sad'),
+    ], columns=['id', 'concept', 'term', 'capture', 'precontext', 'postcontext'])
+
+
+def test_encode(tmp_path, results_df):
+    sink = ContextSink(tmp_path / 'nlp_regex', context_length=5)
+    encoded_df, contexts = sink.encode(results_df)
+    assert 'precontext' not in encoded_df.columns
+    assert encoded_df['context'].tolist() == [0, 0, 1, 0]
+    assert contexts.values.tolist() == [['very ', ' and '], ['', ' at s']]
+
+
+@pytest.mark.parametrize('output_format', ['csv', 'parquet'])
+def test_write(tmp_path, results_df, output_format):
+    sink = ContextSink(tmp_path / 'nlp_regex', output_format, context_length=5, batch_size=1)
+    encoded_df, contexts = sink.encode(results_df)
+    ct_df = encoded_df.iloc[1:].assign(
+        studyid=1, pat_enc_csn_id=[10, 11, 12], index_pat_enc_csn_id=100, note_date='2020-01-01',
+        concept_term=['depression', 'bully', 'depression'],
+    )
+    sink.write(ct_df, contexts, is_index=False)
+    sink.write(ct_df.iloc[:1].drop(columns='index_pat_enc_csn_id'), contexts, is_index=True)
+    sink.close()
+    if output_format == 'csv':
+        df = pd.read_csv(sink.path, keep_default_na=False)
+    else:
+        df = pd.read_parquet(sink.path)
+    assert sink.path.endswith('.csv.gz' if output_format == 'csv' else '.parquet')
+    assert list(df.columns) == CONTEXT_COLUMNS
+    assert df[['is_index', 'index_pat_enc_csn_id', 'pat_enc_csn_id', 'capture', 'precontext']].values.tolist() == [
+        [0, 100, 10, 'depressed', 'very '],
+        [0, 100, 11, 'bullied', ''],
+        [0, 100, 12, 'depression', 'very '],
+        [1, 10, 10, 'depressed', 'very '],  # index hits are their own index encounter
+    ]
+    assert sink.n_records == 4
+
+
+def test_close_without_hits(tmp_path):
+    sink = ContextSink(tmp_path / 'nlp_regex')
+    sink.close()
+    assert list(pd.read_csv(sink.path).columns) == CONTEXT_COLUMNS
+
+
+def test_unrecognized_format(tmp_path):
+    with pytest.raises(ValueError):
+        ContextSink(tmp_path / 'nlp_regex', 'xlsx')
@@ -0,0 +1,216 @@
+import datetime
+
+import pandas as pd
+import pytest
+import sqlalchemy as sa
+
+from mhnav_pipeline import write_data
+
+
+@pytest.fixture
+def regex_file(tmp_path):
+    path = tmp_path / 'regexes.tsv'
+    path.write_text('MH_DX\tdepression\tdepress(?:ed|ion)\n'
+                    'ENV_STRESS\tbully\tbull(?:y|ied)\n'
+                    'MH_DX\tanxiety\tanxi(?:ety|ous)\n'
+                    'OTHER\tcough\tcough\n', encoding='utf8')
+    return path
+
+
+@pytest.fixture
+def index_df():
+    """Index encounters 100 and 101 (patient 1), 200 (patient 2), and 300 (patient 3; no hits)."""
+    return pd.DataFrame([
+        (1, 100, '2021-03-01', 'Child is depressed\nand anxious'),
+        (1, 100, '2021-03-01', 'was bullied'),
+        (1, 101, '2021-05-01', 'depression'),
+        (2, 200, '2021-04-01', 'Anxious; cough'),
+        (3, 300, '2021-04-01', 'cough'),
+    ], columns=['studyid', 'pat_enc_csn_id', 'note_date', 'note_text']).assign(
+        start_date=lambda df: (pd.to_datetime(df.note_date) - pd.Timedelta(days=365)).dt.strftime('%Y-%m-%d'),
+        end_date=lambda df: (pd.to_datetime(df.note_date) - pd.Timedelta(days=1)).dt.strftime('%Y-%m-%d'),
+    )
+
+
+@pytest.fixture
+def notes_df():
+    """Historical notes (each once), some of which are in the windows of several index encounters."""
+    return pd.DataFrame([
+        (1, 10, '2020-06-01', 'bully at school\nagain'),
+        (1, 11, '2020-07-01', 'cough'),
+        (1, 12, '2021-01-01', 'Depressed, depressed'),
+        (1, 13, '2021-04-01', 'anxiety'),
+        (1, 14, '2021-01-01', 'nothing of note'),
+        (2, 20, '2020-05-01', 'anxious'),
+        (2, 21, '2020-06-01', 'bullied'),
+        (3, 30, '2020-06-01', 'depressed'),
+    ], columns=['studyid', 'pat_enc_csn_id', 'note_date', 'note_text'])
+
+
+@pytest.fixture
+def historical_df(index_df, notes_df):
+    """Historical notes repeated for each index encounter whose window contains them (ordered by studyid)."""
+    encounters_df = index_df.drop_duplicates('pat_enc_csn_id')[['studyid', 'pat_enc_csn_id', 'start_date', 'end_date']]
+    df = pd.merge(encounters_df.rename(columns={'pat_enc_csn_id': 'index_pat_enc_csn_id'}), notes_df, on='studyid')
+    return df[(df.note_date >= df.start_date) & (df.note_date <= df.end_date)].reset_index(drop=True)
+
+
+def _run(main, index_df, historical_df, regex_file, tmp_path, **kwargs):
+    return main.build_datasets(index_df.copy(), historical_df.copy(), regex_file, outpath=tmp_path,
+                               output_to_csv=False, **kwargs)
+
+
+def _assert_same_tables(expected, actual):
+    for expected_table, table in zip(expected, actual):
+        if expected_table is None:
+            assert table is None
+        else:
+            pd.testing.assert_frame_equal(expected_table.reset_index(drop=True), table.reset_index(drop=True))
+
+
+def _sorted_hits(nlp_regex):
+    df = nlp_regex.drop(columns='id')
+    return df.sort_values(list(df.columns), ignore_index=True)
+
+
+@pytest.mark.parametrize('include_context', [0, 5])
+def test_chunks_same_as_in_memory(main, index_df, historical_df, regex_file, tmp_path, include_context):
+    expected = _run(main, index_df, historical_df, regex_file, tmp_path, include_context=include_context)
+    assert expected[0].shape[0] > 0 and expected[1].shape[0] > 0
+    # patient 1 has 3 index records and 5 historical records, so always straddles a chunk boundary
+    actual = _run(main, index_df, historical_df, regex_file, tmp_path, include_context=include_context, chunksize=3)
+    if include_context:  # `id` is the label of the record within its chunk, and hits are ordered by chunk
+        expected, actual = [*expected[:3], _sorted_hits(expected[3])], [*actual[:3], _sorted_hits(actual[3])]
+    _assert_same_tables(expected, actual)
+
+
+@pytest.mark.parametrize('chunksize', [None, 3])
+def test_no_historical_matches(main, index_df, historical_df, regex_file, tmp_path, chunksize):
+    historical_df['index_pat_enc_csn_id'] += 1000  # no records for retained index encounters
+    nlp_positive, nlp_model, nlp_index, nlp_regex = _run(
+        main, index_df, historical_df, regex_file, tmp_path, include_context=5, chunksize=chunksize
+    )
+    assert nlp_model.shape[0] == 0
+    assert nlp_index.shape[0] > 0
+    assert set(nlp_regex['is_index']) == {1}
+
+
+def test_workers_same_as_serial(main, index_df, historical_df, regex_file, tmp_path):
+    expected = _run(main, index_df, historical_df, regex_file, tmp_path, include_context=5)
+    actual = _run(main, index_df, historical_df, regex_file, tmp_path, include_context=5, workers=2)
+    _assert_same_tables(expected, actual)
+
+
+@pytest.mark.parametrize('chunksize', [None, 3])
+def test_cache_same_output_with_context(main, index_df, historical_df, regex_file, tmp_path, chunksize):
+    expected = _run(main, index_df, historical_df, regex_file, tmp_path, include_context=5, chunksize=chunksize)
+    for _ in range(2):  # results are stored by the first run and retrieved by the second
+        actual = _run(main, index_df, historical_df, regex_file, tmp_path, include_context=5, chunksize=chunksize,
+                      cache_dir=tmp_path / 'cache')
+        _assert_same_tables(expected, actual)
+    assert not actual[3]['note_text'].str.contains('\n').any()  # note text is cleaned for cached notes
+
+
+def test_no_metrics_written_without_output(main, index_df, historical_df, regex_file, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    main.build_datasets(index_df, historical_df, regex_file, output_to_csv=False)
+    assert not list(tmp_path.glob('**/metrics_*'))
+    _run(main, index_df, historical_df, regex_file, tmp_path / 'out')  # outpath specified
+    assert len(list(tmp_path.glob('out/*/metrics_*'))) == 2
+
+
+def test_invalid_arguments_create_nothing(main, index_df, historical_df, regex_file, tmp_path):
+    with pytest.raises(ValueError, match='Exactly one'):
+        main.build_datasets(index_df, historical_df, regex_file, notes_dataset=historical_df,
+                            outpath=tmp_path / 'out', cache_dir=tmp_path / 'cache', workers=2)
+    assert not (tmp_path / 'out').exists() and not (tmp_path / 'cache').exists()
+
+
+def test_failed_build_closes_cache_and_sinks(main, index_df, historical_df, regex_file, tmp_path, monkeypatch):
+    closed = []
+    for cls in (main.RegexResultCache, main.ContextSink):
+        monkeypatch.setattr(cls, 'close', lambda self, close=cls.close: closed.append(type(self)) or close(self))
+
+    def _fail(*args, **kwargs):
+        raise RuntimeError('failed')
+    monkeypatch.setattr(main, '_build_tables', _fail)
+    with pytest.raises(RuntimeError):
+        _run(main, index_df, historical_df, regex_file, tmp_path, include_context=5, stream_context=True,
+             cache_dir=tmp_path / 'cache', workers=2)
+    assert closed == [main.RegexResultCache, main.ContextSink]
+
+
+@pytest.mark.parametrize('chunksize', [None, 3])
+def test_presence_only_same_output(main, index_df, historical_df, regex_file, tmp_path, chunksize):
+    expected = _run(main, index_df, historical_df, regex_file, tmp_path)
+    assert expected[1].shape[0] > 0
+    actual = _run(main, index_df, historical_df, regex_file, tmp_path, chunksize=chunksize, presence_only=True)
+    _assert_same_tables(expected, actual)
+
+
+def _sorted_rows(df):
+    return df.sort_values(list(df.columns), ignore_index=True)
+
+
+@pytest.mark.parametrize('chunksize', [None, 3])
+def test_notes_dataset_same_as_historical(main, index_df, historical_df, notes_df, regex_file, tmp_path, chunksize):
+    expected = _run(main, index_df, historical_df, regex_file, tmp_path, chunksize=chunksize)
+    assert expected[1].shape[0] > 0
+    actual = main.build_datasets(index_df.copy(), None, regex_file, notes_dataset=notes_df.copy(), outpath=tmp_path,
+                                 output_to_csv=False, chunksize=chunksize)
+    # records are in the same order as if the historical dataset were ordered by index encounter and note date
+    _assert_same_tables([_sorted_rows(df) for df in expected[:3]], [_sorted_rows(df) for df in actual[:3]])
+    by_date = historical_df.sort_values(['index_pat_enc_csn_id', 'note_date'], kind='stable')
+    _assert_same_tables(_run(main, index_df, by_date, regex_file, tmp_path, chunksize=chunksize)[:3], actual[:3])
+
+
+@pytest.mark.parametrize('chunksize', [None, 3])
+def test_variants_same_as_single_regex_file(main, index_df, historical_df, regex_file, tmp_path, chunksize):
+    other_file = tmp_path / 'other.tsv'
+    other_file.write_text('MH_DX\tanxiety\tanxi(?:ety|ous)\n'
+                          'OTHER\tcough\tcough\n', encoding='utf8')
+    variant_tables = _run(main, index_df, historical_df, [regex_file, other_file], tmp_path, include_context=5,
+                          chunksize=chunksize)
+    assert list(variant_tables) == ['regexes', 'other']
+    for path in (regex_file, other_file):
+        expected = _run(main, index_df, historical_df, path, tmp_path, include_context=5, chunksize=chunksize)
+        assert expected[2].shape[0] > 0
+        _assert_same_tables(expected, variant_tables[path.stem])
+
+
+def test_incremental_only_replaces_changed_keys(main, index_df, historical_df, regex_file, tmp_path, monkeypatch):
+    diffs = []  # (deleted keys, inserted keys) for each table
+    diff_records = write_data.diff_records
+
+    def _diff_records(existing_df, new_df, keys):
+        deleted_keys, inserted_df = diff_records(existing_df, new_df, keys)
+        diffs.append((deleted_keys.to_dict('records'), inserted_df[keys].to_dict('records')))
+        return deleted_keys, inserted_df
+    monkeypatch.setattr(write_data, 'diff_records', _diff_records)
+    connection_string = f'sqlite:///{tmp_path / "out.db"}'
+
+    def _run_incremental(historical_df):
+        tables = _run(main, index_df, historical_df, regex_file, tmp_path, out_connection_string=connection_string,
+                      incremental=True)
+        engine = sa.create_engine(connection_string)
+        for name, df in zip(('nlp_positive', 'nlp_model', 'nlp_index'), tables):
+            # database contains the same records as the output of this run
+            written = pd.read_sql_table(name, engine)
+            if 'note_date' in written:  # read back as datetimes
+                written['note_date'] = written['note_date'].dt.strftime('%Y-%m-%d')
+            pd.testing.assert_frame_equal(_sorted_rows(written), _sorted_rows(df), check_dtype=False)
+        engine.dispose()
+
+    _run_incremental(historical_df)  # tables are created
+    assert diffs == []
+    _run_incremental(historical_df)
+    assert diffs == [([], [])] * 3  # unchanged: nothing deleted or inserted
+    diffs.clear()
+    historical_df.loc[historical_df['pat_enc_csn_id'] == 13, 'note_text'] = 'depressed'  # was: anxiety
+    _run_incremental(historical_df)
+    assert diffs == [
+        ([], []),  # nlp_positive
+        ([{'index_pat_enc_csn_id': 101, 'note_date': datetime.date(2021, 4, 1), 'concept_term': 'anxiety'}],
+         [{'index_pat_enc_csn_id': 101, 'note_date': datetime.date(2021, 4, 1), 'concept_term': 'depression'}]),
+        ([], []),  # nlp_index
+    ]
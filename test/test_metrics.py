@@ -0,0 +1,54 @@
+import csv
+import json
+import pstats
+
+import pandas as pd
+
+from mhnav_pipeline.metrics import StageMetrics, measure, measure_iter, METRIC_COLUMNS
+
+
+def test_stage_aggregates_calls():
+    metrics = StageMetrics()
+    for n in (10, 20):
+        with metrics.stage('clean', rows_in=n) as stage:
+            stage.rows_out = n - 1
+    record, = metrics.records()
+    assert record['stage'] == 'clean'
+    assert record['calls'] == 2
+    assert record['rows_in'] == 30
+    assert record['rows_out'] == 28
+    assert record['wall_time'] >= 0
+    assert record['notes_per_sec'] is None or record['notes_per_sec'] > 0
+
+
+def test_measure_without_metrics():
+    with measure(None, 'clean', rows_in=10) as stage:
+        stage.rows_out = 5
+    assert stage.rows_out == 5
+
+
+def test_measure_iter():
+    metrics = StageMetrics()
+    chunks = [pd.DataFrame({'a': range(3)}), pd.DataFrame({'a': range(2)})]
+    assert len(list(measure_iter(metrics, 'load', chunks))) == 2
+    record, = metrics.records()
+    assert record['calls'] == 2
+    assert record['rows_out'] == 5
+
+
+def test_write(tmp_path):
+    metrics = StageMetrics(profile=True)
+    with metrics.stage('load') as stage:
+        stage.rows_out = sum(range(1000))
+    with metrics.stage('clean', rows_in=10):
+        pass
+    metrics.write(tmp_path, 'metrics')
+    with open(tmp_path / 'metrics.json') as fh:
+        data = json.load(fh)
+    assert [record['stage'] for record in data['stages']] == ['load', 'clean']
+    assert 'wall_time' in data['summary']
+    with open(tmp_path / 'metrics.csv', newline='') as fh:
+        reader = csv.DictReader(fh)
+        assert reader.fieldnames == METRIC_COLUMNS
+        assert len(list(reader)) == 2
+    pstats.Stats(str(tmp_path / 'profile_load.prof'))
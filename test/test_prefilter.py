@@ -0,0 +1,58 @@
+import re
+
+import pytest
+
+from mhnav_pipeline.prefilter import extract_anchors, minimize_anchors, KeywordPrefilter
+
+
+@pytest.mark.parametrize('regex_str, expected', [
+    (r'depress\w*', {'depress'}),
+    (r'\bAnxi(?:ety|ous)\b', {'anxiety', 'anxious'}),
+    (r'(?:suicid\w*|self\W+harm)', {'suicid', 'self'}),
+    (r'(?:bully|bullied)', {'bully', 'bullied'}),
+    (r'adhd|attention\W+deficit', {'adhd', 'attention'}),
+    (r'(?:poor\s+)?grades?', {'grade'}),
+    (r'\w+', None),
+    (r'(?:a|)b', {'b'}),
+    (r'(?:a|\d)', None),
+])
+def test_extract_anchors(regex_str, expected):
+    assert extract_anchors(regex_str) == expected
+
+
+def test_minimize_anchors():
+    assert minimize_anchors({'bully', 'bullied', 'bull', 'anx'}) == ['anx', 'bull']
+
+
+@pytest.mark.parametrize('text', [
+    'Patient reports DEPRESSION.',
+    'has been bullied at school',
+    'SELF  HARM noted',
+    'İnstructions: ADHD',
+])
+def test_prefilter_is_lossless(text):
+    regexes = [r'depress\w*', r'bull(?:y|ied)', r'self\W+harm', r'adhd']
+    prefilter = KeywordPrefilter(set().union(*(extract_anchors(r) for r in regexes)))
+    assert any(re.search(r, text, re.I) for r in regexes)
+    assert prefilter.is_candidate(text)
+
+
+def test_prefilter_skips():
+    prefilter = KeywordPrefilter({'depress'})
+    assert not prefilter.is_candidate('normal exam')
+    assert not prefilter.is_candidate('')
+    assert list(prefilter.candidate_mask(['normal', 'depressed'])) == [False, True]
+
+
+def test_prefilter_always_scan():
+    prefilter = KeywordPrefilter(None)
+    assert prefilter.is_candidate('normal exam')
+
+
+def test_prefilter_from_regex_file(tmp_path):
+    path = tmp_path / 'regex.tsv'
+    path.write_text('MH_DX\tdepression\tdepress\\w*\nMH_DX\tanxiety\tanx(?:iety|ious)\n')
+    prefilter = KeywordPrefilter.from_regex_file(path)
+    assert prefilter.anchors == ['anxiety', 'anxious', 'depress']
+    path.write_text('MH_DX\tdepression\tdepress\\w*\nMH_DX\tany\t\\w+\n')
+    assert KeywordPrefilter.from_regex_file(path).always_scan
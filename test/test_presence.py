@@ -0,0 +1,80 @@
+import re
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from mhnav_pipeline.build_datasets import deduplicate_notes
+from mhnav_pipeline.concept_terms import get_concept_term_rules, get_concept_terms
+from mhnav_pipeline.presence import PresenceMatcher
+from mhnav_pipeline.regexes import RegexSet
+
+REGEXES = [
+    ('MH_DX', 'depression', 'depress(?:ed|ion)'),
+    ('ENV_STRESS', 'bully', 'bull(?:y|ied)'),
+    ('MH_DX', 'anxiety', 'anxi(?:ety|ous)'),
+    ('MH_DX', 'anxiety', 'worried'),
+    ('OTHER', 'cough', 'cough'),
+]
+
+
+@pytest.fixture
+def matcher():
+    return PresenceMatcher(RegexSet(REGEXES))
+
+
+@pytest.fixture
+def historical_df():
+    return pd.DataFrame([
+        (1, 10, 100, '2020-01-01', 'cough'),
+        (1, 11, 100, '2020-01-01', 'Anxious, depressed, depressed; was bullied'),
+        (1, 12, 100, '2020-01-01', 'worried and depressed'),
+        (1, 13, 100, '2020-02-01', 'nothing'),
+        (1, 100, 100, '2020-03-01', 'depressed'),  # index encounter: only counts towards nlp_positive
+        (1, 11, 101, '2020-01-01', 'Anxious, depressed, depressed; was bullied'),
+        (2, 20, 200, '2020-05-01', 'worried, bullied'),
+        (2, 21, 200, '2020-04-01', 'depression'),
+        (2, 20, 200, '2020-05-01', 'cough'),
+    ], columns=['studyid', 'pat_enc_csn_id', 'index_pat_enc_csn_id', 'note_date', 'note_text']).assign(
+        start_date='2019-06-01', end_date='2020-06-01'
+    )
+
+
+def find_all(df, concept_term_rules=None):
+    """Reference: all hits for each record (in merge order), reduced to distinct values."""
+    rules = get_concept_term_rules(concept_term_rules)
+    on = ['studyid', 'pat_enc_csn_id', 'index_pat_enc_csn_id', 'start_date', 'end_date', 'note_date']
+    order = np.argsort(df.groupby(on, sort=False).ngroup().to_numpy(), kind='stable')
+    positive, model = [], []
+    for _, row in df.iloc[order].iterrows():
+        for concept, term, regex in REGEXES:
+            for _ in re.finditer(regex, row.note_text, re.I):
+                positive.append((row.studyid, row.index_pat_enc_csn_id, row.note_date))
+                if row.pat_enc_csn_id != row.index_pat_enc_csn_id:
+                    model.extend((row.index_pat_enc_csn_id, row.note_date, ct)
+                                 for ct in get_concept_terms(concept, term, rules))
+    return set(positive), list(dict.fromkeys(model))
+
+
+def test_apply_same_as_all_hits(matcher, historical_df):
+    note_df, note_index = deduplicate_notes(historical_df)
+    res_df2, ct_df2 = matcher.apply(historical_df, note_df, note_index)
+    positive, model = find_all(historical_df)
+    assert set(res_df2.itertuples(index=False, name=None)) == positive
+    assert list(ct_df2.itertuples(index=False, name=None)) == model
+
+
+def test_find_skips_dates_with_all_concept_terms():
+    matcher = PresenceMatcher(RegexSet(REGEXES[:2]))  # concept_terms: depression, ENV_STRESS, bully
+    texts = ['depressed and bullied', 'depressed', 'bullied']
+    keys = [(1, 'a'), (1, 'a'), (1, 'b')]
+    positive, concept_terms = matcher.find(keys, [False, False, False], [0, 1, 2], texts)
+    assert positive == [0, 2]
+    assert concept_terms == [(0, 'depression'), (0, 'ENV_STRESS'), (0, 'bully'), (2, 'ENV_STRESS'), (2, 'bully')]
+
+
+def test_find_with_prefilter_candidates(matcher):
+    positive, concept_terms = matcher.find([(1, 'a'), (1, 'b')], [False, False], [0, 1], ['depressed'] * 2,
+                                           candidates=np.array([False, True]))
+    assert positive == [1]
+    assert concept_terms == [(1, 'depression')]
@@ -0,0 +1,131 @@
+import pandas as pd
+import pytest
+import sqlalchemy as sa
+
+from mhnav_pipeline import read_data
+from mhnav_pipeline.read_data import read_dataset, iter_dataset, align_chunks, NOTE_COLUMNS
+
+
+@pytest.fixture
+def historical_df():
+    return pd.DataFrame({
+        'STUDYID': [1, 1, 2, 3, 3, 3],
+        'INDEX_PAT_ENC_CSN_ID': [10, 11, 20, 30, 30, 31],
+        'PAT_ENC_CSN_ID': [5, 6, 7, 8, 9, 9],
+        'NOTE_DATE': ['2021-01-01'] * 6,
+        'NOTE_TEXT': ['a', 'b', 'c', 'd', 'e', 'f'],
+        'START_DATE': ['2020-01-01'] * 6,
+        'END_DATE': ['2021-12-31'] * 6,
+    })
+
+
+def _read(dataset, **kwargs):
+    return read_dataset(dataset, 'index_pat_enc_csn_id', filter_col='index_pat_enc_csn_id',
+                        filter_values=[11, 30], **kwargs)
+
+
+def test_read_dataset_filter_csv(tmp_path, historical_df):
+    path = tmp_path / 'historical.csv'
+    historical_df.to_csv(path, index=False)
+    df = _read(path)
+    assert sorted(df.note_text) == ['b', 'd', 'e']
+
+
+def test_read_dataset_filter_database(historical_df):
+    engine = sa.create_engine('sqlite://')
+    historical_df.to_sql('historical', con=engine, index=False)
+    df = _read('historical', engine=engine)
+    assert sorted(df.note_text) == ['b', 'd', 'e']
+
+
+@pytest.mark.parametrize('filter_col, filter_values', [
+    ('index_pat_enc_csn_id', [31, 20, 10, 30, 11, 99]),
+    ('studyid', [3, 2, 1]),
+])
+def test_iter_dataset_filter_database_grouped(historical_df, monkeypatch, filter_col, filter_values):
+    monkeypatch.setattr(read_data, 'FILTER_BATCH_SIZE', 2)  # patients 1 and 3 span batches
+    engine = sa.create_engine('sqlite://')
+    historical_df.sample(frac=1, random_state=1).to_sql('historical', con=engine, index=False)
+    chunks = list(iter_dataset('historical', 'index_pat_enc_csn_id', engine=engine, chunksize=2,
+                               filter_col=filter_col, filter_values=filter_values))
+    df = pd.concat(chunks)
+    assert df['studyid'].tolist() == [1, 1, 2, 3, 3, 3]  # ordered by studyid across batches
+    assert sorted(df['note_text']) == list('abcdef')
+    assert sum(chunk['studyid'].nunique() for chunk in chunks) == 3  # no patient split across chunks
+
+
+def test_read_dataset_filter_empty(historical_df):
+    df = read_dataset(historical_df, 'index_pat_enc_csn_id', filter_col='index_pat_enc_csn_id', filter_values=[])
+    assert df.shape[0] == 0
+    assert 'index_pat_enc_csn_id' in df.columns
+
+
+def test_iter_dataset_aligns_patients(historical_df):
+    chunks = list(iter_dataset(historical_df, 'index_pat_enc_csn_id', chunksize=2))
+    studyids = [studyid for chunk in chunks for studyid in chunk.studyid.unique()]
+    assert len(chunks) > 1
+    assert sorted(studyids) == [1, 2, 3]  # no patient split across chunks
+    assert sum(chunk.shape[0] for chunk in chunks) == historical_df.shape[0]
+
+
+def test_align_chunks_patient_spans_chunks():
+    df = pd.DataFrame({'studyid': [1, 2, 2, 2, 2, 2, 2, 3, 4, 4], 'value': range(10)})
+    chunks = list(align_chunks(df.iloc[start:start + 3] for start in range(0, df.shape[0], 3)))
+    assert [chunk.studyid.tolist() for chunk in chunks] == [[1], [2] * 6 + [3], [4, 4]]
+    assert pd.concat(chunks)['value'].tolist() == list(range(10))  # every record retained, in order
+
+
+@pytest.fixture
+def arrow_path(request, tmp_path, historical_df):
+    pytest.importorskip('pyarrow')
+    df = historical_df.assign(
+        NOTE_DATE=pd.to_datetime(historical_df.NOTE_DATE),
+        EXTRA=['not read'] * historical_df.shape[0],
+    )
+    path = tmp_path / f'historical.{request.param}'
+    if request.param == 'parquet':
+        df.to_parquet(path, index=False)
+    else:
+        df.to_feather(path)
+    return path
+
+
+@pytest.mark.parametrize('arrow_path', ['parquet', 'feather'], indirect=True)
+def test_read_dataset_arrow(arrow_path):
+    df = read_dataset(arrow_path, 'index_pat_enc_csn_id')
+    assert 'extra' not in df.columns
+    assert pd.api.types.is_datetime64_any_dtype(df.note_date)
+    assert pd.api.types.is_integer_dtype(df.pat_enc_csn_id)
+    assert sorted(_read(arrow_path).note_text) == ['b', 'd', 'e']
+
+
+@pytest.mark.parametrize('arrow_path', ['parquet', 'feather'], indirect=True)
+def test_iter_dataset_arrow(arrow_path):
+    chunks = list(iter_dataset(arrow_path, 'index_pat_enc_csn_id', chunksize=2))
+    assert sorted(note for chunk in chunks for note in chunk.note_text) == ['a', 'b', 'c', 'd', 'e', 'f']
+    assert pd.concat(chunks).index.is_unique
+
+
+def test_read_dataset_csv_reads_only_expected_columns(tmp_path, historical_df):
+    path = tmp_path / 'historical.csv'
+    historical_df.assign(EXTRA='not read').to_csv(path, index=False)
+    df = read_dataset(path, 'index_pat_enc_csn_id')
+    assert sorted(df.columns) == sorted(['studyid', 'index_pat_enc_csn_id', 'pat_enc_csn_id', 'note_date',
+                                         'note_text', 'start_date', 'end_date'])
+
+
+def test_read_dataset_does_not_modify_dataframe(historical_df):
+    historical_df = historical_df.rename(columns=str.lower)
+    df = read_dataset(historical_df, 'index_pat_enc_csn_id')
+    df['note_text'] = ''
+    assert historical_df['note_text'].tolist() == ['a', 'b', 'c', 'd', 'e', 'f']
+
+
+def test_read_notes_dataset(tmp_path, historical_df):
+    path = tmp_path / 'notes.csv'
+    historical_df.drop(columns=['INDEX_PAT_ENC_CSN_ID', 'START_DATE', 'END_DATE']).to_csv(path, index=False)
+    df = read_dataset(path, filter_col='studyid', filter_values=[3], columns=NOTE_COLUMNS)
+    assert set(df.columns) == NOTE_COLUMNS
+    assert sorted(df.note_text) == ['d', 'e', 'f']
+    with pytest.raises(ValueError):
+        read_dataset(path)  # missing start_date/end_date
@@ -0,0 +1,162 @@
+import copy
+import http.client
+import json
+import threading
+
+import pytest
+
+from mhnav_pipeline.cleaning_rules import CleaningRuleSet
+from mhnav_pipeline.regexes import RegexSet
+from mhnav_pipeline.scoring import EncounterScorer
+from mhnav_pipeline.service import create_server
+
+
+@pytest.fixture
+def regex_file(tmp_path):
+    path = tmp_path / 'regexes.tsv'
+    path.write_text('MH_DX\tdepression\tdepress(?:ed|ion)\n'
+                    'ENV_STRESS\tbully\tbull(?:y|ied)\n'
+                    'OTHER\tcough\tcough\n', encoding='utf8')
+    return path
+
+
+@pytest.fixture
+def scorer(regex_file):
+    return EncounterScorer(regex_file, cleaning_rules=CleaningRuleSet(exclusions=['automated message']))
+
+
+@pytest.fixture
+def encounter():
+    return {
+        'studyid': 1,
+        'pat_enc_csn_id': 100,
+        'index_notes': [
+            {'note_date': '2021-03-01', 'note_text': 'Mother reports child is Depressed; was bullied'},
+            {'note_date': '2021-03-01', 'note_text': 'depressed again'},
+        ],
+        'historical_notes': [
+            {'pat_enc_csn_id': 10, 'note_date': '2020-06-01', 'note_text': 'bully at school'},
+            {'pat_enc_csn_id': 11, 'note_date': '2020-07-01', 'note_text': 'cough'},
+            {'pat_enc_csn_id': 12, 'note_date': '2020-08-01', 'note_text': 'Automated message: depressed'},
+            {'pat_enc_csn_id': 13, 'note_date': '2020-06-01', 'note_text': 'depression'},
+            {'pat_enc_csn_id': 14, 'note_date': '2020-09-01', 'note_text': 'nothing of note'},
+            {'pat_enc_csn_id': 100, 'note_date': '2021-03-01', 'note_text': 'depressed'},
+        ],
+    }
+
+
+def test_regex_set(regex_file):
+    regex_set = RegexSet.from_file(regex_file)
+    assert list(regex_set.finditer('Bullied, depressed, bully')) == [
+        ('MH_DX', 'depression', 'depressed'),
+        ('ENV_STRESS', 'bully', 'Bullied'),
+        ('ENV_STRESS', 'bully', 'bully'),
+    ]
+
+
+def test_score(scorer, encounter):
+    tables = scorer.score(encounter)
+    assert tables['nlp_index'] == [
+        {'pat_enc_csn_id': 100, 'note_date': '2021-03-01', 'concept_term': 'depression', 'text_string': 'Depressed'},
+        {'pat_enc_csn_id': 100, 'note_date': '2021-03-01', 'concept_term': 'ENV_STRESS', 'text_string': 'bullied'},
+        {'pat_enc_csn_id': 100, 'note_date': '2021-03-01', 'concept_term': 'bully', 'text_string': 'bullied'},
+        {'pat_enc_csn_id': 100, 'note_date': '2021-03-01', 'concept_term': 'depression', 'text_string': 'depressed'},
+    ]
+    # any hit counts towards nlp_positive (including the index encounter and hits without a concept_term)
+    assert tables['nlp_positive'] == [{'pat_enc_csn_id': 100, 'note_count': 3}]
+    # ordered by the first note with the same encounter/date
+    assert tables['nlp_model'] == [
+        {'index_pat_enc_csn_id': 100, 'note_date': '2020-06-01', 'concept_term': 'ENV_STRESS'},
+        {'index_pat_enc_csn_id': 100, 'note_date': '2020-06-01', 'concept_term': 'bully'},
+        {'index_pat_enc_csn_id': 100, 'note_date': '2020-06-01', 'concept_term': 'depression'},
+    ]
+
+
+def test_score_not_retained(scorer, encounter):
+    encounter['index_notes'] = [{'note_date': '2021-03-01', 'note_text': 'cough'}]
+    assert scorer.score(encounter) == {'nlp_positive': [], 'nlp_model': [], 'nlp_index': []}
+
+
+def test_score_without_historical_notes(scorer, encounter):
+    encounter['historical_notes'] = []
+    tables = scorer.score(encounter)
+    assert tables['nlp_positive'] == [] and tables['nlp_model'] == []
+    assert len(tables['nlp_index']) == 4
+
+
+def test_score_missing_keys(scorer, encounter):
+    del encounter['historical_notes'][0]['note_date']
+    with pytest.raises(ValueError):
+        scorer.score(encounter)
+
+
+@pytest.fixture
+def server(scorer):
+    server = create_server(scorer, port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _request(conn, method, path, body=None):
+    conn.request(method, path, body)
+    response = conn.getresponse()
+    return response.status, json.loads(response.read())
+
+
+def test_service(server, scorer, encounter):
+    conn = http.client.HTTPConnection('127.0.0.1', server.server_address[1])
+    assert _request(conn, 'GET', '/health') == (200, {'status': 'ok'})
+    # same connection is reused for each request
+    assert _request(conn, 'POST', '/score', json.dumps(encounter)) == (200, scorer.score(encounter))
+    assert _request(conn, 'POST', '/score', '{not json')[0] == 400
+    assert _request(conn, 'POST', '/score', json.dumps({'studyid': 1}))[0] == 400
+    assert _request(conn, 'POST', '/unknown', '{}')[0] == 404
+    conn.close()
+
+
+def _malformed(encounter, path, value=None):
+    """Copy of `encounter` with the value at `path` replaced by `value` (or deleted if `value` is `KeyError`)."""
+    encounter = copy.deepcopy(encounter)
+    *parents, key = path
+    record = encounter
+    for parent in parents:
+        record = record[parent]
+    if value is KeyError:
+        del record[key]
+    else:
+        record[key] = value
+    return encounter
+
+
+MALFORMED = [
+    (('index_notes', 0, 'note_text'), 3),
+    (('index_notes', 0, 'note_text'), None),
+    (('historical_notes', 1, 'note_text'), None),
+    (('index_notes',), {'note_date': '2021-03-01', 'note_text': 'depressed'}),
+    (('historical_notes',), 'cough'),
+    (('index_notes', 1), 'depressed again'),
+    (('historical_notes', 0, 'note_date'), KeyError),
+    (('index_notes', 0, 'note_date'), ['2021-03-01']),
+    (('historical_notes', 0, 'pat_enc_csn_id'), {'id': 10}),
+    (('pat_enc_csn_id',), None),
+    (('pat_enc_csn_id',), True),
+]
+
+
+@pytest.mark.parametrize('path, value', MALFORMED)
+def test_score_malformed(scorer, encounter, path, value):
+    with pytest.raises(ValueError):
+        scorer.score(_malformed(encounter, path, value))
+
+
+def test_service_malformed(server, encounter):
+    conn = http.client.HTTPConnection('127.0.0.1', server.server_address[1])
+    for body in ('[]', '3', 'null', *(json.dumps(_malformed(encounter, *args)) for args in MALFORMED)):
+        status, response = _request(conn, 'POST', '/score', body)
+        assert status == 400
+        assert response['error']
+    assert _request(conn, 'GET', '/health') == (200, {'status': 'ok'})  # connection still usable
+    conn.close()
@@ -0,0 +1,62 @@
+import re
+
+import pandas as pd
+import pytest
+
+from mhnav_pipeline.read_data import validate_headers
+from mhnav_pipeline.regexes import read_regex_file
+from mhnav_pipeline.synthetic import generate_datasets, write_datasets, SYNTHETIC_REGEX_FILE, HIT_PHRASES, \
+    FILLER_WORDS
+
+
+@pytest.fixture(scope='module')
+def datasets():
+    return generate_datasets(n_patients=50, seed=1)
+
+
+def test_columns(datasets):
+    index_df, historical_df = datasets
+    validate_headers(index_df)
+    validate_headers(historical_df, 'index_pat_enc_csn_id')
+    assert index_df['studyid'].is_monotonic_increasing
+    assert historical_df['studyid'].is_monotonic_increasing
+
+
+def test_same_seed_same_data(datasets):
+    index_df, historical_df = generate_datasets(n_patients=50, seed=1)
+    pd.testing.assert_frame_equal(index_df, datasets[0])
+    pd.testing.assert_frame_equal(historical_df, datasets[1])
+    assert not generate_datasets(n_patients=50, seed=2)[0].equals(index_df)
+
+
+def test_historical_in_window(datasets):
+    index_df, historical_df = datasets
+    assert (historical_df['note_date'] >= historical_df['start_date']).all()
+    assert (historical_df['note_date'] <= historical_df['end_date']).all()
+    assert set(historical_df['index_pat_enc_csn_id']) <= set(index_df['pat_enc_csn_id'])
+    assert not set(historical_df['pat_enc_csn_id']) & set(index_df['pat_enc_csn_id'])
+    # notes are repeated (with the same text) for overlapping windows
+    assert historical_df['pat_enc_csn_id'].duplicated().any()
+    assert (historical_df.groupby('pat_enc_csn_id')['note_text'].nunique() == 1).all()
+
+
+@pytest.mark.parametrize('hit_rate', [0, 0.5, 1])
+def test_hit_rate(hit_rate):
+    index_df, _ = generate_datasets(n_patients=200, hit_rate=hit_rate, note_length=20)
+    pat = re.compile('|'.join(regex for _, _, regex in read_regex_file(SYNTHETIC_REGEX_FILE)), re.I)
+    rate = index_df['note_text'].map(lambda text: bool(pat.search(text))).mean()
+    assert rate == pytest.approx(hit_rate, abs=0.1)
+
+
+def test_regexes_match_hit_phrases_only():
+    regexes = [re.compile(regex, re.I) for _, _, regex in read_regex_file(SYNTHETIC_REGEX_FILE)]
+    for phrase in HIT_PHRASES:
+        assert any(regex.search(phrase) for regex in regexes), phrase
+    for word in FILLER_WORDS:
+        assert not any(regex.search(word) for regex in regexes), word
+
+
+def test_write_datasets(tmp_path):
+    index_path, historical_path = write_datasets(tmp_path, n_patients=5)
+    assert pd.read_csv(index_path).shape[0] == 10
+    assert pd.read_csv(historical_path).shape[0] > 0
@@ -0,0 +1,46 @@
+import pandas as pd
+import pytest
+
+from mhnav_pipeline.variants import resolve_regex_files, summarize_variants
+
+
+@pytest.fixture
+def regex_dir(tmp_path):
+    for name in ['b.tsv', 'a.tsv', 'notes.md']:
+        (tmp_path / name).write_text('MH_DX\tdepression\tdepressed\n', encoding='utf8')
+    return tmp_path
+
+
+def test_resolve_regex_files(regex_dir):
+    assert resolve_regex_files(regex_dir / 'a.tsv') == [regex_dir / 'a.tsv']
+    assert resolve_regex_files(str(regex_dir)) == [regex_dir / 'a.tsv', regex_dir / 'b.tsv']
+    assert resolve_regex_files([regex_dir / 'b.tsv', regex_dir / 'a.tsv']) == [regex_dir / 'b.tsv', regex_dir / 'a.tsv']
+
+
+def test_resolve_regex_files_invalid(regex_dir, tmp_path_factory):
+    with pytest.raises(ValueError):
+        resolve_regex_files(tmp_path_factory.mktemp('empty'))
+    with pytest.raises(ValueError):  # names are used to label output
+        resolve_regex_files([regex_dir, regex_dir / 'a.tsv'])
+
+
+def test_summarize_variants():
+    def tables(model_terms, index_terms):
+        return (
+            None,
+            pd.DataFrame({'index_pat_enc_csn_id': 1, 'note_date': '2020-01-01', 'concept_term': model_terms}),
+            pd.DataFrame({'pat_enc_csn_id': 1, 'note_date': '2020-01-01', 'concept_term': index_terms}),
+            None,
+        )
+
+    summary = summarize_variants({
+        'base': tables(['anxiety', 'depression', 'depression'], ['depression']),
+        'new': tables(['depression', 'bully'], []),
+    })
+    assert summary.values.tolist() == [
+        ['nlp_index', 'depression', 1, 0, -1],
+        ['nlp_model', 'anxiety', 1, 0, -1],
+        ['nlp_model', 'bully', 0, 1, 1],
+        ['nlp_model', 'depression', 2, 1, -1],
+    ]
+    assert list(summary.columns) == ['table', 'concept_term', 'base', 'new', 'new_diff']
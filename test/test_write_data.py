@@ -0,0 +1,135 @@
+import datetime
+
+import pandas as pd
+import pytest
+import sqlalchemy as sa
+
+from mhnav_pipeline.write_data import write_table, BulkWriter, ExecutemanyWriter, PostgresCopyWriter, build_table, \
+    prepare_records, write_tables_incremental
+
+
+@pytest.fixture
+def engine():
+    return sa.create_engine('sqlite://')
+
+
+@pytest.fixture
+def nlp_model():
+    return pd.DataFrame({
+        'index_pat_enc_csn_id': [10, 10, 11],
+        'note_date': ['2021-01-01', '2021-01-02', '2021-02-01'],
+        'concept_term': ['depression', 'anxiety', 'depression'],
+    })
+
+
+@pytest.mark.parametrize('writer', [None, BulkWriter(chunksize=2), ExecutemanyWriter(chunksize=2)])
+def test_write_table_sqlite(engine, nlp_model, writer):
+    write_table(nlp_model, 'nlp_model_test', engine, 'nlp_model', writer=writer)
+    with engine.connect() as conn:
+        rows = conn.execute(sa.text('SELECT * FROM nlp_model_test ORDER BY note_date')).fetchall()
+    assert [tuple(row) for row in rows] == [
+        (10, '2021-01-01', 'depression'),
+        (10, '2021-01-02', 'anxiety'),
+        (11, '2021-02-01', 'depression'),
+    ]
+
+
+def test_write_table_schema(engine, nlp_model):
+    write_table(nlp_model, 'nlp_model_test', engine, 'nlp_model')
+    columns = {col['name']: col for col in sa.inspect(engine).get_columns('nlp_model_test')}
+    assert isinstance(columns['index_pat_enc_csn_id']['type'], sa.BigInteger)
+    assert isinstance(columns['note_date']['type'], sa.Date)
+    assert columns['concept_term']['type'].length == 50
+    assert not columns['concept_term']['nullable']
+    table = sa.Table('nlp_model_test', sa.MetaData(), autoload_with=engine)
+    with engine.connect() as conn:
+        assert conn.execute(sa.select(table.c.note_date)).scalars().first() == datetime.date(2021, 1, 1)
+
+
+def test_write_table_exists(engine, nlp_model):
+    write_table(nlp_model, 'nlp_model_test', engine, 'nlp_model')
+    with pytest.raises(ValueError):
+        write_table(nlp_model, 'nlp_model_test', engine, 'nlp_model')
+    write_table(nlp_model.iloc[:1], 'nlp_model_test', engine, 'nlp_model', overwrite_existing=True)
+    with engine.connect() as conn:
+        assert conn.execute(sa.text('SELECT COUNT(*) FROM nlp_model_test')).scalar() == 1
+
+
+def test_write_table_rolls_back(engine, nlp_model):
+    nlp_model.loc[2, 'concept_term'] = None  # violates NOT NULL
+    with pytest.raises(sa.exc.IntegrityError):
+        write_table(nlp_model, 'nlp_model_test', engine, 'nlp_model', writer=ExecutemanyWriter(chunksize=2))
+    # pysqlite commits DDL immediately, but the first chunk of records must have been rolled back
+    with engine.connect() as conn:
+        assert conn.execute(sa.text('SELECT COUNT(*) FROM nlp_model_test')).scalar() == 0
+
+
+def test_build_table_infers_types(nlp_model):
+    df = nlp_model.assign(is_index=1, score=0.5, precontext='text')
+    table = build_table('nlp_regex_test', df)
+    assert isinstance(table.c.note_date.type, sa.Date)
+    assert isinstance(table.c.is_index.type, sa.Integer)
+    assert isinstance(table.c.score.type, sa.Float)
+    assert isinstance(table.c.precontext.type, sa.UnicodeText)
+
+
+def _rows(engine, tablename):
+    with engine.connect() as conn:
+        return sorted(tuple(row) for row in conn.execute(sa.text(f'SELECT * FROM {tablename}')))
+
+
+@pytest.mark.parametrize('writer', [None, BulkWriter(chunksize=2)])
+def test_write_tables_incremental(engine, nlp_model, writer):
+    nlp_index = pd.DataFrame({
+        'pat_enc_csn_id': [10, 10, 11],
+        'note_date': ['2021-03-01'] * 3,
+        'concept_term': ['depression', 'depression', 'anxiety'],
+        'text_string': ['depressed', 'depression', None],
+    })
+    nlp_positive = pd.DataFrame({'pat_enc_csn_id': [10, 11], 'note_count': [2, 1]})
+    tables = [(nlp_positive, 'nlp_positive', 'nlp_positive'), (nlp_model, 'nlp_model', 'nlp_model'),
+              (nlp_index, 'nlp_index', 'nlp_index')]
+    write_tables_incremental(tables, engine, writer=writer)  # creates tables
+    write_tables_incremental(tables, engine, writer=writer)  # nothing changed
+    assert len(_rows(engine, 'nlp_model')) == 3
+
+    tables = [
+        (pd.DataFrame({'pat_enc_csn_id': [10, 12], 'note_count': [3, 1]}), 'nlp_positive', 'nlp_positive'),
+        (nlp_model.iloc[1:], 'nlp_model', 'nlp_model'),
+        (nlp_index.iloc[[0, 2]], 'nlp_index', 'nlp_index'),
+    ]
+    write_tables_incremental(tables, engine, writer=writer)
+    assert _rows(engine, 'nlp_positive') == [(10, 3), (12, 1)]
+    assert _rows(engine, 'nlp_model') == [(10, '2021-01-02', 'anxiety'), (11, '2021-02-01', 'depression')]
+    assert _rows(engine, 'nlp_index') == [(10, '2021-03-01', 'depression', 'depressed'),
+                                          (11, '2021-03-01', 'anxiety', None)]
+
+
+def test_write_tables_incremental_rolls_back(engine, nlp_model):
+    write_tables_incremental([(nlp_model, 'nlp_model', 'nlp_model')], engine)
+    nlp_positive = pd.DataFrame({'pat_enc_csn_id': [10, 11], 'note_count': [2, None]})  # violates NOT NULL
+    write_table(nlp_positive.iloc[:1], 'nlp_positive', engine, 'nlp_positive')
+    with pytest.raises(sa.exc.IntegrityError):
+        write_tables_incremental([(nlp_model.iloc[:1], 'nlp_model', 'nlp_model'),
+                                  (nlp_positive, 'nlp_positive', 'nlp_positive')], engine)
+    assert len(_rows(engine, 'nlp_model')) == 3
+
+
+def test_copy_buffer_distinguishes_empty_strings():
+    df = pd.DataFrame({
+        'pat_enc_csn_id': [1, 2, 3],
+        'capture': ['', None, 'say "hi"'],
+        'precontext': ['a,\nb', '', None],
+    })
+    records = prepare_records(df, build_table('nlp_regex', df))
+    buffer, null = PostgresCopyWriter.copy_buffer(records)
+    assert null == '\\N'
+    # COPY reads the unquoted marker as NULL and an empty field as an empty string
+    assert buffer.read() == '1,,"a,\nb"\n2,\\N,\n3,"say ""hi""",\\N\n'
+
+
+def test_copy_buffer_marker_not_in_values():
+    df = pd.DataFrame({'capture': ['\\N', None, '\\N_']}, dtype=object)
+    buffer, null = PostgresCopyWriter.copy_buffer(df)
+    assert null == '\\N__'
+    assert buffer.read() == '\\N\n\\N__\n\\N_\n'